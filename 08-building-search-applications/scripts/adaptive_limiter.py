@@ -0,0 +1,229 @@
+""" Adaptive (AIMD) concurrency limiter shared by the Azure OpenAI calls of the enrichment scripts.
+
+The number of requests in flight grows by about one per round trip while the
+service keeps up, and halves on a 429. Throttled requests hold every caller
+until the retry-after hint has passed, instead of each thread sleeping its own
+random backoff. With a target tokens-per-minute the limiter also keeps the
+tokens sent in the last minute under the target, and it stops growing when the
+x-ratelimit-remaining-* headers show the quota is nearly used.
+"""
+
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+import openai
+import requests
+
+INITIAL_CONCURRENCY = 4
+MIN_CONCURRENCY = 1
+MAX_CONCURRENCY = 64
+DECREASE_FACTOR = 0.5
+# retry-after used when a 429 carries no hint
+DEFAULT_RETRY_AFTER = 5.0
+TPM_WINDOW_SECONDS = 60.0
+# usage is kept a little longer than the window, a request reaches the service after it is counted
+TPM_WINDOW_MARGIN = 1.0
+# stop growing when less than this fraction of the quota remains
+LOW_REMAINING_FRACTION = 0.1
+MAX_CONNECTION_RETRIES = 2
+
+logger = logging.getLogger(__name__)
+
+
+def retry_after_seconds(headers):
+    """return the retry-after hint of a response in seconds, or None"""
+    if not headers:
+        return None
+    for name, scale in [("retry-after-ms", 0.001), ("retry-after", 1.0)]:
+        value = headers.get(name)
+        if value is not None:
+            try:
+                return float(value) * scale
+            except ValueError:
+                # an HTTP date instead of seconds
+                continue
+    return None
+
+
+class AdaptiveLimiter:
+    """thread safe AIMD limit on the requests in flight and the tokens per minute"""
+
+    def __init__(
+        self,
+        target_tpm=None,
+        initial=INITIAL_CONCURRENCY,
+        min_limit=MIN_CONCURRENCY,
+        max_limit=MAX_CONCURRENCY,
+        window=TPM_WINDOW_SECONDS,
+    ):
+        """initialize the limiter, target_tpm None only limits on 429s"""
+        self.target_tpm = target_tpm
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.window = window
+        self.in_flight = 0
+        self.usage = deque()
+        self.window_tokens = 0
+        self.blocked_until = 0.0
+        self.last_decrease = 0.0
+        self.quota_low = False
+        self.max_remaining = {}
+        self.requests = 0
+        self.throttled = 0
+        self.peak_limit = self.limit
+        self.condition = threading.Condition()
+
+    def _expire(self, now):
+        """forget the token usage older than the window"""
+        while self.usage and self.usage[0][0] <= now - self.window - TPM_WINDOW_MARGIN:
+            entry = self.usage.popleft()
+            self.window_tokens -= entry[1]
+            # a reservation cancelled after it expired has nothing left to remove
+            entry[1] = 0
+
+    def _wait_time(self, tokens, now):
+        """seconds to wait before a request of tokens can start, None to wait for a release"""
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.in_flight >= int(self.limit):
+            return None
+        if self.target_tpm and self.usage and self.window_tokens + tokens > self.target_tpm:
+            return self.usage[0][0] + self.window + TPM_WINDOW_MARGIN - now
+        return 0
+
+    def acquire(self, tokens=0):
+        """
+        block until a request of about `tokens` tokens may start,
+        returns its usage entry for `throttle` to cancel
+        """
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                self._expire(now)
+                wait = self._wait_time(tokens, now)
+                if wait == 0:
+                    break
+                self.condition.wait(wait)
+
+            self.in_flight += 1
+            self.requests += 1
+            return self._record(now, tokens)
+
+    def _record(self, now, tokens):
+        """add tokens to the usage window, returns the [time, tokens] entry or None"""
+        if not tokens:
+            return None
+        entry = [now, tokens]
+        self.usage.append(entry)
+        self.window_tokens += tokens
+        return entry
+
+    def release(self, reserved=0, used=None):
+        """a request finished, grow the limit by about one per round trip"""
+        with self.condition:
+            self.in_flight -= 1
+            # the quota is charged at least the reservation, max_tokens counts even if unused
+            if used is not None and used > reserved:
+                self._record(time.monotonic(), used - reserved)
+
+            near_target = self.target_tpm and self.window_tokens >= self.target_tpm
+            if not self.quota_low and not near_target:
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+                self.peak_limit = max(self.peak_limit, self.limit)
+            self.condition.notify_all()
+
+    def throttle(self, reservation=None, retry_after=None):
+        """
+        a request was throttled, halve the limit and hold every caller for retry_after,
+        reservation is the usage entry returned by `acquire`
+        """
+        with self.condition:
+            self.in_flight -= 1
+            self.throttled += 1
+            now = time.monotonic()
+            # a throttled request does not use the quota, its reservation is zeroed in place
+            # so the window never counts less than the requests that reached the service
+            if reservation is not None:
+                self.window_tokens -= reservation[1]
+                reservation[1] = 0
+            retry_after = DEFAULT_RETRY_AFTER if retry_after is None else retry_after
+
+            # the 429s of one burst count as a single congestion event
+            if now >= self.last_decrease + max(retry_after, 1.0):
+                self.limit = max(self.min_limit, self.limit * DECREASE_FACTOR)
+                self.last_decrease = now
+                logger.info("Throttled, concurrency limit %.1f", self.limit)
+
+            self.blocked_until = max(self.blocked_until, now + retry_after)
+            self.condition.notify_all()
+
+    def observe(self, headers):
+        """read the remaining quota headers of a response"""
+        with self.condition:
+            low = False
+            for name in ["x-ratelimit-remaining-tokens", "x-ratelimit-remaining-requests"]:
+                value = headers.get(name)
+                if value is None:
+                    continue
+                # the largest remaining value seen approximates the quota
+                remaining = float(value)
+                quota = self.max_remaining[name] = max(self.max_remaining.get(name, 0), remaining)
+                low = low or remaining < quota * LOW_REMAINING_FRACTION
+            self.quota_low = low
+
+    def call(self, fn, *args, tokens=0, **kwargs):
+        """call fn under the limiter, tokens is the estimated size of the request"""
+        reservation = self.acquire(tokens)
+        try:
+            response = fn(*args, **kwargs)
+        except openai.error.RateLimitError as rate_limit_error:
+            self.throttle(reservation, retry_after_seconds(rate_limit_error.headers))
+            raise
+        except BaseException:
+            self.release(tokens)
+            raise
+
+        usage = response.get("usage") or {}
+        self.release(tokens, usage.get("total_tokens"))
+        return response
+
+    def wait(self, retry_state):
+        """tenacity wait, throttled calls already wait in acquire so only jitter is added"""
+        exception = retry_state.outcome.exception() if retry_state.outcome else None
+        if isinstance(exception, openai.error.RateLimitError):
+            return random.uniform(0, 1)
+        return min(30, random.uniform(0, 2**retry_state.attempt_number))
+
+    def install(self):
+        """
+        route the openai requests of the calling script through `session`,
+        called by the entry points so importing a helper never changes openai
+        """
+        openai.requestssession = self.session
+
+    def session(self):
+        """requests session for openai.requestssession that reports the quota headers"""
+        session = requests.Session()
+        session.mount(
+            "https://", requests.adapters.HTTPAdapter(max_retries=MAX_CONNECTION_RETRIES)
+        )
+        session.hooks["response"].append(lambda response, **kwargs: self.observe(response.headers))
+        return session
+
+    def stats(self):
+        """requests, throttled requests and the current and peak concurrency limits"""
+        with self.condition:
+            return {
+                "requests": self.requests,
+                "throttled": self.throttled,
+                "limit": self.limit,
+                "peak_limit": self.peak_limit,
+            }
+
+
+target_tpm = os.getenv("AZURE_OPENAI_TARGET_TPM")
+limiter = AdaptiveLimiter(target_tpm=int(target_tpm) if target_tpm else None)
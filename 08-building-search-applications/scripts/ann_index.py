@@ -0,0 +1,179 @@
+""" Approximate nearest neighbour search with an inverted file (IVF) index and k-means coarse quantization.
+
+The vectors are clustered with spherical k-means into `nlist` lists. A query
+only scores the vectors in the `nprobe` lists whose centroids are closest,
+so `nprobe` trades recall for latency. More lists are probed when the
+closest ones hold fewer vectors than the rows asked for, and small indexes are
+searched exactly.
+"""
+
+import numpy as np
+from vector_ops import normalize_rows, top_k
+
+KMEANS_ITERATIONS = 10
+# k-means is trained on a sample of this many points per list
+TRAINING_POINTS_PER_LIST = 256
+ASSIGN_CHUNK_SIZE = 65536
+# below this many vectors scoring every vector is about as fast as probing lists
+EXACT_SEARCH_MAX_COUNT = 4096
+
+
+def default_nlist(count: int) -> int:
+    """rule of thumb number of lists for a corpus size"""
+    return int(max(1, min(count, round(np.sqrt(count)))))
+
+
+def assign(vectors, centroids):
+    """return the index of the most similar centroid for each vector"""
+    labels = np.empty(vectors.shape[0], dtype=np.int32)
+    for start in range(0, vectors.shape[0], ASSIGN_CHUNK_SIZE):
+        chunk = vectors[start : start + ASSIGN_CHUNK_SIZE]
+        labels[start : start + len(chunk)] = np.argmax(chunk @ centroids.T, axis=1)
+    return labels
+
+
+def kmeans(vectors, k, iterations=KMEANS_ITERATIONS, seed=42):
+    """spherical k-means, returns unit length centroids"""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(vectors.shape[0], k, replace=False)].copy()
+
+    for _ in range(iterations):
+        labels = assign(vectors, centroids)
+        counts = np.bincount(labels, minlength=k)
+
+        # sum the members of each cluster with one pass over the label sorted vectors
+        order = np.argsort(labels, kind="stable")
+        present = np.flatnonzero(counts)
+        starts = np.concatenate(([0], np.cumsum(counts[present])[:-1]))
+        sums = np.zeros_like(centroids)
+        sums[present] = np.add.reduceat(vectors[order], starts, axis=0)
+
+        # re-seed empty clusters with random points
+        empty = np.flatnonzero(counts == 0)
+        if len(empty):
+            sums[empty] = vectors[rng.choice(vectors.shape[0], len(empty), replace=False)]
+
+        centroids = normalize_rows(sums)
+
+    return centroids
+
+
+class IvfIndex:
+    """inverted file index over unit length float32 vectors
+
+    The index keeps a reference to the vectors it was built from, which may be
+    a memory mapped matrix, and only stores the centroids and the list
+    membership. `save` writes those to a .npz file and `load` reattaches them
+    to the same vectors.
+    """
+
+    def __init__(self, vectors, centroids, order, offsets, nprobe=8):
+        """create the index from its parts, use `build` or `load` instead"""
+        self.vectors = normalize_rows(vectors)
+        self.centroids = centroids
+        self.order = order
+        self.offsets = offsets
+        self.nprobe = nprobe
+
+    @classmethod
+    def build(cls, vectors, nlist=None, nprobe=8, seed=42):
+        """train the coarse quantizer and assign every vector to a list"""
+        vectors = normalize_rows(vectors)
+        count = vectors.shape[0]
+        nlist = min(nlist or default_nlist(count), count)
+
+        rng = np.random.default_rng(seed)
+        sample_size = min(count, nlist * TRAINING_POINTS_PER_LIST)
+        sample = vectors[np.sort(rng.choice(count, sample_size, replace=False))]
+        centroids = kmeans(sample, nlist, seed=seed)
+
+        labels = assign(vectors, centroids)
+        order = np.argsort(labels, kind="stable").astype(np.int64)
+        offsets = np.zeros(nlist + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(labels, minlength=nlist))
+
+        return cls(vectors, centroids, order, offsets, nprobe)
+
+    @classmethod
+    def load(cls, path, vectors):
+        """load the index saved with `save` and attach it to its vectors"""
+        with np.load(path) as data:
+            if int(data["count"]) != vectors.shape[0]:
+                raise ValueError(
+                    f"IVF index {path} was built for {int(data['count'])} vectors, "
+                    f"got {vectors.shape[0]}"
+                )
+            return cls(
+                vectors,
+                data["centroids"],
+                data["order"],
+                data["offsets"],
+                int(data["nprobe"]),
+            )
+
+    def save(self, path):
+        """save the centroids and list membership"""
+        np.savez(
+            path,
+            centroids=self.centroids,
+            order=self.order,
+            offsets=self.offsets,
+            nprobe=self.nprobe,
+            count=self.vectors.shape[0],
+        )
+
+    @property
+    def nlist(self):
+        return self.centroids.shape[0]
+
+    def candidates(self, query, nprobe, rows=0):
+        """
+        return the ids of the vectors in the nprobe lists closest to the query,
+        further lists are probed until they hold at least `rows` vectors
+        """
+        if self.vectors.shape[0] <= EXACT_SEARCH_MAX_COUNT:
+            return np.arange(self.vectors.shape[0])
+
+        lists = top_k(self.centroids @ query, self.nlist)
+        sizes = np.cumsum(np.diff(self.offsets)[lists])
+        nprobe = max(nprobe, int(np.searchsorted(sizes, rows)) + 1)
+        lists = lists[: min(nprobe, self.nlist)]
+        ids = np.concatenate(
+            [self.order[self.offsets[i] : self.offsets[i + 1]] for i in lists]
+        )
+        # ascending ids read the (possibly memory mapped) vectors sequentially
+        ids.sort()
+        return ids
+
+    def search(self, query_vector, rows=10, nprobe=None):
+        """return the (ids, similarities) of the approximate best matches, best first"""
+        query = normalize_rows(query_vector)
+        ids = self.candidates(query, nprobe or self.nprobe, rows)
+
+        scores = self.vectors[ids] @ query
+        best = top_k(scores, rows)
+        return ids[best], scores[best]
+
+    def search_batch(self, query_vectors, rows=10, nprobe=None):
+        """search several queries, returns a list of (ids, similarities)"""
+        return [
+            self.search(query, rows, nprobe) for query in np.atleast_2d(query_vectors)
+        ]
+
+    def kneighbors(self, query_vectors, n_neighbors=5, nprobe=None):
+        """scikit-learn NearestNeighbors compatible search returning (distances, indices)
+
+        distances are euclidean distances between the unit length vectors.
+        """
+        if n_neighbors > self.vectors.shape[0]:
+            raise ValueError(
+                f"Expected n_neighbors <= n_samples, n_samples = {self.vectors.shape[0]}, "
+                f"n_neighbors = {n_neighbors}"
+            )
+        # every query gets n_neighbors results, the probe widens when its lists are too small
+        results = self.search_batch(query_vectors, n_neighbors, nprobe)
+        shape = (len(results), n_neighbors)
+        similarities = np.array([similarities for _, similarities in results], dtype=np.float32)
+        indices = np.array([ids for ids, _ in results], dtype=np.int64).reshape(shape)
+        distances = np.sqrt(np.maximum(0.0, 2.0 - 2.0 * similarities)).reshape(shape)
+        return distances, indices
@@ -0,0 +1,37 @@
+""" Atomic file writes shared by the transcript_* scripts.
+
+The data is written to a temporary file in the folder of the target and renamed
+over it, so an interrupted run never leaves a partial file behind.
+"""
+
+import contextlib
+import json
+import os
+import tempfile
+
+
+@contextlib.contextmanager
+def atomic_open(filename, mode="w"):
+    """open a temporary file next to filename, it replaces filename when the block succeeds"""
+    descriptor, temp_filename = tempfile.mkstemp(
+        dir=os.path.dirname(filename) or ".", prefix=os.path.basename(filename), suffix=".tmp"
+    )
+    try:
+        with open(descriptor, mode, encoding=None if "b" in mode else "utf-8") as file:
+            yield file
+        os.replace(temp_filename, filename)
+    except BaseException:
+        os.remove(temp_filename)
+        raise
+
+
+def write_text(filename, text):
+    """write a text file, atomically"""
+    with atomic_open(filename) as file:
+        file.write(text)
+
+
+def write_json(filename, data, **kwargs):
+    """write data as json, atomically"""
+    with atomic_open(filename) as file:
+        json.dump(data, file, **kwargs)
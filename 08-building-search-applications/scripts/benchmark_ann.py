@@ -0,0 +1,79 @@
+""" Benchmark recall@10 and queries/sec of the IVF index against exact search."""
+
+import argparse
+import json
+import os
+import time
+import numpy as np
+from ann_index import IvfIndex
+from vector_ops import normalize_rows, top_k
+
+RAG_DATASET = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "..",
+    "..",
+    "15-rag-and-vector-databases",
+    "output.json",
+)
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--rag", default=RAG_DATASET, help="RAG output.json with embeddings")
+parser.add_argument(
+    "--sizes", default="10000,100000", help="synthetic corpus sizes, e.g. 10000,100000,1000000"
+)
+parser.add_argument("-d", "--dimensions", type=int, default=1536)
+parser.add_argument("-q", "--queries", type=int, default=200)
+parser.add_argument("-k", "--rows", type=int, default=10)
+parser.add_argument("--nprobe", default="1,4,8,16,32")
+args = parser.parse_args()
+
+
+def synthetic_corpus(count, dimensions, queries, seed=42):
+    """clustered unit vectors, roughly shaped like topic clusters of embeddings"""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((max(1, count // 100), dimensions), dtype=np.float32)
+    labels = rng.integers(0, len(centers), count + queries)
+    noise = rng.standard_normal((count + queries, dimensions), dtype=np.float32)
+    vectors = normalize_rows(centers[labels] + 2.0 * noise)
+    return vectors[:count], vectors[count:]
+
+
+def exact_search(vectors, queries, rows):
+    """exact top-k, returns the ids and the queries/sec"""
+    start_time = time.perf_counter()
+    ids = [top_k(vectors @ query, rows) for query in queries]
+    return ids, len(queries) / (time.perf_counter() - start_time)
+
+
+def report(name, vectors, queries):
+    """print recall@k and queries/sec for each nprobe"""
+    truth, exact_qps = exact_search(vectors, queries, args.rows)
+
+    start_time = time.perf_counter()
+    index = IvfIndex.build(vectors)
+    build_time = time.perf_counter() - start_time
+
+    print(f"\n{name}: {len(vectors)} vectors, {index.nlist} lists, built in {build_time:.1f}s")
+    print(f"{'search':>12} {'recall@' + str(args.rows):>10} {'queries/sec':>12}")
+    print(f"{'exact':>12} {1.0:>10.3f} {exact_qps:>12.1f}")
+
+    for nprobe in [int(n) for n in args.nprobe.split(",")]:
+        start_time = time.perf_counter()
+        results = index.search_batch(queries, args.rows, nprobe)
+        qps = len(queries) / (time.perf_counter() - start_time)
+
+        hits = sum(
+            len(np.intersect1d(ids, expected)) for (ids, _), expected in zip(results, truth)
+        )
+        recall = hits / (len(queries) * args.rows)
+        print(f"{'nprobe ' + str(nprobe):>12} {recall:>10.3f} {qps:>12.1f}")
+
+
+if os.path.exists(args.rag):
+    with open(args.rag, "r", encoding="utf-8") as f:
+        rag_vectors = normalize_rows([doc["embedding"] for doc in json.load(f)])
+    report("RAG output.json", rag_vectors, rag_vectors)
+
+for size in [int(n) for n in args.sizes.split(",")]:
+    corpus, corpus_queries = synthetic_corpus(size, args.dimensions, args.queries)
+    report(f"Synthetic {size}", corpus, corpus_queries)
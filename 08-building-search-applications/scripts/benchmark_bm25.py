@@ -0,0 +1,76 @@
+""" Benchmark the BM25 MaxScore top-k against scoring every posting, over a synthetic segment corpus."""
+
+import argparse
+import random
+import time
+import numpy as np
+from bm25_index import Bm25Index
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-n", "--segments", type=int, default=100000)
+parser.add_argument("--vocabulary", type=int, default=20000)
+parser.add_argument("--words", type=int, default=150, help="words per segment")
+parser.add_argument("-q", "--queries", type=int, default=200)
+parser.add_argument("-k", "--rows", type=int, default=10)
+args = parser.parse_args()
+
+rng = random.Random(42)
+np_rng = np.random.default_rng(42)
+vocabulary = np.array([f"term{i}" for i in range(args.vocabulary)])
+# zipf distributed words, like the words of the transcripts
+weights = 1 / np.arange(1, args.vocabulary + 1)
+weights /= weights.sum()
+speakers = [f"speaker{i}" for i in range(200)]
+
+
+def words(count):
+    """count zipf distributed words"""
+    return " ".join(vocabulary[np_rng.choice(args.vocabulary, count, p=weights)])
+
+
+segments = [
+    {"text": words(args.words), "title": words(6), "speaker": rng.choice(speakers)}
+    for _ in range(args.segments)
+]
+
+start_time = time.perf_counter()
+index = Bm25Index.build(segments)
+postings = len(index.tfs)
+print(
+    f"Index build: {len(index)} segments, {len(index.terms)} terms, {postings} postings, "
+    f"{time.perf_counter() - start_time:.1f}s"
+)
+print(
+    f"Postings: {index.nbytes / 2**20:.1f} MB compressed, "
+    f"{postings * 6 / 2**20:.1f} MB as uint32 doc ids and uint16 frequencies"
+)
+
+# queries mix frequent and rare terms and sometimes a speaker name
+queries = [
+    words(rng.randint(2, 5))
+    + (" " + rng.choice(speakers) if rng.random() < 0.3 else "")
+    for _ in range(args.queries)
+]
+
+for name, search in [("exhaustive", index.search_exhaustive), ("maxscore", index.search)]:
+    search(queries[0], args.rows)
+    latencies = []
+    for query in queries:
+        start_time = time.perf_counter()
+        search(query, args.rows)
+        latencies.append(time.perf_counter() - start_time)
+    latencies = np.array(latencies) * 1000
+    print(
+        f"{name:>12}: p50 {np.percentile(latencies, 50):.2f} ms, "
+        f"p99 {np.percentile(latencies, 99):.2f} ms"
+    )
+
+mismatches = sum(
+    not np.allclose(
+        np.sort(index.search(query, args.rows)[1]),
+        np.sort(index.search_exhaustive(query, args.rows)[1]),
+        rtol=1e-5,
+    )
+    for query in queries
+)
+print(f"Top {args.rows} score mismatches against exhaustive: {mismatches}")
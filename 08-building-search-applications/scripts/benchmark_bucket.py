@@ -0,0 +1,66 @@
+""" Benchmark serial and process pool bucketing on a synthetic corpus of transcripts."""
+
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+from transcript_enrich_bucket import bucket_videos
+
+WORDS = "azure machine learning model notebook data neural network onnx cloud speaker video".split()
+
+
+def write_corpus(folder, videos, lines, seed=42):
+    """write the metadata and .json.vtt files of a synthetic corpus, returns the metadata files"""
+    rng = random.Random(seed)
+    files = []
+    for i in range(videos):
+        video_id = f"video{i:06d}"
+        metadata = {
+            "speaker": "Synthetic Speaker",
+            "title": f"Synthetic video {i}",
+            "videoId": video_id,
+            "description": " ".join(rng.choices(WORDS, k=40)),
+        }
+        captions = [
+            {"text": " ".join(rng.choices(WORDS, k=10)), "start": line * 2.0, "duration": 2.0}
+            for line in range(lines)
+        ]
+
+        metadata_file = os.path.join(folder, video_id + ".json")
+        with open(metadata_file, "w", encoding="utf-8") as f:
+            json.dump(metadata, f)
+        with open(metadata_file + ".vtt", "w", encoding="utf-8") as f:
+            json.dump(captions, f)
+        files.append(metadata_file)
+    return files
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--videos", type=int, default=10000)
+    parser.add_argument("--lines", type=int, default=400, help="caption lines per video")
+    parser.add_argument("-m", "--minutes", type=int, default=3)
+    parser.add_argument("--workers", default=f"1,{os.cpu_count()}")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        start_time = time.perf_counter()
+        files = write_corpus(folder, args.videos, args.lines)
+        print(f"{len(files)} transcripts written in {time.perf_counter() - start_time:.1f}s")
+
+        print(f"{'workers':>8} {'videos/sec':>12} {'segments':>10} {'seconds':>8}")
+        baseline = None
+        for workers in sorted({int(w) for w in args.workers.split(",")}):
+            start_time = time.perf_counter()
+            results = list(bucket_videos(files, folder, args.minutes, workers))
+            elapsed = time.perf_counter() - start_time
+
+            # the merged output must not depend on the number of workers
+            baseline = baseline or results
+            if results != baseline:
+                raise RuntimeError(f"{workers} workers produced different buckets")
+
+            segments = sum(len(video_segments) for video_segments in results)
+            print(f"{workers:>8} {len(files) / elapsed:>12.1f} {segments:>10} {elapsed:>8.1f}")
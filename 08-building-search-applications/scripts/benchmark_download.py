@@ -0,0 +1,126 @@
+""" Benchmark the previous thread per download approach against the asyncio downloader
+on a local stub of the YouTube Data API and the YouTube caption pages, then the
+requests of a manifest backed resync after a day of playlist changes."""
+
+import argparse
+import asyncio
+import os
+import queue
+import tempfile
+import threading
+import time
+from youtube_transcript_api import YouTubeTranscriptApi
+import transcript_download
+from atomic_file import write_json
+from download_manifest import Manifest
+from stub_youtube_server import start_stub_server, use_stub_server
+
+
+def download_threads(youtube, playlist_id, folder, threads):
+    """list every page first, then download with a new session per video, returns downloads"""
+    items = queue.Queue()
+    for item in transcript_download.list_playlist_items(youtube, playlist_id):
+        items.put(item)
+
+    downloaded = []
+
+    def process_queue():
+        while True:
+            try:
+                item = items.get_nowait()
+            except queue.Empty:
+                return
+            video_id = item["snippet"]["resourceId"]["videoId"]
+            transcript = YouTubeTranscriptApi.get_transcript(video_id)
+            write_json(
+                os.path.join(folder, video_id + ".json.vtt"), transcript, indent=4
+            )
+            downloaded.append(video_id)
+
+    workers = [threading.Thread(target=process_queue) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return len(downloaded)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--videos", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds per request")
+    parser.add_argument(
+        "--connect-latency", type=float, default=0.1, help="seconds per new connection"
+    )
+    parser.add_argument(
+        "-c", "--concurrency", type=int, default=transcript_download.PROCESSING_THREADS
+    )
+    parser.add_argument("--new-videos", type=int, default=5, help="videos added before the resync")
+    args = parser.parse_args()
+
+    server, base_url = start_stub_server(
+        videos=args.videos, latency=args.latency, connect_latency=args.connect_latency
+    )
+    os.environ.setdefault("GOOGLE_DEVELOPER_API_KEY", "stub")
+    youtube = transcript_download.build_youtube_client(use_stub_server(base_url))
+
+    print(
+        f"Stub playlist of {args.videos} videos, {args.latency}s per request, "
+        f"{args.connect_latency}s per connection"
+    )
+    print(f"{'method':>28} {'downloads/sec':>14} {'connections':>12} {'seconds':>8}")
+
+    def run(name, download):
+        connections = server.connections
+        with tempfile.TemporaryDirectory() as folder:
+            start_time = time.perf_counter()
+            downloaded = download(folder)
+            elapsed = time.perf_counter() - start_time
+        if downloaded != args.videos:
+            raise RuntimeError(f"{name} downloaded {downloaded} of {args.videos} videos")
+        print(
+            f"{name:>28} {downloaded / elapsed:>14.1f} "
+            f"{server.connections - connections:>12} {elapsed:>8.1f}"
+        )
+
+    run(
+        f"threads, {args.concurrency}",
+        lambda folder: download_threads(youtube, "stub", folder, args.concurrency),
+    )
+    run(
+        f"asyncio, {args.concurrency} in flight",
+        lambda folder: asyncio.run(
+            transcript_download.download_playlist(youtube, "stub", folder, args.concurrency)
+        )["downloaded"],
+    )
+
+    print(f"{'sync with manifest':>36} {'requests':>10} {'304s':>6} {'downloaded':>11} "
+          f"{'refreshed':>10} {'removed':>8} {'seconds':>8}")
+
+    def sync(name, folder, manifest):
+        requests, not_modified = server.requests, server.not_modified
+        start_time = time.perf_counter()
+        counts = asyncio.run(
+            transcript_download.download_playlist(
+                youtube, "stub", folder, args.concurrency, manifest
+            )
+        )
+        elapsed = time.perf_counter() - start_time
+        print(
+            f"{name:>36} {server.requests - requests:>10} "
+            f"{server.not_modified - not_modified:>6} {counts['downloaded']:>11} "
+            f"{counts['refreshed']:>10} {counts['removed']:>8} {elapsed:>8.1f}"
+        )
+
+    with tempfile.TemporaryDirectory() as folder:
+        manifest = Manifest(os.path.join(folder, transcript_download.MANIFEST_FILE))
+        sync("first run", folder, manifest)
+        sync("rerun, no changes", folder, manifest)
+
+        # a day of changes: new videos at the end, a retitled video and a removed one
+        playlist = server.playlist
+        playlist[1] = (playlist[1][0], playlist[1][1] + " (updated)")
+        del playlist[-1]
+        playlist += [(f"newvid{i:05d}", f"New video {i}") for i in range(args.new_videos)]
+        sync(f"rerun, {args.new_videos} new, 1 retitled, 1 removed", folder, manifest)
+        manifest.close()
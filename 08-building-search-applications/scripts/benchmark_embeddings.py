@@ -0,0 +1,72 @@
+""" Benchmark batched embedding requests against the local stub embeddings server."""
+
+import argparse
+import logging
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+import openai
+from adaptive_limiter import limiter
+from embedding_batch import build_batches, get_text_embeddings
+from stub_openai_server import start_stub_server
+
+logging.basicConfig(level=logging.WARNING)
+logger = logging.getLogger(__name__)
+
+BATCH_SIZES = [1, 16, 128]
+PROCESSING_THREADS = 6
+WORDS = "azure machine learning model notebook data neural network onnx cloud speaker video".split()
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-n", "--segments", type=int, default=2048)
+parser.add_argument("--words", type=int, default=300, help="words per segment")
+parser.add_argument("--latency", type=float, default=0.05, help="stub latency per request")
+parser.add_argument("--batch-tokens", type=int, default=1000000)
+parser.add_argument("--verbose", action="store_true")
+args = parser.parse_args()
+if args.verbose:
+    logger.setLevel(logging.DEBUG)
+
+
+def synthetic_segments(count, words):
+    """generate synthetic transcript segments"""
+    rng = random.Random(42)
+    return [
+        {"videoId": f"video{i // 20}", "text": " ".join(rng.choices(WORDS, k=words))}
+        for i in range(count)
+    ]
+
+
+def run(segments, batch_size):
+    """embed all the segments and return the segments per second"""
+    batches = list(build_batches(segments, batch_size, args.batch_tokens))
+
+    def embed(batch):
+        embeddings = get_text_embeddings([text for _, text in batch])
+        for (segment, _), embedding in zip(batch, embeddings):
+            segment["ada_v2"] = embedding
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=PROCESSING_THREADS) as executor:
+        list(executor.map(embed, batches))
+    elapsed = time.perf_counter() - start_time
+
+    return len(segments) / elapsed, len(batches)
+
+
+server, base_url = start_stub_server(latency=args.latency)
+
+openai.api_type = "azure"
+openai.api_key = "stub"
+openai.api_base = base_url
+openai.api_version = "2023-05-15"
+limiter.install()
+
+print(f"Stub server: {base_url}, latency {args.latency * 1000:.0f} ms per request")
+print(f"{'batch size':>10} {'requests':>10} {'segments/sec':>14}")
+
+for size in BATCH_SIZES:
+    rate, requests = run(synthetic_segments(args.segments, args.words), size)
+    print(f"{size:>10} {requests:>10} {rate:>14.1f}")
+
+server.shutdown()
@@ -0,0 +1,87 @@
+""" Benchmark pre-filtered vector search against post-filtering the scores of every segment,
+for selective and broad speaker, video, title and time filters over a synthetic index."""
+
+import argparse
+import random
+import time
+import numpy as np
+from video_search import VideoIndex
+from vector_ops import normalize_rows, top_k
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-n", "--segments", type=int, default=100000)
+parser.add_argument("-d", "--dimensions", type=int, default=1536)
+parser.add_argument("-q", "--queries", type=int, default=50)
+parser.add_argument("-k", "--rows", type=int, default=5)
+args = parser.parse_args()
+
+rng = random.Random(42)
+np_rng = np.random.default_rng(42)
+SEGMENTS_PER_VIDEO = 20
+TOPICS = ["azure machine learning", "onnx runtime", "jupyter notebooks", "responsible ai", "mlops"]
+
+# a few speakers host most of the videos, like the ai show
+speakers = [f"Speaker {i}" for i in range(500)]
+video_speakers = [
+    "Seth Juarez" if rng.random() < 0.3 else rng.choice(speakers)
+    for _ in range(args.segments // SEGMENTS_PER_VIDEO + 1)
+]
+video_titles = [f"Episode {i} {rng.choice(TOPICS)}" for i in range(len(video_speakers))]
+columns = {
+    "videoId": [f"video{i // SEGMENTS_PER_VIDEO}" for i in range(args.segments)],
+    "seconds": [(i % SEGMENTS_PER_VIDEO) * 180 for i in range(args.segments)],
+    "title": [video_titles[i // SEGMENTS_PER_VIDEO] for i in range(args.segments)],
+    "speaker": [video_speakers[i // SEGMENTS_PER_VIDEO] for i in range(args.segments)],
+}
+vectors = np_rng.standard_normal((args.segments, args.dimensions), dtype=np.float32)
+queries = np_rng.standard_normal((args.queries, args.dimensions), dtype=np.float32)
+
+start_time = time.perf_counter()
+index = VideoIndex(vectors, columns)
+index.filter_rows(speaker="Seth Juarez")
+print(f"Index and metadata build: {len(index)} x {args.dimensions}, {time.perf_counter() - start_time:.2f}s")
+
+FILTERS = [
+    ("one video", {"video_ids": "video42"}),
+    ("one speaker", {"speaker": "Speaker 7"}),
+    ("speaker, first 10 min", {"speaker": ["Speaker 7", "Speaker 9"], "end": 600}),
+    ("ten videos", {"video_ids": [f"video{i}" for i in range(0, 1000, 100)]}),
+    ("title word", {"title": "onnx"}),
+    ("main speaker", {"speaker": "Seth Juarez"}),
+    ("first half hour", {"end": 1800}),
+]
+
+
+def post_filter(query, rows, keep):
+    """score every segment, then drop the ones outside the filter"""
+    scores = index.vectors @ normalize_rows(query)
+    scores[~keep] = -np.inf
+    indices = top_k(scores, rows)
+    return indices[np.isfinite(scores[indices])]
+
+
+def percentile_ms(fn):
+    """p50 of fn over the queries in ms"""
+    fn(queries[0])
+    latencies = []
+    for query in queries:
+        start_time = time.perf_counter()
+        fn(query)
+        latencies.append(time.perf_counter() - start_time)
+    return np.percentile(np.array(latencies) * 1000, 50)
+
+
+print(f"{'filter':>24} {'rows':>8} {'post-filter ms':>15} {'pre-filter ms':>14} {'speedup':>8}")
+for name, filters in FILTERS:
+    candidates = index.filter_rows(**filters)
+    keep = np.zeros(len(index), dtype=bool)
+    keep[candidates] = True
+
+    for query in queries[:5]:
+        expected = post_filter(query, args.rows, keep)
+        found, _ = index.search(query, args.rows, threshold=-1.0, **filters)
+        assert list(found) == list(expected), name
+
+    post = percentile_ms(lambda query: post_filter(query, args.rows, keep))
+    pre = percentile_ms(lambda query: index.search(query, args.rows, threshold=-1.0, **filters))
+    print(f"{name:>24} {len(candidates):>8} {post:>15.2f} {pre:>14.2f} {post / pre:>7.1f}x")
@@ -0,0 +1,110 @@
+""" Benchmark per video grouped search against over-fetching segments until k distinct videos
+are found, over a synthetic index whose adjacent segments overlap like the transcript buckets."""
+
+import argparse
+import time
+import numpy as np
+from video_search import VideoIndex
+from vector_ops import normalize_rows
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-n", "--segments", type=int, default=100000)
+parser.add_argument("-d", "--dimensions", type=int, default=1536)
+parser.add_argument("-q", "--queries", type=int, default=100)
+parser.add_argument("-k", "--rows", type=int, default=5)
+parser.add_argument("--topics", type=int, default=200, help="topics shared by several videos")
+args = parser.parse_args()
+
+rng = np.random.default_rng(42)
+SEGMENTS_PER_VIDEO = 20
+# how much of the previous segment carries over into the next one
+OVERLAP = 0.8
+
+videos = args.segments // SEGMENTS_PER_VIDEO
+topics = rng.standard_normal((args.topics, args.dimensions), dtype=np.float32)
+bases = 1.5 * topics[rng.integers(args.topics, size=videos)] + rng.standard_normal(
+    (videos, args.dimensions), dtype=np.float32
+)
+
+# each segment drifts a little from the previous one of its video
+drift = np.empty((videos, SEGMENTS_PER_VIDEO, args.dimensions), dtype=np.float32)
+drift[:, 0] = rng.standard_normal((videos, args.dimensions), dtype=np.float32)
+for i in range(1, SEGMENTS_PER_VIDEO):
+    fresh = rng.standard_normal((videos, args.dimensions), dtype=np.float32)
+    drift[:, i] = OVERLAP * drift[:, i - 1] + np.sqrt(1 - OVERLAP**2) * fresh
+vectors = normalize_rows((bases[:, np.newaxis] + 0.7 * drift).reshape(-1, args.dimensions))
+del drift
+
+columns = {
+    "videoId": [f"video{i // SEGMENTS_PER_VIDEO}" for i in range(len(vectors))],
+    "seconds": [(i % SEGMENTS_PER_VIDEO) * 180 for i in range(len(vectors))],
+}
+index = VideoIndex(vectors, columns)
+index.warm()
+print(f"Index: {len(index)} segments of {videos} videos x {args.dimensions}")
+
+# queries close to a random segment
+targets = rng.integers(len(index), size=args.queries)
+noise = rng.standard_normal((args.queries, args.dimensions), dtype=np.float32)
+queries = normalize_rows(vectors[targets] + 0.05 * noise)
+codes = index.video_groups()[0]
+
+
+def over_fetch(query, rows):
+    """search deeper until the results hold `rows` distinct videos, returns (indices, passes)"""
+    fetch = rows
+    passes = 0
+    while True:
+        passes += 1
+        indices, _ = index.search(query, fetch, threshold=-1.0)
+        _, first = np.unique(codes[indices], return_index=True)
+        if len(first) >= rows or fetch >= len(index):
+            return indices[np.sort(first)[:rows]], passes
+        fetch *= 2
+
+
+def redundancy(indices):
+    """mean similarity between the best segments of the videos returned"""
+    picked = index.vectors[indices]
+    similarities = picked @ picked.T
+    return similarities[np.triu_indices(len(indices), k=1)].mean()
+
+
+def measure(name, search):
+    """p50 latency, distinct videos, mean query similarity and redundancy of a search function"""
+    search(queries[0])
+    latencies, distinct, relevance, overlap, passes = [], [], [], [], []
+    for query in queries:
+        start_time = time.perf_counter()
+        indices, query_passes = search(query)
+        latencies.append(time.perf_counter() - start_time)
+        distinct.append(len(np.unique(codes[indices])))
+        relevance.append(float(np.mean(index.vectors[indices] @ query)))
+        overlap.append(redundancy(indices))
+        passes.append(query_passes)
+    p50 = np.percentile(np.array(latencies) * 1000, 50)
+    print(
+        f"{name:>22} {p50:>8.2f} {np.mean(passes):>7.2f} {np.mean(distinct):>9.2f} "
+        f"{np.mean(relevance):>10.3f} {np.mean(overlap):>11.3f}"
+    )
+
+
+print(f"{'':>22} {'p50 ms':>8} {'passes':>7} {'videos':>9} {'relevance':>10} {'redundancy':>11}")
+measure("top k segments", lambda query: (index.search(query, args.rows, threshold=-1.0)[0], 1))
+measure("over-fetch", lambda query: over_fetch(query, args.rows))
+for mmr_lambda in (1.0, 0.7, 0.5):
+    measure(
+        f"grouped, mmr {mmr_lambda}",
+        lambda query, mmr_lambda=mmr_lambda: (
+            index.search_videos(query, args.rows, threshold=-1.0, mmr_lambda=mmr_lambda)[0],
+            1,
+        ),
+    )
+
+# without the MMR re-rank the grouped search returns the videos over-fetching finds
+mismatches = sum(
+    list(index.search_videos(query, args.rows, threshold=-1.0, mmr_lambda=1.0)[0])
+    != list(over_fetch(query, args.rows)[0])
+    for query in queries
+)
+print(f"Grouped (mmr 1.0) results differing from over-fetch: {mismatches}")
@@ -0,0 +1,109 @@
+""" Benchmark fixed concurrency with random exponential backoff against the adaptive limiter
+on the stub server with a simulated TPM/RPM quota."""
+
+import argparse
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+import openai
+from tenacity import RetryError, retry, stop_after_attempt, wait_random_exponential
+from adaptive_limiter import AdaptiveLimiter
+from stub_openai_server import start_stub_server
+
+logging.basicConfig(level=logging.WARNING)
+
+MAX_TOKENS = 100
+PROMPT = " ".join(["word"] * 400)
+
+
+def run(name, request, threads, count, server):
+    """send count requests from threads workers, print the throughput, 429s and failures"""
+
+    def send(_):
+        try:
+            request()
+            return True
+        except RetryError:
+            return False
+
+    throttled = server.quota.throttled
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(threads) as executor:
+        completed = sum(executor.map(send, range(count)))
+    elapsed = time.perf_counter() - start_time
+
+    tokens = completed * (len(PROMPT.split()) + MAX_TOKENS)
+    print(
+        f"{name:>24} {completed / elapsed:>10.1f} {tokens / elapsed * 60:>12.0f} "
+        f"{server.quota.throttled - throttled:>8} {count - completed:>8} {elapsed:>8.1f}"
+    )
+
+
+def create():
+    """one summary sized chat completion"""
+    return openai.ChatCompletion.create(
+        engine="stub",
+        messages=[{"role": "user", "content": PROMPT}],
+        max_tokens=MAX_TOKENS,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--requests", type=int, default=200)
+    parser.add_argument("--tpm", type=int, default=240000)
+    parser.add_argument("--rpm", type=int, default=2400)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument(
+        "--window", type=float, default=6.0, help="quota window, 60 is real time"
+    )
+    parser.add_argument("--threads", type=int, default=32)
+    args = parser.parse_args()
+
+    # quotas are per minute, scale them to the shortened window
+    scale = args.window / 60
+    server, base_url = start_stub_server(
+        latency=args.latency,
+        tpm=int(args.tpm * scale),
+        rpm=int(args.rpm * scale),
+        window=args.window,
+    )
+
+    openai.api_type = "azure"
+    openai.api_key = "stub"
+    openai.api_base = base_url
+    openai.api_version = "2023-07-01-preview"
+
+    print(f"Stub quota {args.tpm} TPM, {args.rpm} RPM, {args.requests} requests")
+    print(
+        f"{'policy':>24} {'req/sec':>10} {'tokens/min':>12} {'429s':>8} "
+        f"{'failed':>8} {'seconds':>8}"
+    )
+
+    # the previous policy, every thread backs off on its own
+    @retry(
+        wait=wait_random_exponential(min=10 * scale, max=45 * scale),
+        stop=stop_after_attempt(20),
+    )
+    def fixed():
+        return create()
+
+    openai.requestssession = None
+    run(f"fixed {args.threads} threads", fixed, args.threads, args.requests, server)
+
+    for target_tpm in [None, args.tpm]:
+        # start each policy with an empty quota window
+        time.sleep(args.window)
+        limiter = AdaptiveLimiter(
+            target_tpm=int(target_tpm * scale) if target_tpm else None, window=args.window
+        )
+        limiter.install()
+
+        @retry(wait=limiter.wait, stop=stop_after_attempt(20))
+        def adaptive():
+            return limiter.call(create, tokens=len(PROMPT.split()) + MAX_TOKENS)
+
+        name = "adaptive" + (f" target {target_tpm}" if target_tpm else "")
+        run(name, adaptive, args.threads, args.requests, server)
+        stats = limiter.stats()
+        print(f"{'':>24} peak concurrency {stats['peak_limit']:.1f}, final {stats['limit']:.1f}")
@@ -0,0 +1,77 @@
+""" Benchmark memory, recall@10 and latency of the PQ index against the uncompressed index."""
+
+import argparse
+import time
+import numpy as np
+from embedding_index import load_index
+from pq_index import PqIndex
+from vector_ops import normalize_rows, top_k
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--index", help="compact index prefix, e.g. output/embedding_index_3m")
+parser.add_argument("-n", "--segments", type=int, default=50000, help="synthetic corpus size")
+parser.add_argument("-d", "--dimensions", type=int, default=1536)
+parser.add_argument("-q", "--queries", type=int, default=100)
+parser.add_argument("-k", "--rows", type=int, default=10)
+parser.add_argument("--m", default="64,96,192", help="bytes per segment to compare")
+parser.add_argument("--rerank", type=int, default=100)
+args = parser.parse_args()
+
+
+def synthetic_corpus(count, dimensions, queries, seed=42):
+    """clustered unit vectors, roughly shaped like topic clusters of embeddings"""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((max(1, count // 100), dimensions), dtype=np.float32)
+    labels = rng.integers(0, len(centers), count + queries)
+    noise = rng.standard_normal((count + queries, dimensions), dtype=np.float32)
+    vectors = normalize_rows(centers[labels] + 2.0 * noise)
+    return vectors[:count], vectors[count:]
+
+
+def timed(search, queries):
+    """run the search for every query, returns the results and the p50 latency in ms"""
+    results = []
+    latencies = []
+    for query in queries:
+        start_time = time.perf_counter()
+        results.append(search(query))
+        latencies.append(time.perf_counter() - start_time)
+    return results, np.percentile(latencies, 50) * 1000
+
+
+def recall(results, truth):
+    """fraction of the exact top k found"""
+    hits = sum(len(np.intersect1d(ids, expected)) for ids, expected in zip(results, truth))
+    return hits / (len(truth) * args.rows)
+
+
+if args.index:
+    vectors, _ = load_index(args.index)
+    vectors = normalize_rows(vectors)
+    rng = np.random.default_rng(42)
+    queries = vectors[rng.choice(len(vectors), min(args.queries, len(vectors)), replace=False)]
+else:
+    vectors, queries = synthetic_corpus(args.segments, args.dimensions, args.queries)
+
+truth, exact_ms = timed(lambda q: top_k(vectors @ q, args.rows), queries)
+
+print(f"{len(vectors)} vectors x {vectors.shape[1]} dimensions")
+print(f"{'index':>20} {'bytes/segment':>14} {'memory MB':>10} {'recall@' + str(args.rows):>10} {'p50 ms':>8}")
+print(
+    f"{'float32 exact':>20} {vectors.shape[1] * 4:>14} "
+    f"{vectors.nbytes / 2**20:>10.1f} {1.0:>10.3f} {exact_ms:>8.2f}"
+)
+
+for m in [int(x) for x in args.m.split(",")]:
+    start_time = time.perf_counter()
+    index = PqIndex.build(vectors, m=m)
+    build_time = time.perf_counter() - start_time
+
+    for rerank in [0, args.rerank]:
+        results, pq_ms = timed(lambda q: index.search(q, args.rows, rerank=rerank)[0], queries)
+        name = f"pq m={m}" + (f" rerank {rerank}" if rerank else "")
+        print(
+            f"{name:>20} {m:>14} {index.nbytes / 2**20:>10.1f} "
+            f"{recall(results, truth):>10.3f} {pq_ms:>8.2f}"
+        )
+    print(f"{'':>20} trained in {build_time:.1f}s")
@@ -0,0 +1,97 @@
+""" Benchmark the cached, coalescing query embedder against one embedding request per query,
+with concurrent search clients sending skewed queries and trivial variants of them to the stub server."""
+
+import argparse
+import logging
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import openai
+from adaptive_limiter import limiter
+from embedding_batch import get_text_embeddings
+from query_embeddings import QueryEmbedder
+from stub_openai_server import start_stub_server
+
+logging.basicConfig(level=logging.WARNING)
+logger = logging.getLogger(__name__)
+
+WORDS = "azure machine learning model notebook jupyter data onnx cloud speaker video".split()
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-n", "--queries", type=int, default=2000)
+parser.add_argument("--distinct", type=int, default=300, help="distinct queries")
+parser.add_argument("--clients", type=int, default=32, help="concurrent search clients")
+parser.add_argument("--latency", type=float, default=0.05, help="stub latency per request")
+parser.add_argument("--verbose", action="store_true")
+args = parser.parse_args()
+if args.verbose:
+    logger.setLevel(logging.DEBUG)
+
+
+def synthetic_queries(count, distinct):
+    """zipf distributed queries, some with different case, spacing or punctuation"""
+    rng = random.Random(42)
+    base = [" ".join(rng.choices(WORDS, k=rng.randint(2, 6))) for _ in range(distinct)]
+    weights = [1 / (rank + 1) for rank in range(distinct)]
+    queries = []
+    for query in rng.choices(base, weights, k=count):
+        variant = rng.random()
+        if variant < 0.2:
+            query = query.title()
+        elif variant < 0.3:
+            query = "  " + query.replace(" ", "  ") + "?"
+        queries.append(query)
+    return queries
+
+
+def run(queries, embed):
+    """send the queries from concurrent clients, returns the latencies in ms and the seconds"""
+
+    def timed(query):
+        start_time = time.perf_counter()
+        embed(query)
+        return (time.perf_counter() - start_time) * 1000
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.clients) as executor:
+        latencies = np.array(list(executor.map(timed, queries)))
+    return latencies, time.perf_counter() - start_time
+
+
+server, base_url = start_stub_server(latency=args.latency)
+
+openai.api_type = "azure"
+openai.api_key = "stub"
+openai.api_base = base_url
+openai.api_version = "2023-05-15"
+limiter.install()
+
+queries = synthetic_queries(args.queries, args.distinct)
+print(f"Stub server: {base_url}, latency {args.latency * 1000:.0f} ms per request")
+print(f"{len(queries)} queries, {args.distinct} distinct, {args.clients} concurrent clients")
+print(f"{'':>12} {'requests':>10} {'hit rate':>9} {'p50 ms':>8} {'p99 ms':>8} {'queries/sec':>12}")
+
+server.requests = 0
+latencies, elapsed = run(queries, lambda query: get_text_embeddings([query]))
+print(
+    f"{'per query':>12} {server.requests:>10} {'':>9} {np.percentile(latencies, 50):>8.1f} "
+    f"{np.percentile(latencies, 99):>8.1f} {len(queries) / elapsed:>12.1f}"
+)
+
+server.requests = 0
+embedder = QueryEmbedder(get_text_embeddings)
+latencies, elapsed = run(queries, embedder.embed)
+stats = embedder.stats()
+embedder.close()
+print(
+    f"{'cached':>12} {server.requests:>10} {stats['hit_rate']:>9.1%} "
+    f"{np.percentile(latencies, 50):>8.1f} {np.percentile(latencies, 99):>8.1f} "
+    f"{len(queries) / elapsed:>12.1f}"
+)
+print(
+    f"Cached embedder: {stats['hits']} hits, {stats['misses']} misses in {stats['batches']} batches, "
+    f"{stats['coalesced']} coalesced"
+)
+
+server.shutdown()
@@ -0,0 +1,44 @@
+""" Benchmark the vectorized top-k search over a synthetic segment index."""
+
+import argparse
+import time
+import numpy as np
+from video_search import VideoIndex
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-n", "--segments", type=int, default=100000)
+parser.add_argument("-d", "--dimensions", type=int, default=1536)
+parser.add_argument("-q", "--queries", type=int, default=200)
+parser.add_argument("-k", "--rows", type=int, default=5)
+parser.add_argument("--batch", type=int, default=32, help="queries per batched search")
+args = parser.parse_args()
+
+rng = np.random.default_rng(42)
+vectors = rng.standard_normal((args.segments, args.dimensions), dtype=np.float32)
+queries = rng.standard_normal((args.queries, args.dimensions), dtype=np.float32)
+columns = {"videoId": [f"video{i // 20}" for i in range(args.segments)]}
+
+start_time = time.perf_counter()
+index = VideoIndex(vectors, columns)
+print(f"Index build: {len(index)} x {args.dimensions}, {time.perf_counter() - start_time:.3f}s")
+
+# warm up
+index.search(queries[0], args.rows, threshold=-1.0)
+
+latencies = []
+for query in queries:
+    start_time = time.perf_counter()
+    index.search(query, args.rows, threshold=-1.0)
+    latencies.append(time.perf_counter() - start_time)
+
+latencies = np.array(latencies) * 1000
+print(
+    f"Single query: p50 {np.percentile(latencies, 50):.3f} ms, "
+    f"p99 {np.percentile(latencies, 99):.3f} ms"
+)
+
+start_time = time.perf_counter()
+for i in range(0, args.queries, args.batch):
+    index.search_batch(queries[i : i + args.batch], args.rows, threshold=-1.0)
+elapsed = time.perf_counter() - start_time
+print(f"Batched ({args.batch} per call): {args.queries / elapsed:.1f} queries/sec")
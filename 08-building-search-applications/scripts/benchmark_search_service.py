@@ -0,0 +1,230 @@
+""" Load test the search service: concurrent keep-alive clients send vector, hybrid, text and
+filtered searches while indexes are republished, with query embeddings from the stub server."""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from urllib.parse import urlencode
+import numpy as np
+from bm25_index import Bm25Builder
+from embedding_index import write_index
+from stub_openai_server import start_stub_server
+
+WORDS = "azure machine learning model notebook jupyter data onnx cloud speaker video".split()
+SEGMENTS_PER_VIDEO = 20
+# zipf distributed words, like the words of the titles and summaries
+VOCABULARY = np.array(WORDS + [f"term{i}" for i in range(5000)])
+WEIGHTS = 1 / np.arange(1, len(VOCABULARY) + 1)
+WEIGHTS /= WEIGHTS.sum()
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-n", "--segments", type=int, default=50000)
+parser.add_argument("-d", "--dimensions", type=int, default=1536)
+parser.add_argument("-r", "--requests", type=int, default=3000)
+parser.add_argument("--clients", type=int, default=32, help="concurrent keep-alive clients")
+parser.add_argument("--distinct", type=int, default=300, help="distinct queries")
+parser.add_argument("--reloads", type=int, default=2, help="indexes published during the test")
+parser.add_argument("--latency", type=float, default=0.05, help="stub latency per request")
+args = parser.parse_args()
+
+
+def publish(prefix, seed):
+    """write a synthetic index the way transcript_enrich_lite.py does, vectors first, then BM25"""
+    rng = np.random.default_rng(seed)
+    builder = Bm25Builder()
+
+    def words(count):
+        return " ".join(VOCABULARY[rng.choice(len(VOCABULARY), count, p=WEIGHTS)])
+
+    def segments():
+        for i in range(args.segments):
+            vector = rng.standard_normal(args.dimensions).astype(np.float32)
+            segment = {
+                "videoId": f"video{i // SEGMENTS_PER_VIDEO}",
+                "seconds": (i % SEGMENTS_PER_VIDEO) * 180,
+                "title": words(6),
+                "speaker": f"Speaker {i // SEGMENTS_PER_VIDEO % 50}",
+                "summary": words(60),
+                "ada_v2": (vector / np.linalg.norm(vector)).tolist(),
+            }
+            builder.add(segment)
+            yield segment
+
+    write_index(segments(), prefix)
+    builder.build().save(prefix + ".bm25.npz")
+
+
+def search_targets(count, distinct):
+    """zipf distributed queries, mostly vector searches, some hybrid, text and filtered"""
+    rng = random.Random(42)
+    np_rng = np.random.default_rng(42)
+    base = [
+        " ".join(VOCABULARY[np_rng.choice(len(VOCABULARY), rng.randint(2, 5), p=WEIGHTS)])
+        for _ in range(distinct)
+    ]
+    weights = [1 / (rank + 1) for rank in range(distinct)]
+    targets = []
+    for query in rng.choices(base, weights, k=count):
+        mode = rng.choices(["vector", "hybrid", "text"], [6, 2, 2])[0]
+        params = {"q": query, "mode": mode, "threshold": -1}
+        if rng.random() < 0.2:
+            params["speaker"] = f"Speaker {rng.randrange(50)}"
+        targets.append("/search?" + urlencode(params))
+    return targets
+
+
+def free_port():
+    """an unused local port"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def get_json(url):
+    """GET a json document"""
+    with urllib.request.urlopen(url, timeout=10) as response:
+        return json.load(response)
+
+
+async def read_response(reader):
+    """read one HTTP response, returns (status, json body)"""
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while (line := await reader.readline()) not in (b"\r\n", b""):
+        name, _, value = line.decode("latin-1").partition(":")
+        if name.lower() == "content-length":
+            length = int(value)
+    return status, json.loads(await reader.readexactly(length))
+
+
+async def client(port, targets, results, finished):
+    """send the searches one after another over one keep-alive connection until finished()"""
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    for target in itertools.cycle(targets):
+        if finished():
+            break
+        start_time = time.perf_counter()
+        writer.write(f"GET {target} HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n".encode("latin-1"))
+        await writer.drain()
+        status, body = await read_response(reader)
+        results["latencies"].append((time.perf_counter() - start_time) * 1000)
+        results["statuses"][status] = results["statuses"].get(status, 0) + 1
+        if status == 200:
+            generation = body["generation"]
+            results["generations"][generation] = results["generations"].get(generation, 0) + 1
+    writer.close()
+
+
+async def run_clients(port, targets, finished, background=None):
+    """run the clients, and the background coroutine meanwhile, until finished(results)"""
+    results = {"latencies": [], "statuses": {}, "generations": {}}
+    per_client = [targets[i :: args.clients] for i in range(args.clients)]
+    start_time = time.perf_counter()
+    task = asyncio.create_task(background) if background else None
+    await asyncio.gather(
+        *(client(port, chunk, results, lambda: finished(results)) for chunk in per_client)
+    )
+    results["seconds"] = time.perf_counter() - start_time
+    if task:
+        await task
+    return results
+
+
+async def publisher(prefix):
+    """publish the new indexes one after another"""
+    loop = asyncio.get_running_loop()
+    for generation in range(args.reloads):
+        await loop.run_in_executor(None, publish, prefix, generation + 1)
+        # let the service swap it in before the next one replaces it
+        await asyncio.sleep(3)
+
+
+async def load_test(port, prefix, targets):
+    """
+    send the targets against the first index, then keep sending them while the new indexes
+    are published until the last one published answers searches
+    """
+    steady = await run_clients(
+        port, targets, lambda results: len(results["latencies"]) >= len(targets)
+    )
+    reloading = await run_clients(
+        port,
+        targets,
+        lambda results: max(results["generations"], default=0) > args.reloads,
+        publisher(prefix),
+    )
+    return steady, reloading
+
+
+def report(name, results):
+    """print the QPS, latency percentiles and statuses of a phase"""
+    latencies = np.array(results["latencies"])
+    print(
+        f"{name:>10}: {len(latencies):>6} searches, QPS {len(latencies) / results['seconds']:.1f}, "
+        f"p50 {np.percentile(latencies, 50):.1f} ms, p95 {np.percentile(latencies, 95):.1f} ms, "
+        f"p99 {np.percentile(latencies, 99):.1f} ms, max {latencies.max():.1f} ms, "
+        f"statuses {dict(sorted(results['statuses'].items()))}, "
+        f"generations {dict(sorted(results['generations'].items()))}"
+    )
+
+
+folder = tempfile.mkdtemp()
+prefix = os.path.join(folder, "embedding_index_3m")
+start_time = time.perf_counter()
+publish(prefix, 0)
+elapsed = time.perf_counter() - start_time
+print(f"Index: {args.segments} x {args.dimensions} published in {elapsed:.1f}s")
+
+stub, base_url = start_stub_server(latency=args.latency)
+port = free_port()
+service = subprocess.Popen(
+    [sys.executable, "-u", "search_service.py", "-i", prefix, "-p", str(port)]
+    + ["--poll", "0.5", "--settle", "1"],
+    cwd=os.path.dirname(os.path.abspath(__file__)),
+    env={**os.environ, "AZURE_OPENAI_API_KEY": "stub", "AZURE_OPENAI_ENDPOINT": base_url},
+)
+
+try:
+    health_url = f"http://127.0.0.1:{port}/health"
+    for _ in range(600):
+        try:
+            if get_json(health_url)["status"] == "ok":
+                break
+        except OSError:
+            pass
+        time.sleep(0.1)
+    before = get_json(health_url)
+    print(f"Stub server: {base_url}, latency {args.latency * 1000:.0f} ms per embedding request")
+    print(f"Service memory before: {before['memory_kb']}")
+
+    targets = search_targets(args.requests, args.distinct)
+    steady, reloading = asyncio.run(load_test(port, prefix, targets))
+    after = get_json(health_url)
+
+    print(
+        f"{args.clients} concurrent clients, {args.reloads} indexes published "
+        f"during the reloading phase"
+    )
+    report("steady", steady)
+    report("reloading", reloading)
+    print(
+        f"Service: generation {after['generation']}, {after['reloads']} loads, "
+        f"{after['reload_failures']} failed, {after['vector_batches']} vector batches, "
+        f"{stub.requests} embedding requests, hit rate {after['embeddings']['hit_rate']:.1%}"
+    )
+    print(f"Service memory after: {after['memory_kb']}")
+finally:
+    service.terminate()
+    service.wait()
+    stub.shutdown()
+    shutil.rmtree(folder)
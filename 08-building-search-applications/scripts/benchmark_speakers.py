@@ -0,0 +1,69 @@
+""" Benchmark one speaker request per video against batched speaker requests on the local stub server."""
+
+import argparse
+import contextlib
+import io
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+import openai
+from benchmark_bucket import write_corpus
+from stub_openai_server import start_stub_server
+
+# the speaker script reads its settings when it is imported
+os.environ.setdefault("AZURE_OPENAI_API_KEY", "stub")
+os.environ.setdefault("AZURE_OPENAI_ENDPOINT", "http://127.0.0.1")
+import transcript_enrich_speaker  # pylint: disable=wrong-import-position
+
+
+def run(name, fn, items, threads):
+    """run fn over items on threads, print the requests and the wall time"""
+    requests = transcript_enrich_speaker.request_counter.value
+    start_time = time.perf_counter()
+    # the script prints a line per video
+    with contextlib.redirect_stdout(io.StringIO()), ThreadPoolExecutor(threads) as executor:
+        results = list(executor.map(fn, items))
+    elapsed = time.perf_counter() - start_time
+    requests = transcript_enrich_speaker.request_counter.value - requests
+    print(f"{name:>20} {requests:>10} {elapsed:>8.1f}")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--videos", type=int, default=400)
+    parser.add_argument("--lines", type=int, default=40, help="caption lines per video")
+    parser.add_argument("--latency", type=float, default=0.5, help="stub latency per request")
+    parser.add_argument("--batch-drop", type=float, default=0.05, help="videos left out of a batch")
+    parser.add_argument(
+        "--batch-tokens", type=int, default=transcript_enrich_speaker.BATCH_PROMPT_TOKENS
+    )
+    parser.add_argument(
+        "--threads", type=int, default=transcript_enrich_speaker.PROCESSING_THREADS
+    )
+    args = parser.parse_args()
+
+    server, base_url = start_stub_server(latency=args.latency, batch_drop=args.batch_drop)
+    openai.api_base = base_url
+    transcript_enrich_speaker.limiter.install()
+
+    with tempfile.TemporaryDirectory() as folder:
+        files = write_corpus(folder, args.videos, args.lines)
+        print(
+            f"{args.videos} videos, stub latency {args.latency}s, "
+            f"{args.batch_drop:.0%} dropped from batches"
+        )
+        print(f"{'mode':>20} {'requests':>10} {'seconds':>8}")
+
+        run("one per video", transcript_enrich_speaker.update_speaker, files, args.threads)
+
+        batches = list(
+            transcript_enrich_speaker.speaker_batches(files, max_tokens=args.batch_tokens)
+        )
+        retried = run("batched", transcript_enrich_speaker.update_speakers_batch, batches, args.threads)
+        print(
+            f"{len(batches)} batches of up to {transcript_enrich_speaker.BATCH_MAX_VIDEOS} videos, "
+            f"{transcript_enrich_speaker.truncated_batches.value} answers cut off, "
+            f"{sum(retried)} videos retried alone"
+        )
@@ -0,0 +1,54 @@
+""" Microbenchmark one at a time encoding against the shared batched, memoized token counter."""
+
+import argparse
+import random
+import time
+from token_counter import TokenCounter, get_encoding
+
+WORDS = "azure machine learning model notebook data neural network onnx cloud speaker video".split()
+
+
+def timed(fn):
+    """run fn, returns the result and the elapsed seconds"""
+    start_time = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start_time
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--texts", type=int, default=20000, help="caption lines")
+    parser.add_argument("--words", type=int, default=12, help="words per caption line")
+    parser.add_argument("--long", type=int, default=200, help="long texts for the fits check")
+    parser.add_argument("--limit", type=int, default=8191, help="fits limit in tokens")
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    texts = [" ".join(rng.choices(WORDS, k=args.words)) for _ in range(args.texts)]
+    long_texts = [" ".join(rng.choices(WORDS, k=args.limit * 4)) for _ in range(args.long)]
+    encoding = get_encoding()
+
+    print(f"{'method':>28} {'texts/sec':>12}")
+
+    def report(name, count, elapsed):
+        print(f"{name:>28} {count / elapsed:>12.0f}")
+
+    expected, elapsed = timed(lambda: [len(encoding.encode(text)) for text in texts])
+    report("encode one at a time", len(texts), elapsed)
+
+    counter = TokenCounter(encoding)
+    counts, elapsed = timed(lambda: counter.count_batch(texts))
+    report("count_batch, cold", len(texts), elapsed)
+
+    counts, elapsed = timed(lambda: counter.count_batch(texts))
+    report("count_batch, memoized", len(texts), elapsed)
+
+    if counts != expected:
+        raise RuntimeError("count_batch and encode disagree")
+
+    _, elapsed = timed(lambda: [len(encoding.encode(text)) <= args.limit for text in long_texts])
+    report("long texts, full encode", len(long_texts), elapsed)
+
+    counter = TokenCounter(encoding)
+    _, elapsed = timed(lambda: [counter.fits(text, args.limit) for text in long_texts])
+    report(f"long texts, fits({args.limit})", len(long_texts), elapsed)
@@ -0,0 +1,308 @@
+""" In-process BM25 inverted index over the text, summary, title and speaker of the segments.
+
+The fields are combined BM25F style: a term counts FIELD_WEIGHTS[field] times
+per occurrence and the document length is the weighted token count. The doc
+ids of each posting list are split into blocks of BLOCK_SIZE, stored as the
+first id followed by the gaps, varint encoded, next to the weighted term
+frequencies. A block is found from the last doc id of each block, so a list
+can be read only at the blocks that hold given documents.
+
+Queries are answered with MaxScore: the terms are taken in decreasing order of
+their best possible score and fully scored until the best scores of the
+remaining terms together cannot lift an unseen document into the top k. The
+remaining terms are then only read at the blocks of the surviving candidates.
+The result is the exact BM25 top k.
+"""
+
+import re
+import unicodedata
+from array import array
+from collections import Counter
+import numpy as np
+from vector_ops import top_k
+
+K1 = 1.2
+B = 0.75
+BLOCK_SIZE = 128
+FIELD_WEIGHTS = {"title": 3, "speaker": 3, "summary": 2, "text": 1}
+TOKEN = re.compile(r"[^\W_]+")
+STOPWORDS = set(
+    "a an and are as at be but by can do for from has have how i in is it its of on or "
+    "so that the this to was we what when where which who will with you your".split()
+)
+
+
+def tokenize(text: str) -> list[str]:
+    """lower case word tokens of a text without the stopwords"""
+    text = unicodedata.normalize("NFKC", text or "").casefold()
+    return [token for token in TOKEN.findall(text) if token not in STOPWORDS]
+
+
+def encode_varints(values):
+    """LEB128 encode an array of non negative integers, returns the bytes and the length of each value"""
+    values = np.asarray(values, dtype=np.uint64)
+    lengths = np.ones(len(values), dtype=np.int64)
+    for shift in (7, 14, 21, 28, 35):
+        lengths += values >= (1 << shift)
+
+    positions = np.cumsum(lengths) - lengths
+    data = np.empty(int(lengths.sum()), dtype=np.uint8)
+    for byte in range(int(lengths.max()) if len(values) else 0):
+        mask = lengths > byte
+        chunk = (values[mask] >> np.uint64(7 * byte)) & np.uint64(0x7F)
+        more = (lengths[mask] > byte + 1).astype(np.uint64) << np.uint64(7)
+        data[positions[mask] + byte] = chunk | more
+    return data, lengths
+
+
+def decode_varints(data):
+    """decode a LEB128 byte array into an array of integers"""
+    data = np.asarray(data, dtype=np.uint8)
+    if not len(data):
+        return np.empty(0, dtype=np.uint64)
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    shifts = np.arange(len(data)) - np.repeat(starts, ends - starts + 1)
+    parts = (data & np.uint8(0x7F)).astype(np.uint64) << (7 * shifts).astype(np.uint64)
+    return np.add.reduceat(parts, starts)
+
+
+class Bm25Builder:
+    """accumulate the postings of the segments added one at a time"""
+
+    def __init__(self, fields=FIELD_WEIGHTS):
+        """initialize the builder, fields maps the indexed fields to their weight"""
+        self.fields = fields
+        self.vocabulary = {}
+        # one entry per posting, in the order the segments are added
+        self.posting_terms = array("q")
+        self.posting_docs = array("q")
+        self.posting_tfs = array("q")
+        self.doc_lengths = array("q")
+
+    def add(self, segment):
+        """index the next segment, its doc id is the number of segments added before it"""
+        doc = len(self.doc_lengths)
+        counts = Counter()
+        for field, weight in self.fields.items():
+            for token in tokenize(segment.get(field)):
+                counts[token] += weight
+        for term, tf in counts.items():
+            self.posting_terms.append(self.vocabulary.setdefault(term, len(self.vocabulary)))
+            self.posting_docs.append(doc)
+            self.posting_tfs.append(tf)
+        self.doc_lengths.append(sum(counts.values()))
+
+    def build(self, k1=K1, b=B):
+        """the index of the segments added"""
+        terms = sorted(self.vocabulary)
+        ranks = np.empty(len(terms), dtype=np.int64)
+        ranks[[self.vocabulary[term] for term in terms]] = np.arange(len(terms))
+
+        # group the postings by term, the stable sort keeps the doc ids of a term increasing
+        posting_terms = ranks[np.frombuffer(self.posting_terms, dtype=np.int64)]
+        order = np.argsort(posting_terms, kind="stable")
+        return Bm25Index.from_postings(
+            terms,
+            np.bincount(posting_terms, minlength=len(terms)),
+            np.frombuffer(self.posting_docs, dtype=np.int64)[order],
+            np.frombuffer(self.posting_tfs, dtype=np.int64)[order],
+            np.frombuffer(self.doc_lengths, dtype=np.int64),
+            k1,
+            b,
+        )
+
+
+class Bm25Index:
+    """compressed BM25 inverted index with MaxScore top-k"""
+
+    def __init__(self, terms, arrays, k1=K1, b=B):
+        """initialize the index from its terms and the arrays written by save"""
+        self.terms = {term: i for i, term in enumerate(terms)}
+        self.k1 = k1
+        self.b = b
+        # per term: first block, idf and best possible score, with an end sentinel for the blocks
+        self.term_blocks = arrays["term_blocks"]
+        self.idf = arrays["idf"]
+        self.upper_bounds = arrays["upper_bounds"]
+        # per block: last doc id, first byte and first posting, with end sentinels
+        self.block_last = arrays["block_last"]
+        self.block_bytes = arrays["block_bytes"]
+        self.block_postings = arrays["block_postings"]
+        self.doc_data = arrays["doc_data"]
+        self.tfs = arrays["tfs"]
+        self.doc_lengths = arrays["doc_lengths"]
+        average = self.doc_lengths.mean() if len(self.doc_lengths) else 1.0
+        # the per document part of the BM25 denominator
+        self.norms = (k1 * (1 - b + b * self.doc_lengths / max(average, 1e-9))).astype(np.float32)
+
+    @classmethod
+    def build(cls, segments, fields=FIELD_WEIGHTS, k1=K1, b=B):
+        """index the segments, doc ids are their positions"""
+        builder = Bm25Builder(fields)
+        for segment in segments:
+            builder.add(segment)
+        return builder.build(k1, b)
+
+    @classmethod
+    def from_postings(cls, terms, sizes, docs, tfs, doc_lengths, k1=K1, b=B):
+        """compress the concatenated posting lists of the sorted terms"""
+        count = len(doc_lengths)
+        term_postings = np.concatenate(([0], np.cumsum(sizes)))
+        blocks_per_term = -(-sizes // BLOCK_SIZE)
+        term_blocks = np.concatenate(([0], np.cumsum(blocks_per_term)))
+
+        # the first posting of every block, the gaps are taken from the previous posting
+        block_term = np.repeat(np.arange(len(terms)), blocks_per_term)
+        block_index = np.arange(len(block_term)) - term_blocks[block_term]
+        block_postings = term_postings[block_term] + block_index * BLOCK_SIZE
+        gaps = np.diff(docs, prepend=0)
+        gaps[block_postings] = docs[block_postings]
+        doc_data, lengths = encode_varints(gaps)
+        byte_offsets = np.concatenate(([0], np.cumsum(lengths)))
+        block_ends = np.append(block_postings[1:], len(docs))
+
+        doc_lengths = np.asarray(doc_lengths, dtype=np.float32)
+        df = sizes.astype(np.float64)
+        idf = np.log(1 + (count - df + 0.5) / (df + 0.5)).astype(np.float32)
+        arrays = {
+            "term_blocks": term_blocks.astype(np.int64),
+            "idf": idf,
+            "upper_bounds": np.zeros(len(terms), dtype=np.float32),
+            "block_last": docs[block_ends - 1].astype(np.uint32),
+            "block_bytes": byte_offsets[np.append(block_postings, len(docs))].astype(np.int64),
+            "block_postings": np.append(block_postings, len(docs)).astype(np.int64),
+            "doc_data": doc_data,
+            "tfs": np.minimum(tfs, np.iinfo(np.uint16).max).astype(np.uint16),
+            "doc_lengths": doc_lengths,
+        }
+        index = cls(terms, arrays, k1, b)
+
+        # the best score of each term over its documents bounds its contribution
+        if len(docs):
+            scores = index.term_scores(np.repeat(np.arange(len(terms)), sizes), docs, index.tfs)
+            index.upper_bounds = np.maximum.reduceat(scores, term_postings[:-1]).astype(np.float32)
+        return index
+
+    @classmethod
+    def load(cls, path):
+        """load an index written by save"""
+        with np.load(path) as data:
+            arrays = {key: data[key] for key in data.files}
+        params = arrays.pop("params")
+        return cls(arrays.pop("terms").tolist(), arrays, float(params[0]), float(params[1]))
+
+    def save(self, path):
+        """save the index to a .npz file"""
+        terms = sorted(self.terms, key=self.terms.get)
+        np.savez(
+            path,
+            terms=np.array(terms, dtype=str),
+            params=np.array([self.k1, self.b]),
+            term_blocks=self.term_blocks,
+            idf=self.idf,
+            upper_bounds=self.upper_bounds,
+            block_last=self.block_last,
+            block_bytes=self.block_bytes,
+            block_postings=self.block_postings,
+            doc_data=self.doc_data,
+            tfs=self.tfs,
+            doc_lengths=self.doc_lengths,
+        )
+
+    def __len__(self):
+        return len(self.doc_lengths)
+
+    @property
+    def nbytes(self):
+        """size of the posting lists, doc ids and term frequencies"""
+        return self.doc_data.nbytes + self.tfs.nbytes
+
+    def term_scores(self, term, docs, tfs):
+        """BM25 contribution of a term, or an array of terms, to documents with these frequencies"""
+        tfs = tfs.astype(np.float32)
+        return self.idf[term] * tfs * (self.k1 + 1) / (tfs + self.norms[docs])
+
+    def read_blocks(self, blocks):
+        """the doc ids and term frequencies of the postings of sorted blocks"""
+        starts = self.block_bytes[blocks]
+        lengths = self.block_bytes[blocks + 1] - starts
+        positions = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+        values = decode_varints(self.doc_data[positions + np.arange(lengths.sum())]).astype(np.int64)
+
+        # undo the gaps, the first value of a block is an absolute doc id
+        counts = self.block_postings[blocks + 1] - self.block_postings[blocks]
+        firsts = np.cumsum(counts) - counts
+        sums = np.cumsum(values)
+        docs = sums - np.repeat(sums[firsts] - values[firsts], counts)
+
+        postings = np.repeat(self.block_postings[blocks] - firsts, counts) + np.arange(counts.sum())
+        return docs, self.tfs[postings]
+
+    def postings(self, term):
+        """the doc ids and term frequencies of a term"""
+        return self.read_blocks(np.arange(self.term_blocks[term], self.term_blocks[term + 1]))
+
+    def query_terms(self, query: str):
+        """the ids of the distinct query terms in the index"""
+        return sorted({self.terms[token] for token in tokenize(query) if token in self.terms})
+
+    def search_exhaustive(self, query: str, rows: int = 10, allowed=None):
+        """score every posting of every query term, the reference for search"""
+        scores = np.zeros(len(self), dtype=np.float32)
+        for term in self.query_terms(query):
+            docs, tfs = self.postings(term)
+            scores[docs] += self.term_scores(term, docs, tfs)
+        if allowed is not None:
+            scores[~allowed] = 0
+        indices = top_k(scores, rows)
+        indices = indices[scores[indices] > 0]
+        return indices, scores[indices]
+
+    def search(self, query: str, rows: int = 10, allowed=None):
+        """
+        return the (indices, scores) of the BM25 top rows for a text query,
+        allowed is an optional boolean mask of the documents that can be returned
+        """
+        terms = sorted(self.query_terms(query), key=lambda term: -self.upper_bounds[term])
+        # the best score a document can still get from the terms from i on
+        remaining = np.append(np.cumsum(self.upper_bounds[terms][::-1])[::-1], 0.0)
+
+        candidates = np.empty(0, dtype=np.int64)
+        scores = np.empty(0, dtype=np.float32)
+        threshold = 0.0
+        for i, term in enumerate(terms):
+            if len(candidates) < rows or remaining[i] >= threshold:
+                # essential term, an unseen document can still reach the top rows
+                docs, tfs = self.postings(term)
+                if allowed is not None:
+                    keep = allowed[docs]
+                    docs, tfs = docs[keep], tfs[keep]
+                candidates, inverse = np.unique(
+                    np.concatenate((candidates, docs)), return_inverse=True
+                )
+                scores = np.bincount(
+                    inverse,
+                    weights=np.concatenate((scores, self.term_scores(term, docs, tfs))),
+                    minlength=len(candidates),
+                ).astype(np.float32)
+            else:
+                # drop the candidates that cannot reach the threshold, read the rest in place
+                keep = scores + remaining[i] >= threshold
+                candidates, scores = candidates[keep], scores[keep]
+                first, last = self.term_blocks[term], self.term_blocks[term + 1]
+                blocks = first + np.searchsorted(self.block_last[first:last], candidates)
+                blocks = np.unique(blocks[blocks < last])
+                docs, tfs = self.read_blocks(blocks)
+                positions = np.searchsorted(docs, candidates).clip(max=max(len(docs) - 1, 0))
+                found = docs[positions] == candidates if len(docs) else np.zeros(0, dtype=bool)
+                scores[found] += self.term_scores(
+                    term, candidates[found], tfs[positions[found]]
+                )
+
+            if len(candidates) >= rows:
+                # the rows-th best partial score is a lower bound of the final rows-th best score
+                threshold = np.partition(scores, len(scores) - rows)[len(scores) - rows]
+
+        indices = top_k(scores, rows)
+        return candidates[indices], scores[indices]
@@ -0,0 +1,250 @@
+""" Compact columnar store for the caption lines of the downloaded transcripts.
+
+A <videoId>.cap file holds the caption lines of one video as columns:
+
+    b"CAP1" | uint32 count | float64 start[count] | float64 duration[count]
+    | uint32 offsets[count + 1] | utf-8 text
+
+The text of line i is text[offsets[i]:offsets[i + 1]]. A time range is found by
+binary search on the start column and only its span of the text is read, so
+the first minutes of a video do not need the whole file. The readers use the
+.cap file when it exists and is not older than the pretty printed
+<videoId>.json.vtt, and fall back to the .json.vtt otherwise.
+
+Run this script to convert a transcript folder and report the disk and parse
+time it saves, --remove-json deletes the converted .json.vtt files.
+"""
+
+import argparse
+import glob
+import json
+import os
+import struct
+import time
+import numpy as np
+from atomic_file import atomic_open
+
+MAGIC = b"CAP1"
+HEADER = struct.Struct("<4sI")
+VTT_SUFFIX = ".json.vtt"
+CAP_SUFFIX = ".cap"
+# the bounded .json.vtt reader parses the file in chunks of this many characters
+STREAM_CHUNK_CHARS = 16384
+JSON_SEPARATORS = " \t\r\n,["
+
+
+def caption_file(vtt):
+    """the .cap file of a .json.vtt file"""
+    return vtt[: -len(VTT_SUFFIX)] + CAP_SUFFIX
+
+
+def transcript_file(vtt):
+    """
+    the caption file of a video, its .cap file unless the .json.vtt file is newer,
+    or None when there is none
+    """
+    filename = caption_file(vtt)
+    if not os.path.exists(filename):
+        return vtt if os.path.exists(vtt) else None
+    if os.path.exists(vtt) and os.path.getmtime(vtt) > os.path.getmtime(filename):
+        # downloaded again after the conversion
+        return vtt
+    return filename
+
+
+def write_captions(filename, captions):
+    """write a list of caption lines to a .cap file, atomically"""
+    texts = [caption["text"].encode("utf-8") for caption in captions]
+    offsets = np.zeros(len(texts) + 1, dtype="<u4")
+    np.cumsum([len(text) for text in texts], out=offsets[1:])
+
+    with atomic_open(filename, "wb") as file:
+        file.write(HEADER.pack(MAGIC, len(texts)))
+        file.write(np.array([c["start"] for c in captions], dtype="<f8").tobytes())
+        file.write(np.array([c.get("duration", 0.0) for c in captions], dtype="<f8").tobytes())
+        file.write(offsets.tobytes())
+        file.write(b"".join(texts))
+
+
+def read_captions(filename, start=None, end=None, first_seconds=None):
+    """
+    read the caption lines of a .cap file as {"text", "start", "duration"} dicts.
+    start and end limit the lines to start <= line start < end, first_seconds to
+    the lines starting within that many seconds of the first line.
+    """
+    with open(filename, "rb") as file:
+        magic, count = HEADER.unpack(file.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError(f"{filename} is not a caption store file")
+        columns = file.read(count * 20 + 4)
+        starts = np.frombuffer(columns, dtype="<f8", count=count)
+        durations = np.frombuffer(columns, dtype="<f8", count=count, offset=count * 8)
+        offsets = np.frombuffer(columns, dtype="<u4", count=count + 1, offset=count * 16)
+
+        if first_seconds is not None and count:
+            end = starts[0] + first_seconds
+        mask = None
+        if np.all(starts[1:] >= starts[:-1]):
+            # sorted lines, the range is a contiguous span of the text
+            first = 0 if start is None else int(np.searchsorted(starts, start, "left"))
+            last = count if end is None else int(np.searchsorted(starts, end, "left"))
+        else:
+            first, last = 0, count
+            mask = np.ones(count, dtype=bool)
+            if start is not None:
+                mask &= starts >= start
+            if end is not None:
+                mask &= starts < end
+
+        file.seek(HEADER.size + len(columns) + int(offsets[first]))
+        text = file.read(int(offsets[last] - offsets[first])) if last > first else b""
+
+    bounds = (offsets[first : last + 1] - offsets[first]).tolist()
+    lines = [
+        {"text": text[bounds[i] : bounds[i + 1]].decode("utf-8"), "start": s, "duration": d}
+        for i, (s, d) in enumerate(
+            zip(starts[first:last].tolist(), durations[first:last].tolist())
+        )
+    ]
+    if mask is not None:
+        lines = [line for line, keep in zip(lines, mask[first:last]) if keep]
+    return lines
+
+
+def iter_json_captions(vtt):
+    """yield the caption lines of a .json.vtt file one at a time, parsing the file incrementally"""
+    decoder = json.JSONDecoder()
+    with open(vtt, "r", encoding="utf-8") as json_file:
+        buffer = ""
+        position = 0
+        while True:
+            # skip the opening bracket, the commas and the indentation between the lines
+            while position < len(buffer) and buffer[position] in JSON_SEPARATORS:
+                position += 1
+            if buffer.startswith("]", position):
+                return
+            try:
+                caption, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # the next line is not complete yet
+                chunk = json_file.read(STREAM_CHUNK_CHARS)
+                if not chunk:
+                    if buffer[position:].strip():
+                        raise
+                    return
+                buffer = buffer[position:] + chunk
+                position = 0
+                continue
+            yield caption
+
+
+def read_json_captions(vtt, start=None, end=None, first_seconds=None):
+    """
+    read the caption lines of a .json.vtt file, limited like read_captions.
+    With an end the file is only parsed up to the first line past it.
+    """
+    if end is None and first_seconds is None:
+        with open(vtt, "r", encoding="utf-8") as json_file:
+            captions = json.load(json_file)
+        return [caption for caption in captions if start is None or caption["start"] >= start]
+
+    captions = []
+    for caption in iter_json_captions(vtt):
+        if end is None:
+            end = caption["start"] + first_seconds
+        # the lines are in time order
+        if caption["start"] >= end:
+            break
+        if start is None or caption["start"] >= start:
+            captions.append(caption)
+    return captions
+
+
+def load_captions(vtt, start=None, end=None, first_seconds=None):
+    """
+    the caption lines of a video from its .cap file, or from its .json.vtt file,
+    limited like read_captions
+    """
+    filename = transcript_file(vtt)
+    if filename is None:
+        raise FileNotFoundError(vtt)
+    if filename != vtt:
+        return read_captions(filename, start, end, first_seconds)
+    return read_json_captions(vtt, start, end, first_seconds)
+
+
+def compact_folder(folder, remove_json=False):
+    """convert the .json.vtt files of a folder that have no up to date .cap file, returns them"""
+    converted = []
+    for vtt in sorted(glob.glob(os.path.join(folder, "*" + VTT_SUFFIX))):
+        filename = caption_file(vtt)
+        if transcript_file(vtt) == vtt:
+            with open(vtt, "r", encoding="utf-8") as json_file:
+                write_captions(filename, json.load(json_file))
+            converted.append(vtt)
+        if remove_json:
+            os.remove(vtt)
+    return converted
+
+
+def timed(fn, files):
+    """seconds to run fn on every file"""
+    start_time = time.perf_counter()
+    for filename in files:
+        fn(filename)
+    return time.perf_counter() - start_time
+
+
+def report(folder, first_seconds):
+    """print the disk use and parse times of the .json.vtt and .cap files of a folder"""
+    vtts = sorted(glob.glob(os.path.join(folder, "*" + VTT_SUFFIX)))
+    vtts = [vtt for vtt in vtts if os.path.exists(caption_file(vtt))]
+    caps = [caption_file(vtt) for vtt in vtts]
+    if not vtts:
+        print("No converted transcripts to compare")
+        return
+
+    def parse_json(vtt):
+        with open(vtt, "r", encoding="utf-8") as json_file:
+            return json.load(json_file)
+
+    json_bytes = sum(os.path.getsize(vtt) for vtt in vtts)
+    cap_bytes = sum(os.path.getsize(cap) for cap in caps)
+    print(f"{len(vtts)} transcripts")
+    print(f"{'':>24} {'.json.vtt':>12} {'.cap':>12} {'saved':>8}")
+    print(
+        f"{'disk MB':>24} {json_bytes / 2**20:>12.1f} {cap_bytes / 2**20:>12.1f} "
+        f"{1 - cap_bytes / json_bytes:>8.0%}"
+    )
+    json_seconds = timed(parse_json, vtts)
+    cap_seconds = timed(read_captions, caps)
+    print(
+        f"{'parse all, seconds':>24} {json_seconds:>12.3f} {cap_seconds:>12.3f} "
+        f"{1 - cap_seconds / json_seconds:>8.0%}"
+    )
+    json_seconds = timed(lambda vtt: read_json_captions(vtt, first_seconds=first_seconds), vtts)
+    cap_seconds = timed(lambda cap: read_captions(cap, first_seconds=first_seconds), caps)
+    print(
+        f"{f'first {first_seconds:.0f}s, seconds':>24} {json_seconds:>12.3f} "
+        f"{cap_seconds:>12.3f} {1 - cap_seconds / json_seconds:>8.0%}"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-f", "--folder")
+    parser.add_argument("--remove-json", action="store_true", help="delete the .json.vtt files")
+    parser.add_argument("--first-seconds", type=float, default=180, help="range for the report")
+    args = parser.parse_args()
+
+    if not args.folder:
+        print("Transcript folder not provided")
+        exit(1)
+
+    start_time = time.perf_counter()
+    converted = compact_folder(args.folder)
+    print(f"Converted {len(converted)} transcripts in {time.perf_counter() - start_time:.1f}s")
+
+    report(args.folder, args.first_seconds)
+    if args.remove_json:
+        compact_folder(args.folder, remove_json=True)
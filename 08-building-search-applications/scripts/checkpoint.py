@@ -0,0 +1,110 @@
+""" Write-ahead checkpoint journal for the enrichment stages.
+
+Every completed segment is appended to <output>.journal as one json line and
+the journal is fsynced in batches. A restarted run with --resume skips the
+segments already in the journal, and `merge` turns the journal into the sorted
+output once every input segment is accounted for.
+"""
+
+import json
+import logging
+import os
+import threading
+from segment_stream import read_segments, sort_runs
+
+FSYNC_EVERY = 32
+
+logger = logging.getLogger(__name__)
+
+
+def segment_id(segment):
+    """stable id of a segment, the video and its start time"""
+    return f"{segment['videoId']}:{segment.get('seconds', 0)}"
+
+
+class Journal:
+    """append only journal of completed segments"""
+
+    def __init__(self, filename, resume=False, fsync_every=FSYNC_EVERY):
+        """open the journal, with resume the completed segment ids are recovered"""
+        self.filename = filename
+        self.fsync_every = fsync_every
+        self.done = self.recover() if resume and os.path.exists(filename) else set()
+        self.file = open(filename, "a" if resume else "w", encoding="utf-8")
+        self.unsynced = 0
+        self.lock = threading.Lock()
+
+    def recover(self):
+        """return the ids in the journal, a torn last line from a crash is truncated"""
+        done = set()
+        offset = 0
+        with open(self.filename, "rb+") as f:
+            for line in f:
+                try:
+                    done.add(segment_id(json.loads(line)))
+                except (ValueError, KeyError):
+                    logger.warning("Truncating torn journal entry at byte %d", offset)
+                    f.truncate(offset)
+                    break
+                offset += len(line)
+
+        logger.info("Recovered %d segments from %s", len(done), self.filename)
+        return done
+
+    def is_done(self, segment):
+        """True if the segment completed in a previous run"""
+        return segment_id(segment) in self.done
+
+    def pending(self, segments, expected_ids):
+        """yield the segments not completed yet, every segment id is added to expected_ids"""
+        for segment in segments:
+            expected_ids.add(segment_id(segment))
+            if not self.is_done(segment):
+                yield segment
+
+    def append(self, segments):
+        """record completed segments, fsync every fsync_every segments"""
+        with self.lock:
+            for segment in segments:
+                self.file.write(json.dumps(segment, ensure_ascii=False) + "\n")
+            self.file.flush()
+
+            self.unsynced += len(segments)
+            if self.unsynced >= self.fsync_every:
+                os.fsync(self.file.fileno())
+                self.unsynced = 0
+
+    def close(self):
+        """fsync and close the journal"""
+        with self.lock:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def merge(self, output_file, expected_ids):
+        """
+        sort the journal into output_file and check every expected segment is present,
+        the journal is removed once the output is complete. returns the missing ids.
+        """
+        sort_runs(self.filename, output_file)
+        found = {segment_id(segment) for segment in read_segments(output_file)}
+
+        missing = expected_ids - found
+        if missing:
+            logger.error(
+                "%d segments missing from %s, rerun with --resume", len(missing), output_file
+            )
+            return missing
+
+        unexpected = found - expected_ids
+        if unexpected:
+            logger.warning("%d journal segments are not in the input", len(unexpected))
+
+        os.remove(self.filename)
+        return missing
@@ -0,0 +1,148 @@
+""" SQLite manifest of the playlist pages and videos downloaded by transcript_download.py.
+
+Each playlist page is stored with its etag, so a rerun asks for it with
+If-None-Match and reuses the stored items on a 304. Each video is stored with
+the etag of its playlist item, the hash of its transcript and the fetch time,
+so only new videos, videos whose title or description changed and failed
+downloads are fetched again, and videos removed from the playlist can be pruned.
+"""
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+
+def file_hash(filename):
+    """sha256 of a file"""
+    with open(filename, "rb") as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+
+class Manifest:
+    """thread safe SQLite record of the listed pages and downloaded videos"""
+
+    def __init__(self, path):
+        """open or create the manifest database"""
+        self.path = path
+        self.not_modified = 0
+        self.modified = 0
+        self.lock = threading.Lock()
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS pages (
+                playlist_id TEXT NOT NULL,
+                page_token TEXT NOT NULL,
+                etag TEXT NOT NULL,
+                next_page_token TEXT,
+                items TEXT NOT NULL,
+                fetched_at REAL NOT NULL,
+                PRIMARY KEY (playlist_id, page_token)
+            )"""
+        )
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS videos (
+                video_id TEXT PRIMARY KEY,
+                playlist_id TEXT NOT NULL,
+                etag TEXT,
+                transcript_hash TEXT,
+                fetched_at REAL NOT NULL
+            )"""
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS videos_playlist ON videos(playlist_id)")
+        self.db.commit()
+
+    def get_page(self, playlist_id, page_token):
+        """return the stored (etag, items, next_page_token) of a page or None"""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT etag, items, next_page_token FROM pages "
+                "WHERE playlist_id = ? AND page_token = ?",
+                (playlist_id, page_token or ""),
+            ).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1]), row[2]
+
+    def put_page(self, playlist_id, page_token, etag, items, next_page_token):
+        """store a listed page"""
+        with self.lock:
+            self.modified += 1
+            self.db.execute(
+                "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    playlist_id,
+                    page_token or "",
+                    etag,
+                    next_page_token,
+                    json.dumps(items),
+                    time.time(),
+                ),
+            )
+            self.db.commit()
+
+    def page_not_modified(self):
+        """count a page answered with 304 Not Modified"""
+        with self.lock:
+            self.not_modified += 1
+
+    def remove_pages(self, playlist_id, keep_tokens):
+        """forget the pages of a playlist that are no longer part of its page chain"""
+        keep_tokens = {token or "" for token in keep_tokens}
+        with self.lock:
+            tokens = self.db.execute(
+                "SELECT page_token FROM pages WHERE playlist_id = ?", (playlist_id,)
+            ).fetchall()
+            self.db.executemany(
+                "DELETE FROM pages WHERE playlist_id = ? AND page_token = ?",
+                [(playlist_id, token) for (token,) in tokens if token not in keep_tokens],
+            )
+            self.db.commit()
+
+    def get_video(self, video_id):
+        """return the stored (etag, transcript_hash, fetched_at) of a video or None"""
+        with self.lock:
+            return self.db.execute(
+                "SELECT etag, transcript_hash, fetched_at FROM videos WHERE video_id = ?",
+                (video_id,),
+            ).fetchone()
+
+    def put_video(self, video_id, playlist_id, etag, transcript_hash):
+        """record a video, transcript_hash None marks a failed download"""
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO videos VALUES (?, ?, ?, ?, ?)",
+                (video_id, playlist_id, etag, transcript_hash, time.time()),
+            )
+            self.db.commit()
+
+    def video_ids(self, playlist_id):
+        """ids of the recorded videos of a playlist"""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT video_id FROM videos WHERE playlist_id = ?", (playlist_id,)
+            ).fetchall()
+        return {video_id for (video_id,) in rows}
+
+    def remove_videos(self, video_ids):
+        """forget videos"""
+        with self.lock:
+            self.db.executemany(
+                "DELETE FROM videos WHERE video_id = ?", [(video_id,) for video_id in video_ids]
+            )
+            self.db.commit()
+
+    def stats(self):
+        """pages listed, pages not modified and videos recorded"""
+        with self.lock:
+            videos = self.db.execute("SELECT COUNT(*) FROM videos").fetchone()[0]
+            return {"modified": self.modified, "not_modified": self.not_modified, "videos": videos}
+
+    def close(self):
+        """close the database"""
+        with self.lock:
+            self.db.close()
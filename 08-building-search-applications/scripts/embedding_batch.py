@@ -0,0 +1,92 @@
+""" Helpers to pack transcript segments into batched OpenAI embedding requests."""
+
+import itertools
+import re
+import openai
+from tenacity import (
+    retry,
+    stop_after_attempt,
+    retry_if_not_exception_type,
+)
+from adaptive_limiter import limiter
+from token_counter import count_tokens_batch
+
+EMBEDDING_ENGINE = "text-embedding-ada-002"
+# maximum number of tokens the embedding model accepts for a single input
+MAX_INPUT_TOKENS = 8191
+OPENAI_REQUEST_TIMEOUT = 60
+# number of segments whose tokens are counted with one batch encode
+COUNT_WINDOW = 256
+
+
+def normalize_text(s, sep_token=" \n "):
+    """normalize text by removing extra spaces and newlines"""
+    s = re.sub(r"\s+", " ", s).strip()
+    s = re.sub(r". ,", "", s)
+    # remove all instances of multiple spaces
+    s = s.replace("..", ".")
+    s = s.replace(". .", ".")
+    s = s.replace("\n", "")
+    s = s.strip()
+
+    return s
+
+
+def build_batches(segments, max_inputs, max_tokens, skipped=None):
+    """
+    pack the segments into batches limited by input count and total token budget.
+    each batch is a list of (segment, normalized_text) tuples so the returned
+    vectors can be mapped back to their segment.
+    segments longer than MAX_INPUT_TOKENS are left out of the batches and
+    appended to skipped as (segment, normalized_text) when it is given.
+    """
+    batch = []
+    batch_tokens = 0
+    segments = iter(segments)
+
+    # count the tokens of COUNT_WINDOW segments at a time with one batch encode
+    while window := list(itertools.islice(segments, COUNT_WINDOW)):
+        texts = [normalize_text(segment["text"]) for segment in window]
+
+        for segment, text, tokens in zip(window, texts, count_tokens_batch(texts)):
+            if tokens > MAX_INPUT_TOKENS:
+                if skipped is not None:
+                    skipped.append((segment, text))
+                continue
+
+            if batch and (len(batch) >= max_inputs or batch_tokens + tokens > max_tokens):
+                yield batch
+                batch = []
+                batch_tokens = 0
+
+            batch.append((segment, text))
+            batch_tokens += tokens
+
+    if batch:
+        yield batch
+
+
+@retry(
+    wait=limiter.wait,
+    stop=stop_after_attempt(20),
+    retry=retry_if_not_exception_type(openai.InvalidRequestError),
+)
+def get_text_embeddings(
+    texts: list[str], engine: str = EMBEDDING_ENGINE, request_timeout: float = OPENAI_REQUEST_TIMEOUT
+):
+    """get the embeddings for a list of texts in a single request"""
+
+    response = limiter.call(
+        openai.Embedding.create,
+        tokens=sum(count_tokens_batch(texts)),
+        input=texts,
+        engine=engine,
+        request_timeout=request_timeout,
+    )
+
+    # the service may return the vectors in any order, the index maps them back
+    data = sorted(response["data"], key=lambda x: x["index"])
+    if len(data) != len(texts):
+        raise ValueError(f"Expected {len(texts)} embeddings, received {len(data)}")
+
+    return [item["embedding"] for item in data]
@@ -0,0 +1,148 @@
+""" Persistent content addressed embedding cache shared across pipeline runs."""
+
+import hashlib
+import sqlite3
+import threading
+import time
+from array import array
+
+DEFAULT_MAX_BYTES = 2 * 1024 * 1024 * 1024
+
+
+def cache_key(model: str, text: str) -> str:
+    """hash the model and normalized text into a cache key"""
+    return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """thread safe SQLite backed embedding cache with a size cap and LRU eviction
+
+    Vectors are stored as float32 blobs keyed by hash(model, normalized text).
+    When the stored vectors exceed `max_bytes` the least recently used entries
+    are evicted. Hits only record their access time in memory, `flush` writes
+    them in one transaction and runs before every eviction and on `close`.
+    """
+
+    def __init__(self, path: str, max_bytes: int = DEFAULT_MAX_BYTES):
+        """open or create the cache database"""
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # last access time of the keys read since the last flush
+        self.touched = {}
+        self.lock = threading.Lock()
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY,
+                vector BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL
+            )"""
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_last_access ON embeddings(last_access)"
+        )
+        self.db.commit()
+
+        self.total_bytes = self.db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM embeddings"
+        ).fetchone()[0]
+
+    def get(self, model: str, text: str):
+        """return the cached embedding or None"""
+        key = cache_key(model, text)
+        with self.lock:
+            row = self.db.execute(
+                "SELECT vector FROM embeddings WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.touched[key] = time.time()
+
+        return array("f", row[0]).tolist()
+
+    def _flush(self):
+        """write the access times of the touched keys, the caller holds the lock and commits"""
+        if self.touched:
+            self.db.executemany(
+                "UPDATE embeddings SET last_access = ? WHERE key = ?",
+                [(last_access, key) for key, last_access in self.touched.items()],
+            )
+            self.touched = {}
+
+    def flush(self):
+        """write the access times of the cache hits since the last flush in one transaction"""
+        with self.lock:
+            self._flush()
+            self.db.commit()
+
+    def put_many(self, model: str, items):
+        """store (text, embedding) pairs and evict if the cache is over its size cap"""
+        now = time.time()
+        rows = []
+        for text, embedding in items:
+            blob = array("f", embedding).tobytes()
+            rows.append((cache_key(model, text), blob, len(blob), now))
+
+        with self.lock:
+            for key, blob, size, last_access in rows:
+                previous = self.db.execute(
+                    "SELECT size FROM embeddings WHERE key = ?", (key,)
+                ).fetchone()
+                self.db.execute(
+                    "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)",
+                    (key, blob, size, last_access),
+                )
+                self.total_bytes += size - (previous[0] if previous else 0)
+
+            # the entries read since the last flush are not the least recently used
+            self._flush()
+            self._evict()
+            self.db.commit()
+
+    def put(self, model: str, text: str, embedding):
+        """store an embedding"""
+        self.put_many(model, [(text, embedding)])
+
+    def _evict(self):
+        """remove the least recently used entries until the cache fits its size cap"""
+        while self.total_bytes > self.max_bytes:
+            rows = self.db.execute(
+                "SELECT key, size FROM embeddings ORDER BY last_access LIMIT 256"
+            ).fetchall()
+            if not rows:
+                break
+
+            for key, size in rows:
+                if self.total_bytes <= self.max_bytes:
+                    break
+                self.db.execute("DELETE FROM embeddings WHERE key = ?", (key,))
+                self.total_bytes -= size
+                self.evictions += 1
+
+    def stats(self):
+        """return the cache statistics"""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "bytes": self.total_bytes,
+        }
+
+    def close(self):
+        """close the cache database"""
+        with self.lock:
+            self._flush()
+            self.db.commit()
+            self.db.close()
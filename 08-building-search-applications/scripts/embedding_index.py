@@ -0,0 +1,94 @@
+""" Compact embedding index: a memory mappable .npy vector matrix plus a columnar metadata sidecar.
+
+<prefix>.npy        contiguous float32 (or float16) matrix, one row per segment
+<prefix>.meta.json  {"count": n, "dimensions": d, "dtype": "float32", "columns": {"videoId": [...], ...}}
+"""
+
+import json
+import os
+import numpy as np
+
+VECTOR_KEY = "ada_v2"
+METADATA_COLUMNS = ["videoId", "seconds", "title", "speaker", "summary"]
+DTYPES = ["float32", "float16"]
+
+
+def index_files(prefix: str):
+    """return the vector and metadata file names for an index prefix"""
+    return prefix + ".npy", prefix + ".meta.json"
+
+
+def metadata_columns(segments, columns=None):
+    """return the metadata columns for the segments, missing values become empty strings"""
+    columns = columns or {column: [] for column in METADATA_COLUMNS}
+    for seg in segments:
+        for column in METADATA_COLUMNS:
+            value = seg.get(column)
+            columns[column].append("" if value is None else value)
+    return columns
+
+
+def write_index(segments, prefix: str, dtype: str = "float32", vector_key: str = VECTOR_KEY):
+    """
+    write the segment vectors and metadata columns, segments without a vector are skipped.
+    segments can be a generator, the vectors are streamed to disk as they are read.
+    """
+    if dtype not in DTYPES:
+        raise ValueError(f"Unsupported dtype {dtype}, expected one of {DTYPES}")
+
+    vector_file, metadata_file = index_files(prefix)
+
+    # the .npy header needs the row count, so stage the raw rows first
+    count = 0
+    dimensions = 0
+    columns = metadata_columns([])
+    with open(vector_file + ".raw", "wb") as raw:
+        for seg in segments:
+            if not seg.get(vector_key):
+                continue
+            dimensions = dimensions or len(seg[vector_key])
+            raw.write(np.asarray(seg[vector_key], dtype=dtype).tobytes())
+            metadata_columns([seg], columns)
+            count += 1
+
+    vectors = np.lib.format.open_memmap(
+        vector_file + ".tmp", mode="w+", dtype=dtype, shape=(count, dimensions)
+    )
+    if count:
+        vectors[:] = np.memmap(
+            vector_file + ".raw", dtype=dtype, mode="r", shape=(count, dimensions)
+        )
+    vectors.flush()
+    del vectors
+    os.remove(vector_file + ".raw")
+
+    metadata = {
+        "count": count,
+        "dimensions": dimensions,
+        "dtype": dtype,
+        "columns": columns,
+    }
+    with open(metadata_file + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(metadata, f, ensure_ascii=False)
+
+    # replace the files only once they are complete so readers never see a partial index
+    os.replace(vector_file + ".tmp", vector_file)
+    os.replace(metadata_file + ".tmp", metadata_file)
+
+
+def load_index(prefix: str):
+    """open the index zero-copy, returns the memory mapped vectors and the metadata columns"""
+    vector_file, metadata_file = index_files(prefix)
+
+    vectors = np.load(vector_file, mmap_mode="r")
+
+    with open(metadata_file, "r", encoding="utf-8") as f:
+        metadata = json.load(f)
+
+    if vectors.shape[0] != metadata["count"]:
+        raise ValueError(
+            f"Index {prefix} is inconsistent: {vectors.shape[0]} vectors, "
+            f"{metadata['count']} metadata rows"
+        )
+
+    return vectors, metadata["columns"]
@@ -0,0 +1,147 @@
+""" Metadata row sets of the video index for pre-filtered search.
+
+Each speaker, videoId and title word maps to the set of index rows that have
+it. Like the containers of a roaring bitmap, a set holding more than
+DENSE_FRACTION of the rows is a packed bitmap and a smaller one is a sorted
+array of row ids. A filter intersects the sets of its fields, smallest first,
+so a selective filter only ever touches a few rows, and the search then scores
+only the surviving candidate rows.
+"""
+
+import re
+from collections import defaultdict
+import numpy as np
+from bm25_index import tokenize
+
+# sets with more rows than this fraction are kept as bitmaps
+DENSE_FRACTION = 1 / 32
+SPEAKER_SEPARATORS = re.compile(r",|&|\band\b")
+# set bits of every byte value
+POPCOUNT = np.array([bin(byte).count("1") for byte in range(256)], dtype=np.int64)
+
+
+def speaker_names(value) -> list[str]:
+    """the normalized names of a speaker column value such as "Seth Juarez, Jane Doe" """
+    names = SPEAKER_SEPARATORS.split(str(value or "").casefold())
+    return [" ".join(name.split()) for name in names if name.strip()]
+
+
+def as_list(values):
+    """a single value or an iterable of values as a list"""
+    if values is None:
+        return []
+    if isinstance(values, str):
+        return [values]
+    return list(values)
+
+
+class MetadataIndex:
+    """speaker, videoId and title word row sets over the metadata columns of a video index"""
+
+    def __init__(self, columns: dict[str, list]):
+        """build the row sets from the metadata columns"""
+        self.count = len(columns["videoId"])
+        self.seconds = np.asarray(columns.get("seconds", [0] * self.count), dtype=np.float64)
+
+        keys = {
+            "speaker": [speaker_names(value) for value in columns.get("speaker", [""] * self.count)],
+            "videoId": [[value] for value in columns["videoId"]],
+            "title": [set(tokenize(value)) for value in columns.get("title", [""] * self.count)],
+        }
+        self.sets = {}
+        for field, row_keys in keys.items():
+            rows = defaultdict(list)
+            for row, values in enumerate(row_keys):
+                for value in values:
+                    rows[value].append(row)
+            self.sets[field] = {value: self._compact(np.array(ids)) for value, ids in rows.items()}
+
+    def _compact(self, rows):
+        """a sorted row array, or a packed bitmap for a dense set"""
+        if len(rows) <= DENSE_FRACTION * self.count:
+            return rows.astype(np.int64)
+        return self._bitmap(rows)
+
+    def _bitmap(self, rows):
+        """a packed bitmap of a row array"""
+        mask = np.zeros(self.count, dtype=bool)
+        mask[rows] = True
+        return np.packbits(mask)
+
+    def _is_bitmap(self, row_set):
+        """True for a packed bitmap"""
+        return row_set.dtype == np.uint8
+
+    def _size(self, row_set):
+        """number of rows of a set"""
+        if self._is_bitmap(row_set):
+            return int(POPCOUNT[row_set].sum())
+        return len(row_set)
+
+    def _rows(self, row_set):
+        """the sorted row ids of a set"""
+        if self._is_bitmap(row_set):
+            return np.flatnonzero(np.unpackbits(row_set, count=self.count))
+        return row_set
+
+    def _contains(self, row_set, rows):
+        """mask of the rows that are in a set"""
+        if self._is_bitmap(row_set):
+            return ((row_set[rows >> 3] >> (7 - (rows & 7)).astype(np.uint8)) & 1).astype(bool)
+        return np.isin(rows, row_set, assume_unique=True)
+
+    def _union(self, row_sets):
+        """the union of the sets of several values of a field"""
+        if not row_sets:
+            return np.empty(0, dtype=np.int64)
+        if len(row_sets) == 1:
+            return row_sets[0]
+        if any(self._is_bitmap(row_set) for row_set in row_sets):
+            union = np.zeros((self.count + 7) // 8, dtype=np.uint8)
+            for row_set in row_sets:
+                union |= row_set if self._is_bitmap(row_set) else self._bitmap(row_set)
+            return union
+        return np.unique(np.concatenate(row_sets))
+
+    def field_sets(self, field: str, values):
+        """the row set of each value of a field, empty for unknown values"""
+        empty = np.empty(0, dtype=np.int64)
+        return [self.sets[field].get(value, empty) for value in values]
+
+    def rows(self, speaker=None, video_ids=None, title=None, start=None, end=None):
+        """
+        the sorted rows matching every filter, None without filters. speaker and video_ids
+        take a value or a list of accepted values, title the words every title must contain,
+        start and end bound the segment start seconds, start <= seconds < end.
+        """
+        row_sets = []
+        if speaker is not None:
+            names = [name for value in as_list(speaker) for name in speaker_names(value)]
+            row_sets.append(self._union(self.field_sets("speaker", names)))
+        if video_ids is not None:
+            row_sets.append(self._union(self.field_sets("videoId", as_list(video_ids))))
+        if title is not None:
+            words = [word for value in as_list(title) for word in tokenize(value)]
+            # a title of only stopwords or punctuation has no indexed word to match
+            row_sets += self.field_sets("title", words) or [np.empty(0, dtype=np.int64)]
+        if not row_sets and start is None and end is None:
+            return None
+
+        # start from the smallest set and drop the rows missing from the others
+        if row_sets:
+            row_sets.sort(key=self._size)
+            rows = self._rows(row_sets[0])
+            for row_set in row_sets[1:]:
+                if not len(rows):
+                    break
+                rows = rows[self._contains(row_set, rows)]
+        else:
+            rows = np.arange(self.count)
+
+        seconds = self.seconds[rows]
+        keep = np.ones(len(rows), dtype=bool)
+        if start is not None:
+            keep &= seconds >= start
+        if end is not None:
+            keep &= seconds < end
+        return rows[keep]
@@ -0,0 +1,180 @@
+""" Product quantization (PQ) of the segment embeddings with asymmetric distance computation search.
+
+Each vector is split into `m` sub-vectors and every sub-vector is replaced by
+the id of its nearest of 256 centroids, so a 1536 dimension float32 vector
+(6 KB) is stored in `m` bytes. A query is scored against the codes with one
+lookup table per sub-space, and the best candidates can optionally be
+re-ranked with the exact vectors.
+"""
+
+import numpy as np
+from vector_ops import normalize_rows, top_k
+
+KSUB = 256
+KMEANS_ITERATIONS = 10
+TRAINING_SAMPLE = 32768
+ENCODE_CHUNK_SIZE = 65536
+
+
+def kmeans_l2(vectors, k, iterations=KMEANS_ITERATIONS, seed=42):
+    """euclidean k-means, returns the centroids"""
+    rng = np.random.default_rng(seed)
+    k = min(k, vectors.shape[0])
+    centroids = vectors[rng.choice(vectors.shape[0], k, replace=False)].copy()
+
+    for _ in range(iterations):
+        labels = nearest_centroid(vectors, centroids)
+        counts = np.bincount(labels, minlength=k)
+
+        sums = np.stack(
+            [
+                np.bincount(labels, weights=vectors[:, d], minlength=k)
+                for d in range(vectors.shape[1])
+            ],
+            axis=1,
+        )
+
+        present = counts > 0
+        centroids[present] = sums[present] / counts[present, None]
+
+        # re-seed empty clusters with random points
+        empty = np.flatnonzero(~present)
+        if len(empty):
+            centroids[empty] = vectors[rng.choice(vectors.shape[0], len(empty), replace=False)]
+
+    return centroids
+
+
+def nearest_centroid(vectors, centroids):
+    """return the index of the closest centroid by euclidean distance"""
+    # |x - c|^2 = |x|^2 - 2 x.c + |c|^2, |x|^2 is the same for every centroid
+    distances = (centroids * centroids).sum(axis=1) - 2.0 * (vectors @ centroids.T)
+    return np.argmin(distances, axis=1)
+
+
+class ProductQuantizer:
+    """encode vectors as m one byte centroid ids"""
+
+    def __init__(self, centroids):
+        """create the quantizer from the (m, 256, dsub) centroids, use `train` instead"""
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+
+    @classmethod
+    def train(cls, vectors, m=96, seed=42):
+        """train the sub-space codebooks on a sample of the vectors"""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        count, dimensions = vectors.shape
+        if dimensions % m:
+            raise ValueError(f"{dimensions} dimensions can't be split into {m} sub-vectors")
+
+        rng = np.random.default_rng(seed)
+        if count > TRAINING_SAMPLE:
+            vectors = vectors[np.sort(rng.choice(count, TRAINING_SAMPLE, replace=False))]
+
+        dsub = dimensions // m
+        centroids = np.zeros((m, KSUB, dsub), dtype=np.float32)
+        for j in range(m):
+            sub = np.ascontiguousarray(vectors[:, j * dsub : (j + 1) * dsub])
+            trained = kmeans_l2(sub, KSUB, seed=seed + j)
+            centroids[j, : len(trained)] = trained
+
+        return cls(centroids)
+
+    @property
+    def m(self):
+        return self.centroids.shape[0]
+
+    @property
+    def dsub(self):
+        return self.centroids.shape[2]
+
+    def encode(self, vectors):
+        """return the (n, m) uint8 codes for the vectors"""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        codes = np.empty((vectors.shape[0], self.m), dtype=np.uint8)
+
+        for start in range(0, vectors.shape[0], ENCODE_CHUNK_SIZE):
+            chunk = np.asarray(vectors[start : start + ENCODE_CHUNK_SIZE], dtype=np.float32)
+            for j in range(self.m):
+                sub = chunk[:, j * self.dsub : (j + 1) * self.dsub]
+                codes[start : start + len(chunk), j] = nearest_centroid(sub, self.centroids[j])
+
+        return codes
+
+    def decode(self, codes):
+        """return the approximate vectors for the codes"""
+        parts = [self.centroids[j][codes[:, j]] for j in range(self.m)]
+        return np.concatenate(parts, axis=1)
+
+    def lookup_tables(self, query):
+        """return the (m, 256) inner products between each query sub-vector and the centroids"""
+        query = np.asarray(query, dtype=np.float32).reshape(self.m, 1, self.dsub)
+        return (self.centroids * query).sum(axis=2)
+
+
+class PqIndex:
+    """searchable PQ codes with an optional exact re-rank
+
+    `vectors` is only needed for re-ranking; a memory mapped matrix keeps it
+    out of memory except for the pages of the re-ranked candidates.
+    """
+
+    def __init__(self, quantizer: ProductQuantizer, codes, vectors=None, rerank=0):
+        """create the index from a trained quantizer and the codes, use `build` or `load` instead"""
+        self.quantizer = quantizer
+        # column major so each sub-space lookup reads contiguous memory
+        self.codes = np.asfortranarray(codes)
+        self.vectors = vectors
+        self.rerank = rerank
+
+    @classmethod
+    def build(cls, vectors, m=96, rerank=0, seed=42):
+        """train the quantizer and encode the unit length vectors"""
+        vectors = normalize_rows(vectors)
+        quantizer = ProductQuantizer.train(vectors, m=m, seed=seed)
+        return cls(quantizer, quantizer.encode(vectors), vectors, rerank)
+
+    @classmethod
+    def load(cls, path, vectors=None, rerank=0):
+        """load the codebooks and codes saved with `save`"""
+        with np.load(path) as data:
+            return cls(ProductQuantizer(data["centroids"]), data["codes"], vectors, rerank)
+
+    def save(self, path):
+        """save the codebooks and codes"""
+        np.savez(path, centroids=self.quantizer.centroids, codes=self.codes)
+
+    def __len__(self):
+        return self.codes.shape[0]
+
+    @property
+    def nbytes(self):
+        """memory used by the codes and codebooks"""
+        return self.codes.nbytes + self.quantizer.centroids.nbytes
+
+    def scores(self, query):
+        """asymmetric distance computation, approximate inner products for every code"""
+        tables = self.quantizer.lookup_tables(query)
+        scores = np.zeros(self.codes.shape[0], dtype=np.float32)
+        for j in range(self.quantizer.m):
+            scores += np.take(tables[j], self.codes[:, j])
+        return scores
+
+    def search(self, query_vector, rows=10, rerank=None):
+        """return the (ids, similarities) of the best matches, best first
+
+        With `rerank` > 0 the best `rerank` candidates by ADC are re-scored with
+        the exact vectors.
+        """
+        query = normalize_rows(query_vector)
+        rerank = self.rerank if rerank is None else rerank
+        scores = self.scores(query)
+
+        if rerank and self.vectors is not None:
+            candidates = np.sort(top_k(scores, max(rows, rerank)))
+            exact = np.asarray(self.vectors[candidates], dtype=np.float32) @ query
+            best = top_k(exact, rows)
+            return candidates[best], exact[best]
+
+        best = top_k(scores, rows)
+        return best, scores[best]
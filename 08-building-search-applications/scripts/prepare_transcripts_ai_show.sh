@@ -7,6 +7,27 @@
 # 4. Enrich the transcripts with with OpenAI ChatGPT summaries
 # 5. Enrich the transcripts with embeddings
 # 6. Enrich the transcripts with lite embeddings - removes the text property
+#    and writes the compact embedding index (.npy vectors + .meta.json metadata)
+#
+# The intermediate files are newline delimited json (.jsonl), one segment per line.
+# If the summaries or embeddings step is interrupted, rerun it with --resume to
+# continue from its checkpoint journal (master_*.jsonl.journal).
+#
+# Set AZURE_OPENAI_TARGET_TPM to the deployment tokens-per-minute quota to keep the
+# speaker, summary and embedding requests under it.
+#
+# Set AZURE_OPENAI_RESPONSE_CACHE to a SQLite file (or "memory") to answer repeated
+# speaker and summary requests from a cache. AZURE_OPENAI_RESPONSE_CACHE_MODE=record
+# refreshes it, and =replay runs the stages offline from it, failing on a miss.
+#
+# transcript_pipeline.py runs the same stages in one process, streaming each
+# video through bounded queues so summaries and embeddings overlap:
+#   python3 transcript_pipeline.py -f $TRANSCRIPT_FOLDER -p <playlist> -m 3 --incremental --ann --bm25
+#
+# search_service.py serves the published index over HTTP and swaps in each newly
+# published index without a restart, benchmark_search_service.py load tests it:
+#   python3 search_service.py -i $TRANSCRIPT_FOLDER/output/embedding_index_3m -p 8000
+#   curl "http://127.0.0.1:8000/search?q=onnx+runtime&mode=hybrid&rows=5"
 
 
 export TRANSCRIPT_FOLDER=transcripts_the_ai_show
@@ -14,20 +35,36 @@ export TRANSCRIPT_BUCKET_MINUTES=3
 
 mkdir -p $TRANSCRIPT_FOLDER/output
 
+# reruns only fetch new and changed videos and prune removed ones, the etags are kept in
+# $TRANSCRIPT_FOLDER/download_manifest.sqlite
 python3 transcript_download.py -f $TRANSCRIPT_FOLDER -p PLlrxD0HtieHi0mwteKBOfEeOYf0LJU4O1
 
+# optional: pack the captions into compact .cap files, the later stages read them when present
+# python3 caption_store.py -f $TRANSCRIPT_FOLDER --remove-json
+
+# --batch packs several videos into each speaker request
 python3 transcript_enrich_speaker.py -f $TRANSCRIPT_FOLDER
 python3 transcript_enrich_bucket.py -f $TRANSCRIPT_FOLDER -m $TRANSCRIPT_BUCKET_MINUTES
-python3 transcript_enrich_summaries.py -f $TRANSCRIPT_FOLDER
+# reuse the summaries of unchanged segments from the previous run
+# --hierarchical also writes output/master_video_summaries.jsonl and master_playlist_summary.json
+python3 transcript_enrich_summaries.py -f $TRANSCRIPT_FOLDER --incremental \
+    --previous ./$TRANSCRIPT_FOLDER/output/embedding_index_full_${TRANSCRIPT_BUCKET_MINUTES}m.jsonl
 python3 transcript_enrich_embeddings.py -f $TRANSCRIPT_FOLDER
-python3 transcript_enrich_lite.py -f $TRANSCRIPT_FOLDER
+python3 transcript_enrich_lite.py -f $TRANSCRIPT_FOLDER --ann --bm25
 
-# bash test ./output/master_enriched.json file exists then rename it to include segment minutes
-if [ -f "./$TRANSCRIPT_FOLDER/output/master_enriched.json" ]; then
-    mv ./$TRANSCRIPT_FOLDER/output/master_enriched.json ./$TRANSCRIPT_FOLDER/output/embedding_index_full_${TRANSCRIPT_BUCKET_MINUTES}m.json
+# bash test ./output/master_enriched.jsonl file exists then rename it to include segment minutes
+if [ -f "./$TRANSCRIPT_FOLDER/output/master_enriched.jsonl" ]; then
+    mv ./$TRANSCRIPT_FOLDER/output/master_enriched.jsonl ./$TRANSCRIPT_FOLDER/output/embedding_index_full_${TRANSCRIPT_BUCKET_MINUTES}m.jsonl
 fi
 
 # bash test ./output/master_enriched_lite.json file exists then rename it to include segment minutes
 if [ -f "./$TRANSCRIPT_FOLDER/output/master_enriched_lite.json" ]; then
     mv ./$TRANSCRIPT_FOLDER/output/master_enriched_lite.json ./$TRANSCRIPT_FOLDER/output/embedding_index_${TRANSCRIPT_BUCKET_MINUTES}m.json
 fi
+
+# rename the compact index files to include segment minutes
+for ext in npy meta.json ivf.npz pq.npz bm25.npz; do
+    if [ -f "./$TRANSCRIPT_FOLDER/output/master_enriched_lite.$ext" ]; then
+        mv ./$TRANSCRIPT_FOLDER/output/master_enriched_lite.$ext ./$TRANSCRIPT_FOLDER/output/embedding_index_${TRANSCRIPT_BUCKET_MINUTES}m.$ext
+    fi
+done
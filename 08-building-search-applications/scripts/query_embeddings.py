@@ -0,0 +1,199 @@
+""" Query embedding layer for the video search front end.
+
+Queries are normalized (Unicode NFKC, case folded, whitespace collapsed and
+the surrounding punctuation dropped) and the normalized text is both embedded
+and used as the cache key, so "Jupyter notebooks  Azure ML?" and "jupyter
+notebooks azure ml" share one embedding. Misses wait up to `batch_window`
+seconds for other misses and are embedded together in one request, and a
+query already being embedded is joined instead of requested again.
+"""
+
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import numpy as np
+
+CACHE_MAX_ENTRIES = 4096
+CACHE_TTL_SECONDS = 24 * 3600.0
+BATCH_WINDOW_SECONDS = 0.005
+BATCH_MAX_QUERIES = 16
+# concurrent embedding requests
+MAX_IN_FLIGHT = 4
+# latencies kept for the percentiles
+LATENCY_WINDOW = 10000
+
+WHITESPACE = re.compile(r"\s+")
+EDGE_PUNCTUATION = "?!.,;:'\"()[]{} "
+
+
+def normalize_query(query: str) -> str:
+    """the cache key and embedded text of a query"""
+    query = unicodedata.normalize("NFKC", query).casefold()
+    return WHITESPACE.sub(" ", query).strip(EDGE_PUNCTUATION)
+
+
+def client_embedder(client, model: str):
+    """embed_batch function over an openai>=1.0 OpenAI or AzureOpenAI client"""
+
+    def embed_batch(texts):
+        response = client.embeddings.create(input=texts, model=model)
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+    return embed_batch
+
+
+class QueryEmbedder:
+    """thread safe LRU and TTL cached, coalescing and batching query embedder
+
+    embed_batch(texts) -> list of vectors is called with up to max_batch
+    normalized queries. A miss opens a batch that is sent batch_window seconds
+    later, or as soon as it is full, and every miss arriving meanwhile joins it.
+    """
+
+    def __init__(
+        self,
+        embed_batch,
+        max_entries: int = CACHE_MAX_ENTRIES,
+        ttl: float | None = CACHE_TTL_SECONDS,
+        batch_window: float = BATCH_WINDOW_SECONDS,
+        max_batch: int = BATCH_MAX_QUERIES,
+        max_in_flight: int = MAX_IN_FLIGHT,
+    ):
+        """initialize the embedder, ttl None keeps the embeddings until they are evicted"""
+        self.embed_batch = embed_batch
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.executor = ThreadPoolExecutor(max_in_flight)
+
+        self.cache = OrderedDict()
+        self.in_flight = {}
+        self.pending = []
+        self.batch_timer = None
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.batches = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+
+    def embed(self, query: str) -> np.ndarray:
+        """the embedding of a query"""
+        return self.embed_many([query])[0]
+
+    def embed_many(self, queries) -> np.ndarray:
+        """the embeddings of several queries as a matrix, their misses share the batches"""
+        start_time = time.perf_counter()
+        results = []
+        with self.lock:
+            for query in queries:
+                key = normalize_query(query)
+                vector = self._cached(key)
+                if vector is not None:
+                    self.hits += 1
+                    results.append(vector)
+                elif key in self.in_flight:
+                    # the same query is already being embedded
+                    self.coalesced += 1
+                    results.append(self.in_flight[key])
+                else:
+                    self.misses += 1
+                    results.append(self._enqueue(key))
+
+        vectors = [result.result() if isinstance(result, Future) else result for result in results]
+        elapsed = time.perf_counter() - start_time
+        with self.lock:
+            self.latencies.extend([elapsed] * len(vectors))
+        return np.stack(vectors)
+
+    def _cached(self, key):
+        """the cached embedding of a key or None, expired entries are dropped"""
+        entry = self.cache.get(key)
+        if entry is None:
+            return None
+        stored_at, vector = entry
+        if self.ttl is not None and time.monotonic() - stored_at > self.ttl:
+            del self.cache[key]
+            return None
+        self.cache.move_to_end(key)
+        return vector
+
+    def _enqueue(self, key):
+        """add a miss to the open batch, called with the lock held"""
+        future = Future()
+        self.in_flight[key] = future
+        self.pending.append(key)
+        if len(self.pending) >= self.max_batch:
+            self._send()
+        elif self.batch_timer is None:
+            self.batch_timer = threading.Timer(self.batch_window, self._send_on_timer)
+            self.batch_timer.daemon = True
+            self.batch_timer.start()
+        return future
+
+    def _send_on_timer(self):
+        """send the open batch when its window ends"""
+        with self.lock:
+            self.batch_timer = None
+            if self.pending:
+                self._send()
+
+    def _send(self):
+        """send the open batch, called with the lock held"""
+        if self.batch_timer is not None:
+            self.batch_timer.cancel()
+            self.batch_timer = None
+        batch, self.pending = self.pending, []
+        self.batches += 1
+        self.executor.submit(self._embed, batch)
+
+    def _embed(self, batch):
+        """embed a batch and resolve the waiting queries"""
+        try:
+            vectors = np.asarray(self.embed_batch(batch), dtype=np.float32)
+        except BaseException as exception:  # pylint: disable=broad-except
+            with self.lock:
+                futures = [self.in_flight.pop(key) for key in batch]
+            for future in futures:
+                future.set_exception(exception)
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            futures = []
+            for key, vector in zip(batch, vectors):
+                self.cache[key] = (now, vector)
+                self.cache.move_to_end(key)
+                futures.append(self.in_flight.pop(key))
+            while len(self.cache) > self.max_entries:
+                self.cache.popitem(last=False)
+        for future, vector in zip(futures, vectors):
+            future.set_result(vector)
+
+    def stats(self):
+        """hit rate, requests saved by coalescing and batching, and p50/p99 latency in ms"""
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            queries = self.hits + self.misses + self.coalesced
+            return {
+                "queries": queries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "batches": self.batches,
+                "hit_rate": self.hits / queries if queries else 0.0,
+                "p50_ms": float(np.percentile(latencies, 50)) if len(latencies) else 0.0,
+                "p99_ms": float(np.percentile(latencies, 99)) if len(latencies) else 0.0,
+            }
+
+    def close(self):
+        """wait for the batches in flight"""
+        with self.lock:
+            if self.pending:
+                self._send()
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,45 @@
+""" Thread safe token bucket rate limiter shared by the transcript enrichment scripts."""
+
+import threading
+import time
+
+
+class TokenBucket:
+    """thread safe token bucket
+
+    The bucket refills at `rate` tokens per second up to `capacity` tokens.
+    Callers block in `acquire` until enough tokens are available, which spreads
+    requests evenly over time instead of sleeping a fixed interval per request.
+    """
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        """initialize the bucket"""
+        if rate <= 0:
+            raise ValueError("rate must be greater than zero")
+
+        self.rate = float(rate)
+        self.capacity = float(capacity) if capacity else float(rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        """add the tokens accumulated since the last update"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, tokens: float = 1):
+        """block until the requested number of tokens can be taken from the bucket"""
+        # a request larger than the bucket would otherwise wait forever
+        tokens = min(float(tokens), self.capacity)
+
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+
+            time.sleep(wait)
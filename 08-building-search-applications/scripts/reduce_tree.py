@@ -0,0 +1,112 @@
+""" Streaming tree reduction of results that complete out of order.
+
+The results of a stream are reduced fan_in at a time in input order: the
+results 0..fan_in-1 form the first group of level 1, the next fan_in the
+second, and so on up to a single root. Every group is reduced on the executor
+as soon as its last input is ready, so the reduction overlaps with the work
+that produces the inputs. The grouping only depends on the input order, so an
+unchanged input gives the same groups on every run.
+"""
+
+import threading
+from concurrent.futures import Future
+
+FAN_IN = 8
+
+
+class ReduceTree:
+    """reduce a stream of indexed results with reduce_fn(values) -> value"""
+
+    def __init__(self, reduce_fn, executor, fan_in=FAN_IN):
+        """initialize the tree, reductions are submitted to executor"""
+        self.reduce_fn = reduce_fn
+        self.executor = executor
+        self.fan_in = fan_in
+        # per level the ready values by index, the number of values once known
+        # and the groups already submitted
+        self.values = [{}]
+        self.sizes = [None]
+        self.submitted = [set()]
+        self.lock = threading.Lock()
+        self.result = Future()
+
+    def add(self, index, value):
+        """add the result of input index"""
+        self._add(0, index, value)
+
+    def finish(self, count):
+        """no more inputs, count is the number of inputs added"""
+        with self.lock:
+            level, size = 0, count
+            while True:
+                self._ensure(level)
+                self.sizes[level] = size
+                if size <= 1:
+                    break
+                size = -(-size // self.fan_in)
+                level += 1
+            if count == 0:
+                self.result.set_result(None)
+                return
+            ready = [group for level in range(len(self.values)) for group in self._ready(level)]
+            self._check_root()
+        self._submit(ready)
+
+    def wait(self, timeout=None):
+        """block until the root value is reduced and return it"""
+        return self.result.result(timeout)
+
+    def _ensure(self, level):
+        """create the bookkeeping of level"""
+        while len(self.values) <= level:
+            self.values.append({})
+            self.sizes.append(None)
+            self.submitted.append(set())
+
+    def _add(self, level, index, value):
+        """store a value and submit the groups it completes"""
+        with self.lock:
+            self._ensure(level)
+            self.values[level][index] = value
+            ready = self._ready(level, index // self.fan_in)
+            self._check_root()
+        self._submit(ready)
+
+    def _ready(self, level, group=None):
+        """the complete groups of level not submitted yet, only group when given"""
+        size = self.sizes[level]
+        if size is not None and size <= 1:
+            # the top level has no groups
+            return []
+        groups = [group] if group is not None else range(-(-(size or 0) // self.fan_in))
+        ready = []
+        for group in groups:
+            first = group * self.fan_in
+            last = first + self.fan_in if size is None else min(first + self.fan_in, size)
+            values = self.values[level]
+            if group in self.submitted[level] or any(i not in values for i in range(first, last)):
+                continue
+            self.submitted[level].add(group)
+            ready.append((level, group, [values.pop(i) for i in range(first, last)]))
+        return ready
+
+    def _check_root(self):
+        """resolve the result once the single value of the top level is there"""
+        for level, size in enumerate(self.sizes):
+            if size == 1 and 0 in self.values[level] and not self.result.done():
+                self.result.set_result(self.values[level][0])
+
+    def _submit(self, ready):
+        """reduce the ready groups on the executor"""
+        for level, group, values in ready:
+            self.executor.submit(self._reduce, level, group, values)
+
+    def _reduce(self, level, group, values):
+        """reduce one group into the next level"""
+        try:
+            value = self.reduce_fn(values)
+        except BaseException as exception:  # pylint: disable=broad-except
+            if not self.result.done():
+                self.result.set_exception(exception)
+            return
+        self._add(level + 1, group, value)
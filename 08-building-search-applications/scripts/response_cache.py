@@ -0,0 +1,210 @@
+""" Request level cache of the Azure OpenAI chat responses shared by the enrichment scripts.
+
+A response is stored under the hash of everything that decides it: the API
+type and version, the deployment and model, the messages, the functions and
+the sampling parameters. The summary and speaker prompts are effectively
+deterministic, so a rerun answers an unchanged request from the cache without
+a request, a quota charge or a wait.
+
+AZURE_OPENAI_RESPONSE_CACHE selects the backend, a SQLite file or "memory" for
+an in-process LRU whose entries expire after AZURE_OPENAI_RESPONSE_CACHE_TTL
+seconds, and AZURE_OPENAI_RESPONSE_CACHE_MODE the mode:
+
+    read-write  answer from the cache, request and store the misses (default)
+    record      request every call and store its response
+    replay      answer from the cache only, a miss raises ReplayMiss
+
+so a pipeline recorded once can be replayed offline, for example in CI.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+import openai
+from openai.openai_object import OpenAIObject
+
+READ_WRITE = "read-write"
+RECORD = "record"
+REPLAY = "replay"
+MODES = (READ_WRITE, RECORD, REPLAY)
+MEMORY_MAX_ENTRIES = 10000
+# call arguments that do not change the response
+NON_REQUEST_PARAMS = {"tokens", "request_timeout"}
+
+
+class ReplayMiss(Exception):
+    """a replayed request is not in the cache"""
+
+
+def request_key(params):
+    """hash of the api type and version and the request parameters"""
+    request = {key: value for key, value in params.items() if key not in NON_REQUEST_PARAMS}
+    request["api_type"] = openai.api_type
+    request["api_version"] = openai.api_version
+    text = json.dumps(request, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class MemoryBackend:
+    """thread safe in-process LRU of responses, entries older than ttl seconds expire"""
+
+    def __init__(self, max_entries=MEMORY_MAX_ENTRIES, ttl=None):
+        """initialize the LRU, ttl None keeps entries until they are evicted"""
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """return the stored response text or None"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            stored_at, text = entry
+            if self.ttl is not None and time.time() - stored_at > self.ttl:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return text
+
+    def put(self, key, text):
+        """store a response text, evicting the least recently used entries"""
+        with self.lock:
+            self.entries[key] = (time.time(), text)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def close(self):
+        """drop the entries"""
+        with self.lock:
+            self.entries.clear()
+
+
+class SQLiteBackend:
+    """thread safe SQLite file of responses that persists across runs"""
+
+    def __init__(self, path):
+        """open or create the cache database"""
+        self.path = path
+        self.lock = threading.Lock()
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                stored_at REAL NOT NULL
+            )"""
+        )
+        self.db.commit()
+
+    def get(self, key):
+        """return the stored response text or None"""
+        with self.lock:
+            row = self.db.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def put(self, key, text):
+        """store a response text"""
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?)", (key, text, time.time())
+            )
+            self.db.commit()
+
+    def close(self):
+        """close the cache database"""
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+
+def open_backend(spec, ttl=None):
+    """the backend named by spec, "memory" or a SQLite file, None when spec is empty"""
+    if not spec:
+        return None
+    if spec == "memory":
+        return MemoryBackend(ttl=ttl)
+    return SQLiteBackend(spec)
+
+
+class ResponseCache:
+    """answer chat requests from a backend, a cache without a backend calls through"""
+
+    def __init__(self, backend=None, mode=READ_WRITE):
+        """initialize the cache"""
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.configure(backend, mode)
+
+    def configure(self, backend, mode=READ_WRITE):
+        """replace the backend and mode"""
+        if mode not in MODES:
+            raise ValueError(f"Unknown response cache mode {mode}, expected one of {MODES}")
+        self.backend = backend
+        self.mode = mode
+
+    def call(self, fn, *args, **params):
+        """
+        return fn(*args, **params) from the cache, params are the request parameters,
+        fn is called and its response stored on a miss unless replaying
+        """
+        if self.backend is None:
+            return fn(*args, **params)
+
+        key = request_key(params)
+        if self.mode != RECORD:
+            text = self.backend.get(key)
+            with self.lock:
+                if text is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+            if text is not None:
+                return OpenAIObject.construct_from(json.loads(text))
+            if self.mode == REPLAY:
+                raise ReplayMiss(f"Request {key} is not in the response cache")
+
+        response = fn(*args, **params)
+        self.backend.put(key, json.dumps(response, ensure_ascii=False))
+        with self.lock:
+            self.stored += 1
+        return response
+
+    def stats(self):
+        """hits, misses and responses stored"""
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "stored": self.stored}
+
+    def report(self):
+        """print the statistics, returns False if a replayed request was missing"""
+        if self.backend is None:
+            return True
+        stats = self.stats()
+        print(
+            f"Response cache ({self.mode}): {stats['hits']} hits, {stats['misses']} misses, "
+            f"{stats['stored']} stored"
+        )
+        return self.mode != REPLAY or stats["misses"] == 0
+
+    def close(self):
+        """close the backend"""
+        if self.backend is not None:
+            self.backend.close()
+
+
+ttl = os.getenv("AZURE_OPENAI_RESPONSE_CACHE_TTL")
+responses = ResponseCache(
+    open_backend(os.getenv("AZURE_OPENAI_RESPONSE_CACHE"), float(ttl) if ttl else None),
+    os.getenv("AZURE_OPENAI_RESPONSE_CACHE_MODE", READ_WRITE),
+)
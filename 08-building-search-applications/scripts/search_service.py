@@ -0,0 +1,544 @@
+""" Local HTTP search service over the compact video index, hot reloading newly published indexes.
+
+GET  /search?q=<query>&rows=5&mode=vector|text|hybrid|videos
+             &speaker=..&video=..&title=..&start=..&end=..
+POST /search with the same parameters as a json body
+GET  /health
+
+The index is loaded once, memory mapped, and shared by every request. The
+asyncio loop only parses and writes the HTTP messages, the query embeddings
+and the searches run on thread pools. Unfiltered vector searches arriving
+while a batch is being scored are queued and answered together by the next
+`search_batch`, so concurrent queries share one pass over the vectors. The
+query embedding gets a few short attempts and a search not answered within
+`--deadline` seconds gets a 504, so a throttled or unreachable deployment does
+not hold requests for minutes.
+
+A watcher polls the index files and, once a newly published index has stopped
+changing for `settle` seconds, loads and warms it on a worker thread and swaps
+it in with one assignment. Requests already running finish on the previous
+generation, whose memory maps are released when the last of them drops it.
+The vectors are mapped from the page cache, so the two generations never hold
+private copies of the matrix. SIGHUP reloads the index immediately.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import signal
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from urllib.parse import parse_qs, urlsplit
+import numpy as np
+import openai
+from tenacity import stop_after_attempt
+from adaptive_limiter import limiter
+from embedding_batch import get_text_embeddings
+from embedding_index import index_files
+from query_embeddings import QueryEmbedder
+from video_search import (
+    RRF_DEPTH,
+    SIMILARITIES_RESULTS_THRESHOLD,
+    VideoIndex,
+    reciprocal_rank_fusion,
+)
+
+logging.basicConfig(level=logging.WARNING)
+logger = logging.getLogger(__name__)
+
+DEFAULT_INDEX = os.path.join("transcripts_the_ai_show", "output", "embedding_index_3m")
+SIDECAR_EXTENSIONS = [".ivf.npz", ".pq.npz", ".bm25.npz"]
+MODES = ["vector", "text", "hybrid", "videos"]
+DEFAULT_ROWS = 5
+MAX_ROWS = 50
+POLL_SECONDS = 2.0
+SETTLE_SECONDS = 2.0
+SEARCH_WORKERS = 4
+EMBED_WORKERS = 32
+# vector searches answered by one matrix product
+MAX_BATCH = 32
+# a search answers within the deadline or fails with a 504, the query embedding gets a
+# few short attempts instead of the 20 retries of the enrichment scripts
+REQUEST_DEADLINE_SECONDS = 10.0
+QUERY_EMBED_ATTEMPTS = 3
+QUERY_EMBED_TIMEOUT = 5.0
+# latencies kept for the percentiles
+LATENCY_WINDOW = 10000
+# parameters that take several values, repeated in the query string or a json list
+LIST_PARAMETERS = ["speaker", "video"]
+REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    500: "Internal Server Error",
+    502: "Bad Gateway",
+    503: "Service Unavailable",
+    504: "Gateway Timeout",
+}
+
+
+def index_signature(prefix: str):
+    """inode, size and mtime of every index file, None while the vectors or metadata are missing"""
+    signature = []
+    for path in list(index_files(prefix)) + [prefix + ext for ext in SIDECAR_EXTENSIONS]:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            if path in index_files(prefix):
+                return None
+            continue
+        signature.append((path, stat.st_ino, stat.st_size, stat.st_mtime_ns))
+    return tuple(signature)
+
+
+def memory_kb():
+    """resident anonymous and file backed memory of the process in kB, empty without /proc"""
+    try:
+        with open("/proc/self/status", "r", encoding="utf-8") as f:
+            lines = [line.split() for line in f if line.startswith(("RssAnon", "RssFile"))]
+    except OSError:
+        return {}
+    return {name.rstrip(":"): int(value) for name, value, *_ in lines}
+
+
+def optional_float(value, name: str):
+    """a finite float parameter, None when missing or empty"""
+    if value in (None, ""):
+        return None
+    try:
+        if isinstance(value, bool):
+            raise TypeError(name)
+        number = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{name} must be a number") from None
+    if not math.isfinite(number):
+        raise ValueError(f"{name} must be a finite number")
+    return number
+
+
+def optional_int(value, name: str):
+    """an integer parameter, None when missing or empty"""
+    if value in (None, ""):
+        return None
+    try:
+        if isinstance(value, (bool, float)):
+            raise TypeError(name)
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{name} must be an integer") from None
+
+
+def optional_text(value, name: str):
+    """a string parameter, or a list of strings for LIST_PARAMETERS, None when missing or empty"""
+    if value in (None, "", []):
+        return None
+    values = value if name in LIST_PARAMETERS and isinstance(value, list) else [value]
+    if not all(isinstance(item, str) for item in values):
+        kind = "a string or a list of strings" if name in LIST_PARAMETERS else "a string"
+        raise ValueError(f"{name} must be {kind}")
+    return value
+
+
+def search_parameters(params: dict):
+    """validate the search parameters, returns (query, rows, mode, threshold, filters)"""
+    query = (optional_text(params.get("q"), "q") or "").strip()
+    if not query:
+        raise ValueError("Missing query parameter q")
+
+    rows = optional_int(params.get("rows"), "rows")
+    if rows is None:
+        rows = DEFAULT_ROWS
+    if not 0 < rows <= MAX_ROWS:
+        raise ValueError(f"rows must be between 1 and {MAX_ROWS}")
+
+    mode = optional_text(params.get("mode"), "mode") or "vector"
+    if mode not in MODES:
+        raise ValueError(f"Unknown mode {mode}, expected one of {MODES}")
+
+    threshold = optional_float(params.get("threshold"), "threshold")
+    filters = {
+        "speaker": optional_text(params.get("speaker"), "speaker"),
+        "video_ids": optional_text(params.get("video"), "video"),
+        "title": optional_text(params.get("title"), "title"),
+        "start": optional_float(params.get("start"), "start"),
+        "end": optional_float(params.get("end"), "end"),
+    }
+    if threshold is None:
+        threshold = SIMILARITIES_RESULTS_THRESHOLD
+    return query, rows, mode, threshold, filters
+
+
+def query_embed_batch(attempts: int = QUERY_EMBED_ATTEMPTS, timeout: float = QUERY_EMBED_TIMEOUT):
+    """get_text_embeddings with a short retry budget and request timeout for interactive queries"""
+    embed = get_text_embeddings.retry_with(stop=stop_after_attempt(attempts), reraise=True)
+    return partial(embed, request_timeout=timeout)
+
+
+def search_batches(batch):
+    """
+    answer queued (index, vector, rows, threshold, future) searches with one search_batch
+    per index generation, returns the (indices, similarities) of each search
+    """
+    results = [None] * len(batch)
+    generations = {}
+    for position, (index, *_) in enumerate(batch):
+        generations.setdefault(id(index), []).append(position)
+
+    for positions in generations.values():
+        index = batch[positions[0]][0]
+        vectors = np.stack([batch[position][1] for position in positions])
+        # the best matches come first, so each search keeps a prefix of the largest one
+        answers = index.search_batch(
+            vectors, max(batch[position][2] for position in positions), threshold=-np.inf
+        )
+        for position, (indices, similarities) in zip(positions, answers):
+            _, _, rows, threshold, _ = batch[position]
+            indices, similarities = indices[:rows], similarities[:rows]
+            mask = similarities >= threshold
+            results[position] = (indices[mask], similarities[mask])
+    return results
+
+
+class SearchService:
+    """serve searches over the current generation of the index and swap in new ones"""
+
+    def __init__(
+        self,
+        prefix: str,
+        embedder: QueryEmbedder,
+        poll: float = POLL_SECONDS,
+        settle: float = SETTLE_SECONDS,
+        workers: int = SEARCH_WORKERS,
+        deadline: float = REQUEST_DEADLINE_SECONDS,
+    ):
+        """initialize the service, the index is loaded by `serve`"""
+        self.prefix = prefix
+        self.embedder = embedder
+        self.poll = poll
+        self.settle = settle
+        self.deadline = deadline
+        self.executor = ThreadPoolExecutor(workers)
+        # threads waiting on the query embedder, apart so they never hold up the searches
+        self.embed_executor = ThreadPoolExecutor(EMBED_WORKERS)
+
+        # (generation, index), replaced as a whole so a request never mixes two generations
+        self.current = (0, None)
+        self.signature = None
+        self.failed_signature = None
+        self.loaded_at = None
+        self.reloads = 0
+        self.reload_failures = 0
+        self.reload_lock = None
+
+        # unfiltered vector searches waiting for the next batched matrix product
+        self.pending = []
+        self.batching = False
+
+        self.requests = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.batches = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+
+    def load(self):
+        """load and warm the index, runs on a worker thread"""
+        start_time = time.perf_counter()
+        index = VideoIndex.load(self.prefix).warm()
+        elapsed = time.perf_counter() - start_time
+        logger.info("Loaded %s, %d rows in %.2fs", self.prefix, len(index), elapsed)
+        return index
+
+    async def reload(self, signature=None):
+        """load the published index and swap it in, keeping the current one when that fails"""
+        async with self.reload_lock:
+            signature = signature or index_signature(self.prefix)
+            if signature is None:
+                logger.warning("No index published at %s", self.prefix)
+                return False
+
+            try:
+                loop = asyncio.get_running_loop()
+                index = await loop.run_in_executor(self.executor, self.load)
+            except (OSError, ValueError, KeyError) as error:
+                self.reload_failures += 1
+                self.failed_signature = signature
+                logger.warning(
+                    "Keeping generation %d, cannot load %s: %s", self.current[0], self.prefix, error
+                )
+                return False
+
+            if index_signature(self.prefix) != signature:
+                # the files were replaced while loading, the watcher loads them once they settle
+                logger.info("Index %s changed while loading, waiting for it to settle", self.prefix)
+                return False
+
+            self.current = (self.current[0] + 1, index)
+            self.signature = signature
+            self.loaded_at = time.time()
+            self.reloads += 1
+            generation = self.current[0]
+            print(f"Serving generation {generation} of {self.prefix}, {len(index)} rows")
+            return True
+
+    async def watch(self):
+        """poll the index files, a new version is loaded once unchanged for settle seconds"""
+        pending = None
+        changed_at = 0.0
+        while True:
+            await asyncio.sleep(self.poll)
+            signature = index_signature(self.prefix)
+            if signature is None or signature in (self.signature, self.failed_signature):
+                pending = None
+            elif signature != pending:
+                pending, changed_at = signature, time.monotonic()
+            elif time.monotonic() - changed_at >= self.settle:
+                await self.reload(signature)
+                pending = None
+
+    async def search(self, generation, index, params):
+        """answer a search, the embedding and the index work run on the thread pools"""
+        query, rows, mode, threshold, filters = search_parameters(params)
+        loop = asyncio.get_running_loop()
+
+        neighbours = None
+        if mode == "text":
+            indices, scores = await loop.run_in_executor(
+                self.executor, partial(index.search_text, query, rows, **filters)
+            )
+        elif mode == "videos":
+            # distinct videos with the neighbours of their best segment
+            query_vector = await loop.run_in_executor(
+                self.embed_executor, self.embedder.embed, query
+            )
+            indices, scores, neighbours = await loop.run_in_executor(
+                self.executor,
+                partial(index.search_videos, query_vector, rows, threshold, **filters),
+            )
+        else:
+            query_vector = await loop.run_in_executor(
+                self.embed_executor, self.embedder.embed, query
+            )
+            # the hybrid search fuses the top RRF_DEPTH of both rankings, as search_hybrid does
+            depth = RRF_DEPTH if mode == "hybrid" else rows
+            if any(value is not None for value in filters.values()):
+                indices, scores = await loop.run_in_executor(
+                    self.executor, partial(index.search, query_vector, depth, threshold, **filters)
+                )
+            else:
+                indices, scores = await self.search_vector(index, query_vector, depth, threshold)
+
+            if mode == "hybrid":
+                text_indices, _ = await loop.run_in_executor(
+                    self.executor, partial(index.search_text, query, depth, **filters)
+                )
+                indices, scores = reciprocal_rank_fusion([indices, text_indices], rows)
+
+        return {
+            "query": query,
+            "mode": mode,
+            "generation": generation,
+            "results": index.records(indices, scores, neighbours),
+        }
+
+    async def search_vector(self, index, query_vector, rows: int, threshold: float):
+        """queue an unfiltered vector search for the next batched matrix product"""
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((index, query_vector, rows, threshold, future))
+        if not self.batching:
+            self.batching = True
+            asyncio.ensure_future(self.run_batches())
+        return await future
+
+    async def run_batches(self):
+        """answer the queued vector searches, a batch takes those queued while the last one ran"""
+        loop = asyncio.get_running_loop()
+        try:
+            while self.pending:
+                batch, self.pending = self.pending[:MAX_BATCH], self.pending[MAX_BATCH:]
+                self.batches += 1
+                try:
+                    results = await loop.run_in_executor(self.executor, search_batches, batch)
+                except Exception as error:  # pylint: disable=broad-except
+                    results = [error] * len(batch)
+                for (*_, future), result in zip(batch, results):
+                    if future.done():
+                        continue
+                    if isinstance(result, Exception):
+                        future.set_exception(result)
+                    else:
+                        future.set_result(result)
+        finally:
+            self.batching = False
+
+    def health(self):
+        """the serving generation, reload and request counters, latencies and memory"""
+        generation, index = self.current
+        latencies = np.array(self.latencies) * 1000
+        return {
+            "status": "ok" if index is not None else "loading",
+            "index": self.prefix,
+            "generation": generation,
+            "rows": len(index) if index is not None else 0,
+            "loaded_at": self.loaded_at,
+            "reloads": self.reloads,
+            "reload_failures": self.reload_failures,
+            "requests": self.requests,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "vector_batches": self.batches,
+            "p50_ms": float(np.percentile(latencies, 50)) if len(latencies) else 0.0,
+            "p99_ms": float(np.percentile(latencies, 99)) if len(latencies) else 0.0,
+            "embeddings": self.embedder.stats(),
+            "memory_kb": memory_kb(),
+        }
+
+    async def dispatch(self, method: str, target: str, body: bytes):
+        """route a request, returns (status, json body)"""
+        url = urlsplit(target)
+        if url.path == "/health":
+            return 200, self.health()
+        if url.path != "/search":
+            return 404, {"error": f"Unknown path {url.path}"}
+        if method not in ("GET", "POST"):
+            return 405, {"error": f"Method {method} not allowed"}
+
+        # bind the generation now, a reload during the search does not affect it
+        generation, index = self.current
+        if index is None:
+            return 503, {"error": "No index loaded yet"}
+
+        start_time = time.perf_counter()
+        self.requests += 1
+        try:
+            params = {
+                key: values if key in LIST_PARAMETERS else values[0]
+                for key, values in parse_qs(url.query).items()
+            }
+            if method == "POST" and body:
+                body = json.loads(body)
+                if not isinstance(body, dict):
+                    raise ValueError("The request body must be a json object")
+                params.update(body)
+            # the embedding and search threads run on, but the client is answered in time
+            result = await asyncio.wait_for(self.search(generation, index, params), self.deadline)
+        except asyncio.TimeoutError:
+            self.errors += 1
+            self.timeouts += 1
+            logger.warning("Search not answered within %.1fs", self.deadline)
+            return 504, {"error": f"Search not answered within {self.deadline}s"}
+        except ValueError as error:
+            self.errors += 1
+            return 400, {"error": str(error)}
+        except openai.error.OpenAIError as error:
+            self.errors += 1
+            logger.warning("Query embedding failed: %s", error)
+            return 502, {"error": f"Query embedding failed: {error}"}
+        except Exception as error:  # pylint: disable=broad-except
+            self.errors += 1
+            logger.exception("Search failed")
+            return 500, {"error": str(error)}
+
+        self.latencies.append(time.perf_counter() - start_time)
+        return 200, result
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """serve the HTTP/1.1 requests of one keep-alive connection"""
+        try:
+            while request_line := await reader.readline():
+                method, target, version = request_line.decode("latin-1").split()
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                status, payload = await self.dispatch(method, target, body)
+                keep_alive = (
+                    version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                )
+                content = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                writer.write(
+                    (
+                        f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+                        "Content-Type: application/json\r\n"
+                        f"Content-Length: {len(content)}\r\n"
+                        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+                    ).encode("latin-1")
+                    + content
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError) as error:
+            logger.debug("Closing connection: %s", error)
+        finally:
+            writer.close()
+
+    async def serve(self, host: str, port: int):
+        """load the index, then serve requests and watch for new indexes until cancelled"""
+        self.reload_lock = asyncio.Lock()
+        await self.reload()
+
+        loop = asyncio.get_running_loop()
+        try:
+            loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.ensure_future(self.reload()))
+        except (AttributeError, NotImplementedError):
+            # no SIGHUP on Windows, the watcher still reloads new indexes
+            pass
+
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f"Search service listening on http://{host}:{port}, index {self.prefix}")
+        watcher = asyncio.create_task(self.watch())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            watcher.cancel()
+            self.executor.shutdown(wait=False)
+            self.embed_executor.shutdown(wait=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--index", default=DEFAULT_INDEX, help="compact index prefix")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("-p", "--port", type=int, default=8000)
+    parser.add_argument("--poll", type=float, default=POLL_SECONDS, help="index poll interval")
+    parser.add_argument(
+        "--settle", type=float, default=SETTLE_SECONDS, help="seconds a new index is unchanged"
+    )
+    parser.add_argument("--workers", type=int, default=SEARCH_WORKERS, help="search threads")
+    parser.add_argument(
+        "--deadline",
+        type=float,
+        default=REQUEST_DEADLINE_SECONDS,
+        help="seconds a search may take before it is answered with a 504",
+    )
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    if args.verbose:
+        logger.setLevel(logging.DEBUG)
+    # openai creates one session per thread with the limiter's factory
+    limiter.install()
+
+    openai.api_type = "azure"
+    openai.api_key = os.environ["AZURE_OPENAI_API_KEY"]
+    openai.api_base = os.environ["AZURE_OPENAI_ENDPOINT"]
+    openai.api_version = "2023-05-15"
+
+    embedder = QueryEmbedder(query_embed_batch())
+    service = SearchService(
+        args.index, embedder, args.poll, args.settle, args.workers, args.deadline
+    )
+    try:
+        asyncio.run(service.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        embedder.close()
@@ -0,0 +1,182 @@
+""" Newline delimited JSON (.jsonl) segment files shared by the transcript_* stages.
+
+Each line is one segment. Writers append one sorted run per video and flush it,
+so a crash keeps every finished video, and readers stream the segments one
+video at a time instead of loading the whole corpus. `sort_runs` orders a file
+by (videoId, seconds) with a k-way merge of its runs.
+"""
+
+import heapq
+import itertools
+import json
+import logging
+import os
+from array import array
+from concurrent.futures import FIRST_COMPLETED, wait
+from operator import itemgetter
+
+logger = logging.getLogger(__name__)
+
+
+def sort_key(segment):
+    """segments are ordered by video then start time"""
+    return segment["videoId"], segment.get("seconds", 0)
+
+
+def read_segments(filename):
+    """yield the segments of a .jsonl file, or of a legacy .json array"""
+    with open(filename, "r", encoding="utf-8") as f:
+        if not filename.endswith(".jsonl"):
+            yield from json.load(f)
+            return
+
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def count_segments(filename):
+    """count the segments of a .jsonl file without parsing them"""
+    with open(filename, "rb") as f:
+        return sum(1 for line in f if line.strip())
+
+
+def group_by_video(segments):
+    """yield a list of segments for each consecutive run of the same videoId"""
+    for _, video_segments in itertools.groupby(segments, key=itemgetter("videoId")):
+        yield list(video_segments)
+
+
+def chunk_videos(videos, max_segments):
+    """yield whole videos grouped into chunks of about max_segments segments"""
+    chunk = []
+    for video_segments in videos:
+        if chunk and len(chunk) + len(video_segments) > max_segments:
+            yield chunk
+            chunk = []
+        chunk.extend(video_segments)
+    if chunk:
+        yield chunk
+
+
+def map_videos(fn, videos, executor, max_pending):
+    """
+    call fn on the executor for each item of videos, at most max_pending at a time,
+    and yield the results in completion order
+    """
+    pending = set()
+    for video_segments in videos:
+        pending.add(executor.submit(fn, video_segments))
+        if len(pending) >= max_pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+    for future in list(pending):
+        yield future.result()
+
+
+class SegmentWriter:
+    """write segments to a .jsonl file, one flushed run per video"""
+
+    def __init__(self, filename):
+        """open the file for writing, an existing file is truncated"""
+        self.filename = filename
+        self.file = open(filename, "w", encoding="utf-8")
+        self.count = 0
+
+    def write_run(self, segments):
+        """write the segments of one video sorted by start time"""
+        for segment in sorted(segments, key=sort_key):
+            self.file.write(json.dumps(segment, ensure_ascii=False) + "\n")
+        self.file.flush()
+        self.count += len(segments)
+
+    def close(self):
+        """close the file"""
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class Run:
+    """the byte range of a sorted run and the sort keys of its lines, stored compactly"""
+
+    def __init__(self, start, video_ids):
+        """an empty run at byte offset start, video_ids is shared by the runs of a file"""
+        self.start = self.end = start
+        self.video_ids = video_ids
+        self.videos = array("l")
+        self.seconds = array("d")
+
+
+def find_runs(f):
+    """
+    return the sorted runs of an open binary .jsonl file, every line is parsed once
+    and its key kept for the merge
+    """
+    video_ids = []
+    video_numbers = {}
+    runs = [Run(0, video_ids)]
+    previous = None
+    for line in f:
+        if line.strip():
+            key = sort_key(json.loads(line))
+            if previous is not None and key < previous:
+                runs.append(Run(runs[-1].end, video_ids))
+            previous = key
+            if key[0] not in video_numbers:
+                video_numbers[key[0]] = len(video_ids)
+                video_ids.append(key[0])
+            runs[-1].videos.append(video_numbers[key[0]])
+            runs[-1].seconds.append(key[1])
+        runs[-1].end += len(line)
+    return [run for run in runs if run.end > run.start]
+
+
+def read_run(f, run):
+    """yield the (key, line) pairs of one run, seeking the shared file handle on every read"""
+    offset = run.start
+    keys = zip(run.videos, run.seconds)
+    while offset < run.end:
+        f.seek(offset)
+        line = f.readline()
+        offset += len(line)
+        if line.strip():
+            video, seconds = next(keys)
+            yield (run.video_ids[video], seconds), line
+
+
+def sort_runs(filename, output_file=None):
+    """
+    sort a .jsonl file by (videoId, seconds) with a k-way merge of its sorted runs,
+    repeated segments are dropped. the result replaces output_file, or the file itself.
+    returns the number of dropped segments.
+    """
+    output_file = output_file or filename
+    dropped = 0
+    with open(filename, "rb") as f:
+        runs = find_runs(f)
+        if len(runs) <= 1 and output_file == filename:
+            return dropped
+
+        # the runs share one file handle, only one line per run is held in memory
+        merged = heapq.merge(*(read_run(f, run) for run in runs), key=itemgetter(0))
+        previous = None
+        with open(output_file + ".tmp", "wb") as out:
+            for key, line in merged:
+                if key != previous:
+                    out.write(line)
+                else:
+                    dropped += 1
+                    logger.debug("Dropped repeated segment %s at %s seconds", *key)
+                previous = key
+
+    os.replace(output_file + ".tmp", output_file)
+    if dropped:
+        logger.warning("Dropped %d repeated segments sorting %s", dropped, filename)
+    return dropped
@@ -0,0 +1,79 @@
+""" Persistent cache of the speakers extracted for each video across runs."""
+
+import hashlib
+import sqlite3
+import threading
+import time
+
+
+def prompt_key(model: str, prompt: str) -> str:
+    """hash the model and the speaker prompt, the title, description and opening minutes"""
+    return hashlib.sha256(f"{model}\0{prompt}".encode("utf-8")).hexdigest()
+
+
+class SpeakerCache:
+    """thread safe SQLite cache of the speakers of each video
+
+    A video keeps one entry, the speakers extracted from the latest prompt.
+    The entry is only reused while the hash of the prompt is unchanged, so a
+    new title, description or transcript opening extracts the speakers again.
+    Empty answers are not cached, a video without speakers is asked again on
+    the next run.
+    """
+
+    def __init__(self, path: str):
+        """open or create the cache database"""
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS speakers (
+                video_id TEXT PRIMARY KEY,
+                prompt_hash TEXT NOT NULL,
+                speakers TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            )"""
+        )
+        self.db.commit()
+
+    def get(self, video_id: str, model: str, prompt: str):
+        """return the cached speakers of a video or None when its prompt changed"""
+        with self.lock:
+            row = self.db.execute(
+                # caches written before empty answers were skipped can hold them
+                "SELECT speakers FROM speakers "
+                "WHERE video_id = ? AND prompt_hash = ? AND speakers != ''",
+                (video_id, prompt_key(model, prompt)),
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return row[0]
+
+    def put(self, video_id: str, model: str, prompt: str, speakers: str):
+        """store the speakers extracted from a prompt, an empty answer is not stored"""
+        if not speakers:
+            return
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO speakers VALUES (?, ?, ?, ?)",
+                (video_id, prompt_key(model, prompt), speakers, time.time()),
+            )
+            self.db.commit()
+
+    def stats(self):
+        """return the cache statistics"""
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+    def close(self):
+        """close the cache database"""
+        with self.lock:
+            self.db.commit()
+            self.db.close()
@@ -0,0 +1,289 @@
+""" Local stub of the Azure OpenAI REST API used to benchmark and test the enrichment scripts offline."""
+
+import argparse
+import hashlib
+import json
+import logging
+import math
+import random
+import re
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logging.basicConfig(level=logging.WARNING)
+logger = logging.getLogger(__name__)
+
+EMBEDDING_DIMENSIONS = 1536
+QUOTA_WINDOW_SECONDS = 60.0
+BATCH_VIDEO_ID = re.compile(r"Video (\S+):")
+# completions are cut off at max_tokens, JSON arguments and ids average about 3 characters a token
+COMPLETION_CHARS_PER_TOKEN = 3
+
+
+def fake_embedding(text: str, dimensions: int = EMBEDDING_DIMENSIONS):
+    """generate a deterministic pseudo random unit vector for a text"""
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    rng = random.Random(seed)
+    vector = [rng.uniform(-1.0, 1.0) for _ in range(dimensions)]
+    norm = sum(x * x for x in vector) ** 0.5
+    return [x / norm for x in vector]
+
+
+class Quota:
+    """sliding window tokens and requests per minute quota, like an Azure OpenAI deployment"""
+
+    def __init__(self, tpm=None, rpm=None, window=QUOTA_WINDOW_SECONDS):
+        """initialize the quota, None means unlimited"""
+        self.tpm = tpm
+        self.rpm = rpm
+        self.window = window
+        self.usage = deque()
+        self.tokens = 0
+        self.throttled = 0
+        self.lock = threading.Lock()
+
+    def consume(self, tokens):
+        """
+        charge a request, returns (allowed, headers) with the remaining quota
+        or the retry-after hint of a throttled request
+        """
+        with self.lock:
+            now = time.monotonic()
+            while self.usage and self.usage[0][0] <= now - self.window:
+                self.tokens -= self.usage.popleft()[1]
+
+            over_requests = self.rpm is not None and len(self.usage) + 1 > self.rpm
+            over_tokens = self.tpm is not None and self.tokens + tokens > self.tpm
+            if (over_requests or over_tokens) and self.usage:
+                self.throttled += 1
+                retry_after = self.usage[0][0] + self.window - now
+                return False, {
+                    "Retry-After": str(math.ceil(retry_after)),
+                    "retry-after-ms": str(int(retry_after * 1000)),
+                }
+
+            self.usage.append((now, tokens))
+            self.tokens += tokens
+            headers = {}
+            if self.rpm is not None:
+                headers["x-ratelimit-remaining-requests"] = str(self.rpm - len(self.usage))
+            if self.tpm is not None:
+                headers["x-ratelimit-remaining-tokens"] = str(max(0, self.tpm - self.tokens))
+            return True, headers
+
+
+def request_tokens(body):
+    """tokens charged against the quota, a word is one token and max_tokens is reserved"""
+    texts = body.get("input", [])
+    texts = [texts] if isinstance(texts, str) else list(texts)
+    texts += [message.get("content") or "" for message in body.get("messages", [])]
+    return sum(len(text.split()) for text in texts) + body.get("max_tokens", 0)
+
+
+def completion_tokens(text):
+    """tokens of a completion text"""
+    return math.ceil(len(text) / COMPLETION_CHARS_PER_TOKEN)
+
+
+def truncate_completion(message, max_tokens):
+    """cut the content or the function arguments of a message at max_tokens, returns the finish reason"""
+    function_call = message.get("function_call")
+    text = function_call["arguments"] if function_call else message.get("content") or ""
+    if max_tokens is None or completion_tokens(text) <= max_tokens:
+        return "stop"
+
+    text = text[: max_tokens * COMPLETION_CHARS_PER_TOKEN]
+    if function_call:
+        function_call["arguments"] = text
+    else:
+        message["content"] = text
+    return "length"
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """handle the Azure OpenAI REST requests"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        """route the request log through the module logger"""
+        logger.debug(format, *args)
+
+    def _send_json(self, status, body, headers=None):
+        """send a json response"""
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _read_json(self):
+        """read the json request body"""
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """dispatch a POST request by path"""
+        body = self._read_json()
+        path = self.path.split("?")[0]
+
+        allowed, headers = self.server.quota.consume(request_tokens(body))
+        if not allowed:
+            error = {"code": "429", "message": "Requests to the stub have exceeded the quota."}
+            self._send_json(429, {"error": error}, headers)
+            return
+
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        context_tokens = self.server.context_tokens
+        if path.endswith("/chat/completions") and context_tokens and (
+            request_tokens(body) > context_tokens
+        ):
+            error = {
+                "code": "context_length_exceeded",
+                "message": f"This model's maximum context length is {context_tokens} tokens.",
+            }
+            self._send_json(400, {"error": error}, headers)
+            return
+
+        if path.endswith("/embeddings"):
+            self._send_json(200, self.embeddings(body), headers)
+        elif path.endswith("/chat/completions"):
+            self._send_json(200, self.chat_completions(body), headers)
+        else:
+            self._send_json(404, {"error": {"message": f"Unknown path {path}"}})
+
+    def embeddings(self, body):
+        """return a fake embedding for every input"""
+        texts = body.get("input", [])
+        if isinstance(texts, str):
+            texts = [texts]
+
+        self.server.requests += 1
+        tokens = request_tokens(body)
+        return {
+            "object": "list",
+            "data": [
+                {"object": "embedding", "index": i, "embedding": fake_embedding(text)}
+                for i, text in enumerate(texts)
+            ],
+            "model": "text-embedding-ada-002",
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        }
+
+    def chat_completions(self, body):
+        """return a canned completion, or a function call when one is forced"""
+        messages = body.get("messages", [])
+        text = messages[-1].get("content", "") if messages else ""
+
+        self.server.requests += 1
+        message = {"role": "assistant", "content": " ".join(text.split()[:60])}
+
+        function_call = body.get("function_call")
+        if isinstance(function_call, dict) and function_call["name"] == "get_speaker_names":
+            # answer every "Video <videoId>:" of a batch, but drop some like a model can
+            videos = [
+                {"videoId": video_id, "speakers": "Stub Speaker, Second Stub Speaker"}
+                for video_id in BATCH_VIDEO_ID.findall(text)
+                if hashlib.sha256(video_id.encode("utf-8")).digest()[0] >= self.server.batch_drop * 256
+            ]
+            message = {
+                "role": "assistant",
+                "content": None,
+                "function_call": {
+                    "name": function_call["name"],
+                    "arguments": json.dumps({"videos": videos}, indent=2),
+                },
+            }
+        elif isinstance(function_call, dict):
+            message = {
+                "role": "assistant",
+                "content": None,
+                "function_call": {
+                    "name": function_call["name"],
+                    "arguments": json.dumps({"speakers": "Stub Speaker"}),
+                },
+            }
+
+        finish_reason = truncate_completion(message, body.get("max_tokens"))
+        prompt_tokens = request_tokens(body) - body.get("max_tokens", 0)
+        completion = (message.get("function_call") or {}).get("arguments") or message.get("content")
+        output_tokens = completion_tokens(completion or "")
+        return {
+            "object": "chat.completion",
+            "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": output_tokens,
+                "total_tokens": prompt_tokens + output_tokens,
+            },
+        }
+
+
+def start_stub_server(
+    host="127.0.0.1", port=0, latency=0.0, tpm=None, rpm=None, window=None, batch_drop=0.0,
+    context_tokens=None
+):
+    """
+    start the stub server on a background thread and return it with its base url.
+    tpm and rpm simulate a deployment quota, requests over it get a 429 with a retry-after hint.
+    batch_drop is the fraction of the videos left out of the batch speaker answers.
+    chat requests over context_tokens, prompt and max_tokens, are rejected like an overlong prompt.
+    chat completions longer than max_tokens are cut off with the finish reason "length".
+    """
+    server = ThreadingHTTPServer((host, port), StubHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.batch_drop = batch_drop
+    server.context_tokens = context_tokens
+    server.requests = 0
+    server.quota = Quota(tpm, rpm, window or QUOTA_WINDOW_SECONDS)
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    base_url = f"http://{server.server_address[0]}:{server.server_address[1]}"
+    return server, base_url
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("-p", "--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--tpm", type=int, help="simulated tokens per minute quota")
+    parser.add_argument("--rpm", type=int, help="simulated requests per minute quota")
+    parser.add_argument(
+        "--window", type=float, default=QUOTA_WINDOW_SECONDS, help="quota window in seconds"
+    )
+    parser.add_argument(
+        "--batch-drop", type=float, default=0.0, help="fraction of batch speakers left out"
+    )
+    parser.add_argument("--context-tokens", type=int, help="simulated model context length")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    if args.verbose:
+        logger.setLevel(logging.DEBUG)
+
+    stub, url = start_stub_server(
+        args.host,
+        args.port,
+        args.latency,
+        args.tpm,
+        args.rpm,
+        args.window,
+        args.batch_drop,
+        args.context_tokens,
+    )
+    print(f"Stub Azure OpenAI server listening on {url}")
+
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        stub.shutdown()
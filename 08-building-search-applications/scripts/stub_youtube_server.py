@@ -0,0 +1,182 @@
+""" Local stub of the YouTube Data API playlist items and the YouTube watch and caption pages,
+used to benchmark and test transcript_download.py offline."""
+
+import argparse
+import base64
+import hashlib
+import json
+import logging
+import threading
+import time
+from html import escape
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import youtube_transcript_api._transcripts
+
+logging.basicConfig(level=logging.WARNING)
+logger = logging.getLogger(__name__)
+
+CAPTION_LINES = 200
+
+
+def video_id(index):
+    """video id of the index-th video of the stub playlist"""
+    return f"stubvid{index:05d}"
+
+
+def etag(resource):
+    """etag of an api resource"""
+    digest = hashlib.sha1(json.dumps(resource, sort_keys=True).encode("utf-8")).digest()
+    return base64.urlsafe_b64encode(digest).decode("ascii").rstrip("=")
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """handle the playlistItems, watch and timedtext requests"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        """route the request log through the module logger"""
+        logger.debug(format, *args)
+
+    def setup(self):
+        """simulate the TCP and TLS handshake of a new connection"""
+        super().setup()
+        self.server.connections += 1
+        if self.server.connect_latency:
+            time.sleep(self.server.connect_latency)
+
+    def _send(self, status, payload, content_type):
+        """send a response"""
+        payload = payload.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """dispatch a GET request by path"""
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        self.server.requests += 1
+        if url.path.endswith("/playlistItems"):
+            page = self.playlist_items(query)
+            if self.headers.get("If-None-Match") == page["etag"]:
+                self.server.not_modified += 1
+                self._send(304, "", "application/json")
+            else:
+                self._send(200, json.dumps(page), "application/json")
+        elif url.path == "/watch":
+            self._send(200, self.watch(query["v"]), "text/html")
+        elif url.path == "/api/timedtext":
+            self._send(200, self.timedtext(query["v"]), "text/xml")
+        else:
+            self._send(404, "Not found", "text/plain")
+
+    def playlist_items(self, query):
+        """one page of the playlist, the page token is the offset of the page"""
+        playlist = self.server.playlist
+        start = int(query.get("pageToken", 0))
+        end = min(len(playlist), start + int(query.get("maxResults", 5)))
+        items = []
+        for video, title in playlist[start:end]:
+            snippet = {
+                "playlistId": query.get("playlistId"),
+                "title": title,
+                "description": f"Description of {title}",
+                "resourceId": {"kind": "youtube#video", "videoId": video},
+            }
+            items.append({"etag": etag(snippet), "snippet": snippet})
+
+        page = {"kind": "youtube#playlistItemListResponse", "items": items}
+        if end < len(playlist):
+            page["nextPageToken"] = str(end)
+        page["etag"] = etag(page)
+        return page
+
+    def watch(self, video):
+        """watch page holding the caption tracks like youtube.com does"""
+        captions = {
+            "playerCaptionsTracklistRenderer": {
+                "captionTracks": [
+                    {
+                        "baseUrl": f"{self.server.base_url}/api/timedtext?v={video}",
+                        "name": {"simpleText": "English (auto-generated)"},
+                        "languageCode": "en",
+                        "kind": "asr",
+                    }
+                ]
+            }
+        }
+        return (
+            f'<html><script>var ytInitialPlayerResponse = {{"playabilityStatus":{{}},'
+            f'"captions":{escape(json.dumps(captions))},"videoDetails":{{"videoId":"{video}"}}}};'
+            f"</script></html>"
+        )
+
+    def timedtext(self, video):
+        """caption track xml"""
+        lines = [
+            f'<text start="{line * 2.0}" dur="2.0">{video} caption line {line}</text>'
+            for line in range(self.server.caption_lines)
+        ]
+        return '<?xml version="1.0" encoding="utf-8" ?><transcript>' + "".join(lines) + "</transcript>"
+
+
+def start_stub_server(
+    host="127.0.0.1", port=0, videos=1000, latency=0.0, connect_latency=0.0,
+    caption_lines=CAPTION_LINES
+):
+    """
+    start the stub server on a background thread and return it with its base url.
+    connect_latency is added once per connection, like the handshake of a new https connection.
+    server.playlist is the list of (video id, title) of the playlist, it can be edited between runs.
+    """
+    server = ThreadingHTTPServer((host, port), StubHandler)
+    server.daemon_threads = True
+    server.playlist = [(video_id(i), f"Stub video {i}") for i in range(videos)]
+    server.latency = latency
+    server.connect_latency = connect_latency
+    server.caption_lines = caption_lines
+    server.requests = 0
+    server.not_modified = 0
+    server.connections = 0
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    server.base_url = f"http://{server.server_address[0]}:{server.server_address[1]}"
+    return server, server.base_url
+
+
+def use_stub_server(base_url):
+    """point youtube_transcript_api at the stub, returns client_options for the YouTube client"""
+    youtube_transcript_api._transcripts.WATCH_URL = base_url + "/watch?v={video_id}"
+    return {"api_endpoint": base_url + "/"}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("-p", "--port", type=int, default=8081)
+    parser.add_argument("-n", "--videos", type=int, default=1000)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--connect-latency", type=float, default=0.1)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    if args.verbose:
+        logger.setLevel(logging.DEBUG)
+
+    stub, url = start_stub_server(
+        args.host, args.port, args.videos, args.latency, args.connect_latency
+    )
+    print(f"Stub YouTube server listening on {url}")
+
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        stub.shutdown()
@@ -0,0 +1,155 @@
+""" Shared token counting for the transcript_* scripts.
+
+The cl100k_base encoding (gpt-3.5-turbo and text-embedding-ada-002) is loaded
+once per process. Counts are memoized by text hash in a bounded LRU, cache
+misses are encoded together with `encode_batch` across threads, and `fits`
+answers "is this text at most N tokens?" without always encoding all of it.
+"""
+
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+import tiktoken
+
+ENCODING_NAME = "cl100k_base"
+CACHE_SIZE = 100000
+BATCH_THREADS = 8
+# fits() encodes long texts in chunks of about this many characters
+FITS_CHUNK_CHARS = 4096
+WHITESPACE = re.compile(r"\s")
+
+_encoding = None
+_encoding_lock = threading.Lock()
+_counter = None
+_counter_lock = threading.Lock()
+
+
+def get_encoding():
+    """load the encoding once per process"""
+    global _encoding
+    with _encoding_lock:
+        if _encoding is None:
+            _encoding = tiktoken.get_encoding(ENCODING_NAME)
+        return _encoding
+
+
+def text_hash(text):
+    """memoization key of a text"""
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+
+def text_chunks(text, size):
+    """split text into chunks of about size characters, breaking before whitespace"""
+    start = 0
+    while start < len(text):
+        end = start + size
+        if end < len(text):
+            match = WHITESPACE.search(text, end)
+            end = match.start() if match else len(text)
+        yield text[start:end]
+        start = end
+
+
+class TokenCounter:
+    """thread safe token counter with a bounded LRU of counts"""
+
+    def __init__(self, encoding=None, cache_size=CACHE_SIZE, num_threads=BATCH_THREADS):
+        """create the counter, the shared encoding is used by default"""
+        self.encoding = encoding or get_encoding()
+        self.cache_size = cache_size
+        self.num_threads = num_threads
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _lookup(self, key):
+        """return the cached count or None"""
+        with self.lock:
+            count = self.cache.get(key)
+            if count is None:
+                self.misses += 1
+                return None
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return count
+
+    def _store(self, key, count):
+        """cache a count, evicting the least recently used"""
+        with self.lock:
+            self.cache[key] = count
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def count(self, text):
+        """number of tokens in text"""
+        key = text_hash(text)
+        count = self._lookup(key)
+        if count is None:
+            count = len(self.encoding.encode(text))
+            self._store(key, count)
+        return count
+
+    def count_batch(self, texts):
+        """number of tokens of each text, the uncached texts are encoded in one batch"""
+        keys = [text_hash(text) for text in texts]
+        counts = [self._lookup(key) for key in keys]
+
+        missing = [i for i, count in enumerate(counts) if count is None]
+        if missing:
+            encoded = self.encoding.encode_batch(
+                [texts[i] for i in missing], num_threads=self.num_threads
+            )
+            for i, tokens in zip(missing, encoded):
+                counts[i] = len(tokens)
+                self._store(keys[i], counts[i])
+
+        return counts
+
+    def fits(self, text, max_tokens):
+        """True if text has at most max_tokens tokens, encoding stops once the limit is passed"""
+        # a token is at least one byte
+        if len(text.encode("utf-8")) <= max_tokens:
+            return True
+
+        count = self._lookup(text_hash(text))
+        if count is not None:
+            return count <= max_tokens
+
+        total = 0
+        for chunk in text_chunks(text, FITS_CHUNK_CHARS):
+            total += len(self.encoding.encode(chunk))
+            if total > max_tokens:
+                return False
+        return True
+
+    def stats(self):
+        """cache hits, misses and size"""
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self.cache)}
+
+
+def default_counter():
+    """the token counter shared by the scripts of this process"""
+    global _counter
+    with _counter_lock:
+        if _counter is None:
+            _counter = TokenCounter()
+        return _counter
+
+
+def count_tokens(text):
+    """number of tokens in text"""
+    return default_counter().count(text)
+
+
+def count_tokens_batch(texts):
+    """number of tokens of each text"""
+    return default_counter().count_batch(texts)
+
+
+def fits(text, max_tokens):
+    """True if text has at most max_tokens tokens"""
+    return default_counter().fits(text, max_tokens)
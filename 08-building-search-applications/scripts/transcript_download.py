@@ -1,22 +1,41 @@
-""" This script downloads the transcripts for all the videos in a YouTube playlist. """
+""" This script downloads the transcripts for all the videos in a YouTube playlist.
+
+The playlist pages are listed while the transcripts download. The downloads
+are blocking requests calls, an asyncio loop only keeps up to --concurrency of
+them in flight on a thread pool. With youtube-transcript-api 1.x every download
+shares one keep-alive connection pool, the 0.6 releases open a new session for
+every video and have no public way to pass one. Files are written to a
+temporary file and renamed, so an interrupted run never leaves a partial
+transcript behind.
+
+A SQLite manifest in the transcript folder records the etag of every playlist
+page and item. Reruns ask for the pages with If-None-Match, fetch only new
+videos and failed downloads, rewrite the metadata of the videos whose title or
+description changed, and delete the videos removed from the playlist.
+"""
 
 import os
 import json
 import logging
 import time
-import threading
 import argparse
-import queue
+import asyncio
+import inspect
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 import googleapiclient.discovery
 import googleapiclient.errors
+import requests
 from youtube_transcript_api import YouTubeTranscriptApi
 from youtube_transcript_api.formatters import WebVTTFormatter
+from atomic_file import write_json
+from caption_store import caption_file, transcript_file
+from download_manifest import Manifest, file_hash
 
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-GOOGLE_DEVELOPER_API_KEY = os.environ["GOOGLE_DEVELOPER_API_KEY"]
 TRANSCRIPT_FOLDER = "transcripts"
 
 # Initialize the Google developer API client
@@ -25,52 +44,36 @@ GOOGLE_API_VERSION = "v3"
 
 MAX_RESULTS = 50
 PROCESSING_THREADS = 40
+LANGUAGES = ["en"]
+MAX_CONNECTION_RETRIES = 2
+# videos without a transcript are retried after this many seconds
+RETRY_FAILED_SECONDS = 24 * 60 * 60
+MANIFEST_FILE = "download_manifest.sqlite"
 
 formatter = WebVTTFormatter()
-q = queue.Queue()
+# youtube-transcript-api 1.x is instantiated with a requests session, 0.6 only has classmethods
+SHARED_SESSION = "http_client" in inspect.signature(YouTubeTranscriptApi).parameters
 
-parser = argparse.ArgumentParser()
-parser.add_argument("-f", "--folder")
-parser.add_argument("-p", "--playlist")
-parser.add_argument("--verbose", action="store_true")
-args = parser.parse_args()
-if args.verbose:
-    logger.setLevel(logging.DEBUG)
+# sentinel passed down the queue when the playlist has been listed
+DONE = object()
 
-TRANSCRIPT_FOLDER = args.folder if args.folder else None
-PLAYLIST_ID = args.playlist if args.playlist else None
 
-if not TRANSCRIPT_FOLDER:
-    logger.error("Transcript folder not provided")
-    exit(1)
-
-if not PLAYLIST_ID:
-    logger.error("Playlist ID not provided")
-    exit(1)
-
-
-class Counter:
-    """thread safe counter"""
-
-    def __init__(self):
-        """initialize the counter"""
-        self.value = 0
-        self.lock = threading.Lock()
-
-    def increment(self):
-        """increment the counter"""
-        with self.lock:
-            self.value += 1
-
-
-counter = Counter()
+def create_session(pool_size=PROCESSING_THREADS):
+    """requests session with a keep-alive connection pool shared by the downloads"""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_maxsize=pool_size, max_retries=MAX_CONNECTION_RETRIES
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
 
 
-def gen_metadata(playlist_item):
+def gen_metadata(playlist_item, folder=None):
     """Generate metadata for a video"""
 
     video_id = playlist_item["snippet"]["resourceId"]["videoId"]
-    filename = os.path.join(TRANSCRIPT_FOLDER, video_id + ".json")
+    filename = os.path.join(folder or TRANSCRIPT_FOLDER, video_id + ".json")
 
     metadata = {}
     metadata["speaker"] = ""
@@ -78,32 +81,48 @@ def gen_metadata(playlist_item):
     metadata["videoId"] = playlist_item["snippet"]["resourceId"]["videoId"]
     metadata["description"] = playlist_item["snippet"]["description"]
 
+    # keep the extracted speaker when the metadata is refreshed but the text it came from is unchanged
+    if os.path.exists(filename):
+        with open(filename, "r", encoding="utf-8") as json_file:
+            previous = json.load(json_file)
+        if (previous.get("title"), previous.get("description")) == (
+            metadata["title"],
+            metadata["description"],
+        ):
+            metadata["speaker"] = previous.get("speaker", "")
+
     # save the metadata as a .json file
-    json.dump(metadata, open(filename, "w", encoding="utf-8"))
+    write_json(filename, metadata)
+
+
+def fetch_transcript(video_id, session=None):
+    """Fetch the english transcript of a video as a list of {"text", "start", "duration"} dicts"""
+    if SHARED_SESSION:
+        api = YouTubeTranscriptApi(http_client=session or create_session(1))
+        return api.list(video_id).find_transcript(LANGUAGES).fetch().to_raw_data()
+    return YouTubeTranscriptApi.list_transcripts(video_id).find_transcript(LANGUAGES).fetch()
 
 
-def get_transcript(playlist_item, counter_id):
+def get_transcript(playlist_item, counter_id, folder=None, session=None):
     """Get the transcript for a video"""
 
     video_id = playlist_item["snippet"]["resourceId"]["videoId"]
-    filename = os.path.join(TRANSCRIPT_FOLDER, video_id + ".json.vtt")
+    filename = os.path.join(folder or TRANSCRIPT_FOLDER, video_id + ".json.vtt")
 
-    # if video transcript already exists, skip it
-    if os.path.exists(filename):
+    # if video transcript and metadata already exist, skip it
+    if transcript_file(filename) and os.path.exists(filename[: -len(".vtt")]):
         logger.debug("Skipping video %d, %s", counter_id, video_id)
         return False
 
     try:
-        transcript = YouTubeTranscriptApi.get_transcript(video_id)
+        transcript = fetch_transcript(video_id, session)
         # remove \n from the text
         for item in transcript:
             item["text"] = item["text"].replace("\n", " ")
 
         logger.debug("Transcription download completed: %d, %s", counter_id, video_id)
         # save the transcript as a .vtt file
-        with open(filename, "w", encoding="utf-8") as file:
-            json.dump(transcript, file, indent=4, ensure_ascii=False)
-            # file.write(transcript)
+        write_json(filename, transcript, indent=4, ensure_ascii=False)
 
     except Exception as exception:
         logger.debug(exception)
@@ -113,69 +132,225 @@ def get_transcript(playlist_item, counter_id):
     return True
 
 
-def process_queue():
-    """process the queue"""
-    while not q.empty():
-        video = q.get()
-
-        counter.increment()
-
-        if get_transcript(video, counter.value):
-            gen_metadata(video)
-        q.task_done()
-
-
-logger.debug("Transcription folder: %s", TRANSCRIPT_FOLDER)
+def download_video(playlist_item, counter_id, folder=None, session=None, manifest=None):
+    """
+    Download the transcript and metadata of a video. Returns "downloaded", "refreshed"
+    when only the metadata was rewritten, "skipped" or "failed".
+    """
+    folder = folder or TRANSCRIPT_FOLDER
+    video_id = playlist_item["snippet"]["resourceId"]["videoId"]
+    playlist_id = playlist_item["snippet"].get("playlistId")
+    etag = playlist_item.get("etag")
+    filename = os.path.join(folder, video_id + ".json.vtt")
+    record = manifest.get_video(video_id) if manifest else None
+
+    if transcript_file(filename) and os.path.exists(filename[: -len(".vtt")]):
+        if manifest is None or (record and record[0] == etag and record[1]):
+            return "skipped"
+        # the title or description changed, or the video was downloaded before the manifest
+        gen_metadata(playlist_item, folder)
+        manifest.put_video(video_id, playlist_id, etag, file_hash(transcript_file(filename)))
+        return "refreshed"
+
+    # videos without a transcript are retried once in a while, captions can be added later
+    if record and record[1] is None and time.time() - record[2] < RETRY_FAILED_SECONDS:
+        return "skipped"
+
+    if not get_transcript(playlist_item, counter_id, folder, session):
+        if manifest:
+            manifest.put_video(video_id, playlist_id, etag, None)
+        return "failed"
+
+    gen_metadata(playlist_item, folder)
+    if manifest:
+        manifest.put_video(video_id, playlist_id, etag, file_hash(filename))
+    return "downloaded"
+
+
+def list_playlist_pages(youtube, playlist_id, manifest=None):
+    """
+    Yield the items of a playlist a page at a time, one page request at a time.
+    With a manifest the stored pages are requested with If-None-Match and reused on a 304.
+    """
+
+    page_tokens = []
+    page_token = None
+
+    # Loop through the pages of results until there is no next page token
+    while True:
+        # Create a request object with the playlist ID, the max results and the page token
+        request = youtube.playlistItems().list(
+            part="snippet",
+            playlistId=playlist_id,
+            maxResults=MAX_RESULTS,
+            **({"pageToken": page_token} if page_token else {}),
+        )
+        stored = manifest.get_page(playlist_id, page_token) if manifest else None
+        if stored:
+            request.headers["If-None-Match"] = stored[0]
+
+        # Execute the request and get the response
+        try:
+            response = request.execute()
+        except googleapiclient.errors.HttpError as error:
+            if stored is None or error.resp.status != 304:
+                raise
+            manifest.page_not_modified()
+            items, next_page_token = stored[1], stored[2]
+        else:
+            items, next_page_token = response["items"], response.get("nextPageToken")
+            if manifest:
+                manifest.put_page(
+                    playlist_id, page_token, response["etag"], items, next_page_token
+                )
+
+        page_tokens.append(page_token)
+        yield items
+
+        # Get the next page token from the response
+        page_token = next_page_token
+        if not page_token:
+            break
+
+    # the playlist got shorter, forget the pages past its end
+    if manifest:
+        manifest.remove_pages(playlist_id, page_tokens)
+
+
+def list_playlist_items(youtube, playlist_id, manifest=None):
+    """Yield every item of a playlist, one page request at a time"""
+    for page in list_playlist_pages(youtube, playlist_id, manifest):
+        yield from page
+
+
+def prune_videos(manifest, playlist_id, video_ids, folder=None):
+    """remove the files of the recorded videos that are no longer in the playlist"""
+    removed = manifest.video_ids(playlist_id) - set(video_ids)
+    for video_id in removed:
+        filename = os.path.join(folder or TRANSCRIPT_FOLDER, video_id + ".json")
+        for name in [filename, filename + ".vtt", caption_file(filename + ".vtt")]:
+            if os.path.exists(name):
+                os.remove(name)
+        logger.debug("Removed video %s", video_id)
+    manifest.remove_videos(removed)
+    return removed
+
+
+async def download_playlist(
+    youtube, playlist_id, folder=None, concurrency=PROCESSING_THREADS, manifest=None
+):
+    """
+    Download the transcripts of a playlist with up to concurrency downloads in flight,
+    the next page is listed while the previous ones download. With a manifest only new,
+    changed and failed videos are fetched and removed videos are pruned.
+    Returns the number of videos listed and of each download_video result.
+    """
+    loop = asyncio.get_running_loop()
+    session = create_session(concurrency)
+    items = asyncio.Queue(maxsize=MAX_RESULTS + concurrency)
+    counts = Counter()
+    seen = set()
+
+    async def source(executor):
+        """list the playlist pages on the thread pool and queue the new videos"""
+        pages = list_playlist_pages(youtube, playlist_id, manifest)
+        while (page := await loop.run_in_executor(executor, next, pages, DONE)) is not DONE:
+            for item in page:
+                # a playlist can hold a video twice, download it once
+                video_id = item["snippet"]["resourceId"]["videoId"]
+                if video_id not in seen:
+                    seen.add(video_id)
+                    counts["listed"] += 1
+                    await items.put((counts["listed"], item))
+        await items.put(DONE)
+
+    async def worker(executor):
+        """download the queued videos until the playlist is exhausted"""
+        while (entry := await items.get()) is not DONE:
+            counter_id, item = entry
+            counts[
+                await loop.run_in_executor(
+                    executor, download_video, item, counter_id, folder, session, manifest
+                )
+            ] += 1
+        # hand the sentinel on to the next worker
+        await items.put(DONE)
+
+    with ThreadPoolExecutor(max_workers=concurrency + 1) as executor:
+        await asyncio.gather(source(executor), *[worker(executor) for _ in range(concurrency)])
+    session.close()
+
+    # only prune after the whole playlist was listed
+    if manifest:
+        counts["removed"] = len(prune_videos(manifest, playlist_id, seen, folder))
+
+    return counts
+
+
+def build_youtube_client(client_options=None):
+    """Create the YouTube Data API client"""
+    return googleapiclient.discovery.build(
+        GOOGLE_API_SERVICE_NAME,
+        GOOGLE_API_VERSION,
+        developerKey=os.environ["GOOGLE_DEVELOPER_API_KEY"],
+        client_options=client_options,
+    )
 
-youtube = googleapiclient.discovery.build(
-    GOOGLE_API_SERVICE_NAME, GOOGLE_API_VERSION, developerKey=GOOGLE_DEVELOPER_API_KEY
-)
 
-# Create a request object with the playlist ID and the max results
-request = youtube.playlistItems().list(
-    part="snippet", playlistId=PLAYLIST_ID, maxResults=MAX_RESULTS
-)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-f", "--folder")
+    parser.add_argument("-p", "--playlist")
+    parser.add_argument(
+        "-c", "--concurrency", type=int, default=PROCESSING_THREADS, help="downloads in flight"
+    )
+    parser.add_argument("--manifest", help="manifest database, in the folder by default")
+    parser.add_argument("--no-manifest", action="store_true", help="list and check everything")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    if args.verbose:
+        logger.setLevel(logging.DEBUG)
 
+    TRANSCRIPT_FOLDER = args.folder if args.folder else None
+    PLAYLIST_ID = args.playlist if args.playlist else None
 
-# Loop through the pages of results until there is no next page token
-while request:
-    # Execute the request and get the response
-    response = request.execute()
+    if not TRANSCRIPT_FOLDER:
+        logger.error("Transcript folder not provided")
+        exit(1)
 
-    # Iterate over the items in the response and append the video IDs to the list
-    for item in response["items"]:
-        q.put(item)
+    if not PLAYLIST_ID:
+        logger.error("Playlist ID not provided")
+        exit(1)
 
-    # Get the next page token from the response and create a new request object
-    next_page_token = response.get("nextPageToken")
-    if next_page_token:
-        request = youtube.playlistItems().list(
-            part="snippet",
-            playlistId=PLAYLIST_ID,
-            maxResults=MAX_RESULTS,
-            pageToken=next_page_token,
-        )
-    else:
-        request = None
+    logger.debug("Transcription folder: %s", TRANSCRIPT_FOLDER)
 
-    logger.info("Total transcriptions to be download: %s", q.qsize())
+    youtube = build_youtube_client()
+    manifest = None
+    if not args.no_manifest:
+        manifest = Manifest(args.manifest or os.path.join(TRANSCRIPT_FOLDER, MANIFEST_FILE))
 
-start_time = time.time()
+    start_time = time.time()
 
-# create multiple threads to process the queue
-threads = []
-for i in range(PROCESSING_THREADS):
-    t = threading.Thread(
-        target=process_queue,
-        args=(),
+    counts = asyncio.run(
+        download_playlist(youtube, PLAYLIST_ID, TRANSCRIPT_FOLDER, args.concurrency, manifest)
     )
-    t.start()
-    threads.append(t)
 
-# wait for all threads to finish
-for t in threads:
-    t.join()
-
-
-finish_time = time.time()
-logger.debug("Total time taken: %s", finish_time - start_time)
+    finish_time = time.time()
+    logger.info(
+        "Downloaded %d of %d transcripts, %.1f downloads/sec",
+        counts["downloaded"],
+        counts["listed"],
+        counts["downloaded"] / max(finish_time - start_time, 1e-9),
+    )
+    if manifest:
+        stats = manifest.stats()
+        logger.info(
+            "Pages not modified: %d of %d, metadata refreshed: %d, failed: %d, removed: %d",
+            stats["not_modified"],
+            stats["not_modified"] + stats["modified"],
+            counts["refreshed"],
+            counts["failed"],
+            counts["removed"],
+        )
+        manifest.close()
+    logger.debug("Total time taken: %s", finish_time - start_time)
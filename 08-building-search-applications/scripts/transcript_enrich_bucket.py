@@ -3,14 +3,18 @@
 # from the transcript files, generate a master csv file
 # from the transcript folder read all the .json files then load the associated .vtt file
 
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
+from itertools import repeat
 import glob
 import os
 import json
 import argparse
-import tiktoken
 import logging
 from rich.progress import Progress
+from caption_store import load_captions, transcript_file
+from segment_stream import SegmentWriter, sort_runs
+from token_counter import count_tokens, count_tokens_batch
 
 logging.basicConfig(level=logging.WARNING)
 logger = logging.getLogger(__name__)
@@ -21,28 +25,8 @@ PERCENTAGE_OVERLAP = 0.05
 TRANSCRIPT_FOLDER = "transcripts"
 MAX_TOKENS = 2048
 
-segments = []
 total_files = 0
 
-parser = argparse.ArgumentParser()
-parser.add_argument("-f", "--folder")
-parser.add_argument("-m", "--minutes")
-parser.add_argument("--verbose", action="store_true")
-args = parser.parse_args()
-if args.verbose:
-    logger.setLevel(logging.DEBUG)
-
-TRANSCRIPT_FOLDER = args.folder if args.folder else None
-SEGMENT_LENGTH_MINUTES = int(args.minutes) if args.minutes else SEGMENT_LENGTH_MINUTES
-
-if not TRANSCRIPT_FOLDER:
-    logger.error("Transcript folder not provided")
-    exit(1)
-
-# https://stackoverflow.com/questions/75804599/openai-api-how-do-i-count-tokens-before-i-send-an-api-request
-ENCODING_MODEL = "gpt-3.5-turbo"
-tokenizer = tiktoken.encoding_for_model(ENCODING_MODEL)
-
 
 class VttSegment:
     def __init__(self, segment: dict[str, str | float]) -> None:
@@ -81,7 +65,7 @@ def clean_text(text):
     return text
 
 
-def append_text_to_previous_segment(text):
+def append_text_to_previous_segment(text, segments):
     """
     append PERCENTAGE_OVERLAP text to the previous segment to smooth context transition
     """
@@ -93,7 +77,7 @@ def append_text_to_previous_segment(text):
             segments[-1]["text"] += append_text
 
 
-def add_new_segment(metadata, text, segment_begin_seconds):
+def add_new_segment(metadata, text, segment_begin_seconds, segments):
     """add a new segment to the segments list"""
     # convert the segment_begin_time float to 00:00:00 formatted string
     delta = timedelta(seconds=segment_begin_seconds)
@@ -105,13 +89,18 @@ def add_new_segment(metadata, text, segment_begin_seconds):
     segments.append(metadata.copy())
 
 
-def parse_json_vtt_transcript(vtt, metadata):
-    """parse the json vtt file and return the transcript"""
+def parse_json_vtt_transcript(vtt, metadata, segments, segment_minutes=None):
+    """
+    parse the json vtt file and append the transcript buckets to segments.
+    token counts are kept as running sums so each caption line is encoded once.
+    """
+    segment_minutes = segment_minutes or SEGMENT_LENGTH_MINUTES
     text = ""
     current_seconds = None
     seg_begin_seconds = None
     seg_finish_seconds = None
     current_token_length = 0
+    previous_segment_tokens = 0
     first_segment = True
 
     # add the speaker name to the transcript
@@ -129,100 +118,145 @@ def parse_json_vtt_transcript(vtt, metadata):
         metadata["description"] = clean_text(metadata.get("description"))
         text += metadata.get("description") + ". "
 
-    current_token_length = len(tokenizer.encode(text))
-
-    # open the vtt file
-    with open(vtt, "r", encoding="utf-8") as json_file:
-        json_vtt = json.load(json_file)
-
-        for segment in json_vtt:
-            seg = VttSegment(segment)
-            current_seconds = int(seg.start)
-            current_text = seg.text
-
-            if seg_begin_seconds is None:
-                seg_begin_seconds = current_seconds
-                # calculate the finish time from the segment_begin_time
-                seg_finish_seconds = seg_begin_seconds + SEGMENT_LENGTH_MINUTES * 60
-
-            # Get the number of tokens in the text.
-            # Need to calc to allow for 1024 tokens for 
-            # summary request in next pipeline step
-            total_tokens = len(tokenizer.encode(current_text)) + current_token_length
-
-            if current_seconds < seg_finish_seconds and total_tokens < MAX_TOKENS:
-                # add the text to the transcript
-                text += current_text + " "
-                current_token_length = total_tokens
-            else:
-                if not first_segment:
-                    # append PERCENTAGE_OVERLAP text to the previous segment
-                    # to smooth context transition
-                    append_text_to_previous_segment(text)
-                first_segment = False
-                add_new_segment(metadata, text, seg_begin_seconds)
-
-                text = current_text + " "
-
-                # reset the segment_begin_time
-                seg_begin_seconds = None
-                seg_finish_seconds = None
-
-                current_token_length = len(tokenizer.encode(text))
-
-        # Append the last text segment to the last segment in segments dictionary
-        if seg_begin_seconds and text != "":
-            previous_segment_tokens = len(tokenizer.encode(segments[-1]["text"]))
-            current_segment_tokens = len(tokenizer.encode(text))
-
-            if previous_segment_tokens + current_segment_tokens < MAX_TOKENS:
-                segments[-1]["text"] += text
-            else:
-                if not first_segment:
-                    # append PERCENTAGE_OVERLAP text to the previous segment
-                    # to smooth context transition
-                    append_text_to_previous_segment(text)
-                first_segment = False
-                add_new_segment(metadata, text, seg_begin_seconds)
-
-
-def get_transcript(metadata):
+    # https://stackoverflow.com/questions/75804599/openai-api-how-do-i-count-tokens-before-i-send-an-api-request
+    current_token_length = count_tokens(text)
+
+    # read the caption lines from the .cap or .vtt file
+    json_vtt = load_captions(vtt)
+    # count the tokens of every caption line in one batch
+    line_tokens = count_tokens_batch([segment.get("text") for segment in json_vtt])
+
+    for segment, current_text_tokens in zip(json_vtt, line_tokens):
+        seg = VttSegment(segment)
+        current_seconds = int(seg.start)
+        current_text = seg.text
+
+        if seg_begin_seconds is None:
+            seg_begin_seconds = current_seconds
+            # calculate the finish time from the segment_begin_time
+            seg_finish_seconds = seg_begin_seconds + segment_minutes * 60
+
+        # Get the number of tokens in the text.
+        # Need to calc to allow for 1024 tokens for
+        # summary request in next pipeline step
+        total_tokens = current_text_tokens + current_token_length
+
+        if current_seconds < seg_finish_seconds and total_tokens < MAX_TOKENS:
+            # add the text to the transcript
+            text += current_text + " "
+            current_token_length = total_tokens
+        else:
+            if not first_segment:
+                # append PERCENTAGE_OVERLAP text to the previous segment
+                # to smooth context transition
+                append_text_to_previous_segment(text, segments)
+            first_segment = False
+            add_new_segment(metadata, text, seg_begin_seconds, segments)
+            previous_segment_tokens = current_token_length
+
+            text = current_text + " "
+
+            # reset the segment_begin_time
+            seg_begin_seconds = None
+            seg_finish_seconds = None
+
+            current_token_length = current_text_tokens
+
+    # Append the last text segment to the last segment of this video,
+    # a video without a bucket break becomes a single segment
+    if seg_begin_seconds is not None and text != "":
+        if not first_segment and previous_segment_tokens + current_token_length < MAX_TOKENS:
+            segments[-1]["text"] += text
+        else:
+            if not first_segment:
+                # append PERCENTAGE_OVERLAP text to the previous segment
+                # to smooth context transition
+                append_text_to_previous_segment(text, segments)
+            first_segment = False
+            add_new_segment(metadata, text, seg_begin_seconds, segments)
+
+
+def get_transcript(metadata, segments, folder=None, segment_minutes=None):
     """get the transcript from the .vtt file"""
     global total_files
-    vtt = os.path.join(TRANSCRIPT_FOLDER, metadata["videoId"] + ".json.vtt")
+    vtt = os.path.join(folder or TRANSCRIPT_FOLDER, metadata["videoId"] + ".json.vtt")
 
-    # check that the .vtt file exists
-    if not os.path.exists(vtt):
+    # check that the .vtt or .cap file exists
+    if not transcript_file(vtt):
         logger.info("vtt file does not exist: %s", vtt)
         return None
     else:
         logger.debug("Processing file: %s", vtt)
         total_files += 1
 
-    parse_json_vtt_transcript(vtt, metadata)
-
+    parse_json_vtt_transcript(vtt, metadata, segments, segment_minutes)
 
-logger.debug("Transcription folder: %s", TRANSCRIPT_FOLDER)
-logger.debug("Segment length %d minutes", SEGMENT_LENGTH_MINUTES)
 
-folder = os.path.join(TRANSCRIPT_FOLDER, "*.json")
+def bucket_video(metadata_file, folder=None, segment_minutes=None):
+    """return the transcript buckets for one video"""
+    with open(metadata_file, encoding="utf-8") as f:
+        metadata = json.load(f)
 
-with Progress() as progress:
-    task1 = progress.add_task("[green]Enriching Buckets...", total=total_files)
+    video_segments = []
+    get_transcript(metadata, video_segments, folder, segment_minutes)
+    return video_segments
 
-    for file in glob.glob(folder):
-        # load the json file
-        meta = json.load(open(file, encoding="utf-8"))
 
-        get_transcript(meta)
-        progress.update(task1, advance=1)
-
-
-logger.debug("Total files: %s", total_files)
-logger.debug("Total segments: %s", len(segments))
-
-# save segments to a json file
-
-output_file = os.path.join(TRANSCRIPT_FOLDER, "output", "master_transcriptions.json")
-with open(output_file, "w", encoding="utf-8") as f:
-    json.dump(segments, f, ensure_ascii=False, indent=4)
+def bucket_videos(files, folder=None, segment_minutes=None, workers=1):
+    """
+    yield the transcript buckets of each video in file order,
+    with workers > 1 the videos are sharded across a process pool
+    """
+    if workers <= 1:
+        for file in files:
+            yield bucket_video(file, folder, segment_minutes)
+        return
+
+    chunksize = max(1, min(64, len(files) // (workers * 4)))
+    with ProcessPoolExecutor(workers) as executor:
+        yield from executor.map(
+            bucket_video, files, repeat(folder), repeat(segment_minutes), chunksize=chunksize
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-f", "--folder")
+    parser.add_argument("-m", "--minutes")
+    parser.add_argument(
+        "-w", "--workers", type=int, default=os.cpu_count(), help="bucketing processes"
+    )
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    if args.verbose:
+        logger.setLevel(logging.DEBUG)
+
+    TRANSCRIPT_FOLDER = args.folder if args.folder else None
+    SEGMENT_LENGTH_MINUTES = int(args.minutes) if args.minutes else SEGMENT_LENGTH_MINUTES
+
+    if not TRANSCRIPT_FOLDER:
+        logger.error("Transcript folder not provided")
+        exit(1)
+
+    logger.debug("Transcription folder: %s", TRANSCRIPT_FOLDER)
+    logger.debug("Segment length %d minutes", SEGMENT_LENGTH_MINUTES)
+
+    files = sorted(glob.glob(os.path.join(TRANSCRIPT_FOLDER, "*.json")))
+    output_file = os.path.join(TRANSCRIPT_FOLDER, "output", "master_transcriptions.jsonl")
+    videos = 0
+
+    # write the buckets of each video in file order as soon as it is parsed
+    with Progress() as progress, SegmentWriter(output_file) as writer:
+        task1 = progress.add_task("[green]Enriching Buckets...", total=len(files))
+
+        for video_segments in bucket_videos(
+            files, TRANSCRIPT_FOLDER, SEGMENT_LENGTH_MINUTES, args.workers
+        ):
+            writer.write_run(video_segments)
+            videos += 1 if video_segments else 0
+            progress.update(task1, advance=1)
+
+    sort_runs(output_file)
+
+    logger.debug("Total files: %s", videos)
+    logger.debug("Total segments: %s", writer.count)
@@ -2,27 +2,35 @@
 
 import argparse
 import logging
-import re
 import os
-import json
-import threading
-import queue
-import time
+from concurrent.futures import ThreadPoolExecutor
 import openai
-from openai.embeddings_utils import get_embedding
-import tiktoken
-from tenacity import (
-    retry,
-    wait_random_exponential,
-    stop_after_attempt,
-    retry_if_not_exception_type,
-)
 from rich.progress import Progress
+from adaptive_limiter import limiter
+from embedding_batch import (
+    EMBEDDING_ENGINE,
+    MAX_INPUT_TOKENS,
+    build_batches,
+    get_text_embeddings,
+    normalize_text,
+)
+from embedding_cache import EmbeddingCache
+from checkpoint import Journal, segment_id
+from rate_limiter import TokenBucket
+from segment_stream import chunk_videos, count_segments, group_by_video, map_videos, read_segments
 
 API_KEY = os.environ["AZURE_OPENAI_API_KEY"]
 RESOURCE_ENDPOINT = os.environ["AZURE_OPENAI_ENDPOINT"]
 PROCESSING_THREADS = 6
-OPENAI_REQUEST_TIMEOUT = 60
+# Azure OpenAI accepts up to 16 inputs per embeddings request
+BATCH_SIZE = 16
+BATCH_MAX_TOKENS = 100000
+CACHE_MAX_MB = 2048
+# help of the optional fixed request ceiling, shared with the pipeline
+RPS_HELP = (
+    "cap the embedding requests per second with a token bucket, off by default since "
+    "the adaptive limiter already paces the requests to the deployment quota"
+)
 
 openai.api_type = "azure"
 openai.api_key = API_KEY
@@ -32,130 +40,172 @@ openai.api_version = "2023-05-15"
 logging.basicConfig(level=logging.WARNING)
 logger = logging.getLogger(__name__)
 
-parser = argparse.ArgumentParser()
-parser.add_argument("-f", "--folder")
-parser.add_argument("--verbose", action="store_true")
-args = parser.parse_args()
-if args.verbose:
-    logger.setLevel(logging.DEBUG)
-
-TRANSCRIPT_FOLDER = args.folder if args.folder else None
-if not TRANSCRIPT_FOLDER:
-    logger.error("Transcript folder not provided")
-    exit(1)
-
-tokenizer = tiktoken.get_encoding("cl100k_base")
-
-total_segments = 0
-current_segment = 0
-output_segments = []
-
-
-logger.debug("Starting OpenAI Embeddings")
-
-
-# load sessions_list from json file
-input_file = os.path.join(TRANSCRIPT_FOLDER, "output", "master_enriched.json")
-with open(input_file, "r", encoding="utf-8") as f:
-    segments = json.load(f)
-
-total_segments = len(segments)
-
-
-def normalize_text(s, sep_token=" \n "):
-    """normalize text by removing extra spaces and newlines"""
-    s = re.sub(r"\s+", " ", s).strip()
-    s = re.sub(r". ,", "", s)
-    # remove all instances of multiple spaces
-    s = s.replace("..", ".")
-    s = s.replace(". .", ".")
-    s = s.replace("\n", "")
-    s = s.strip()
-
-    return s
-
-
-@retry(
-    wait=wait_random_exponential(min=6, max=30),
-    stop=stop_after_attempt(20),
-    retry=retry_if_not_exception_type(openai.InvalidRequestError),
-)
-def get_text_embedding(text: str):
-    """get the embedding for a text"""
-
-    embedding = get_embedding(text, engine="text-embedding-ada-002", timeout=60)
-    return embedding
-
+cache = None
+rate_limiter = None
 
-def process_queue(progress, task):
-    """process the queue"""
-    while not q.empty():
-        segment = q.get()
 
+def split_cached(segments, embedding_cache=None):
+    """
+    return (done, pending): segments with an embedding or a cached embedding,
+    and the segments that still need one
+    """
+    done = []
+    pending = []
+    for segment in segments:
         if "ada_v2" in segment:
-            output_segments.append(segment.copy())
-            continue
-
-        logger.debug(segment["title"])
-        text = segment["text"]
-
-        if len(tokenizer.encode(text)) > 8191:
-            continue
-
-        text = normalize_text(text)
-        segment["text"] = text
-
-        embedding = get_text_embedding(text)
-        if embedding is None:
-            output_segments.append(segment.copy())
+            done.append(segment.copy())
             continue
 
-        segment["ada_v2"] = embedding.copy()
+        if embedding_cache:
+            text = normalize_text(segment["text"])
+            embedding = embedding_cache.get(EMBEDDING_ENGINE, text)
+            if embedding is not None:
+                segment["text"] = text
+                segment["ada_v2"] = embedding
+                done.append(segment.copy())
+                continue
 
-        output_segments.append(segment.copy())
-        progress.update(task, advance=1)
-        q.task_done()
-        time.sleep(0.2)
+        pending.append(segment)
 
+    if embedding_cache:
+        # one transaction records the access times of the whole batch
+        embedding_cache.flush()
+    return done, pending
 
-logger.debug("Total segments to be processed: %s", len(segments))
 
-# add segment list to a queue
-q = queue.Queue()
-for segment in segments:
-    q.put(segment)
+def embed_batch(batch, embedding_cache=None):
+    """embed a batch of (segment, normalized_text) and return the enriched segments"""
+    embeddings = get_text_embeddings([text for _, text in batch])
 
-with Progress() as progress:
-    task1 = progress.add_task("[green]Enriching Embeddings...", total=total_segments)
-    # create multiple threads to process the queue
-    threads = []
-    for i in range(PROCESSING_THREADS):
-        t = threading.Thread(target=process_queue, args=(progress, task1))
-        t.start()
-        threads.append(t)
+    if embedding_cache:
+        embedding_cache.put_many(
+            EMBEDDING_ENGINE,
+            [(text, embedding) for (_, text), embedding in zip(batch, embeddings)],
+        )
 
-    # wait for all threads to finish
-    for t in threads:
-        t.join()
-
-
-# convert time '00:01:20' to seconds
-def convert_time_to_seconds(value):
-    """convert time to seconds"""
-    time_value = value.split(":")
-    if len(time_value) == 3:
-        h, m, s = time_value
-        return int(h) * 3600 + int(m) * 60 + int(s)
-    else:
-        return 0
-
-
-# sort the output segments by videoId and start
-output_segments.sort(key=lambda x: (x["videoId"], convert_time_to_seconds(x["start"])))
-
-logger.debug("Total segments processed: %s", len(output_segments))
-
-# save the embeddings to a json file
-output_file = os.path.join(TRANSCRIPT_FOLDER, "output", "master_enriched.json")
-with open(output_file, "w", encoding="utf-8") as f:
-    json.dump(output_segments, f)
+    # map each vector back to its segment
+    enriched = []
+    for (segment, text), embedding in zip(batch, embeddings):
+        segment["text"] = text
+        segment["ada_v2"] = embedding
+        enriched.append(segment.copy())
+    return enriched
+
+
+def skip_segments(skipped):
+    """return the (segment, normalized_text) too long to embed as segments without an embedding"""
+    segments = []
+    for segment, text in skipped:
+        logger.warning(
+            "Segment %s is over %d tokens, kept without an embedding",
+            segment_id(segment),
+            MAX_INPUT_TOKENS,
+        )
+        segment["text"] = text
+        segments.append(segment.copy())
+    return segments
+
+
+def embed_chunk(segments, journal, batch_size, batch_tokens, progress, task):
+    """embed a chunk of whole videos and journal each batch, cached embeddings are passed through"""
+    done, pending = split_cached(segments, cache)
+    journal.append(done)
+    progress.update(task, advance=len(done))
+
+    skipped = []
+    for batch in build_batches(pending, batch_size, batch_tokens, skipped):
+        logger.debug("Embedding batch of %d segments", len(batch))
+
+        if rate_limiter:
+            rate_limiter.acquire()
+        journal.append(embed_batch(batch, cache))
+        progress.update(task, advance=len(batch))
+
+    # the oversized segments are journaled too, so the merge does not report them missing
+    journal.append(skip_segments(skipped))
+    progress.update(task, advance=len(skipped))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-f", "--folder")
+    parser.add_argument("-b", "--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--batch-tokens", type=int, default=BATCH_MAX_TOKENS)
+    parser.add_argument("--rps", type=float, help=RPS_HELP)
+    parser.add_argument("--cache", help="embedding cache file, defaults to the output folder")
+    parser.add_argument("--cache-size-mb", type=int, default=CACHE_MAX_MB)
+    parser.add_argument("--no-cache", action="store_true")
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="skip the segments already in the checkpoint journal of an interrupted run",
+    )
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    if args.verbose:
+        logger.setLevel(logging.DEBUG)
+    # openai creates one session per thread with the limiter's factory
+    limiter.install()
+
+    TRANSCRIPT_FOLDER = args.folder if args.folder else None
+    if not TRANSCRIPT_FOLDER:
+        logger.error("Transcript folder not provided")
+        exit(1)
+
+    if not args.no_cache:
+        cache_file = args.cache or os.path.join(
+            TRANSCRIPT_FOLDER, "output", "embedding_cache.sqlite"
+        )
+        cache = EmbeddingCache(cache_file, max_bytes=args.cache_size_mb * 1024 * 1024)
+
+    if args.rps:
+        rate_limiter = TokenBucket(args.rps)
+
+    logger.debug("Starting OpenAI Embeddings")
+
+    # stream the summarized segments one video at a time
+    input_file = os.path.join(TRANSCRIPT_FOLDER, "output", "master_summaries.jsonl")
+    output_file = os.path.join(TRANSCRIPT_FOLDER, "output", "master_enriched.jsonl")
+    total_segments = count_segments(input_file)
+
+    logger.debug("Total segments to be processed: %s", total_segments)
+
+    # completed batches are journaled so an interrupted run can resume
+    expected_ids = set()
+    with Journal(output_file + ".journal", resume=args.resume) as journal:
+        if journal.done:
+            print(f"Resuming, {len(journal.done)} segments already embedded")
+
+        with Progress() as progress, ThreadPoolExecutor(PROCESSING_THREADS) as executor:
+            task1 = progress.add_task(
+                "[green]Enriching Embeddings...",
+                total=total_segments,
+                completed=len(journal.done),
+            )
+
+            # chunks of whole videos keep the batches full without holding the corpus
+            videos = group_by_video(journal.pending(read_segments(input_file), expected_ids))
+            for _ in map_videos(
+                lambda chunk: embed_chunk(
+                    chunk, journal, args.batch_size, args.batch_tokens, progress, task1
+                ),
+                chunk_videos(videos, args.batch_size),
+                executor,
+                max_pending=PROCESSING_THREADS * 2,
+            ):
+                pass
+
+    # sort the journal into the output and check no segment is missing
+    if journal.merge(output_file, expected_ids):
+        exit(1)
+
+    logger.debug("Total segments processed: %s", len(expected_ids))
+
+    if cache:
+        stats = cache.stats()
+        print(
+            f"Embedding cache: {stats['hits']} hits, {stats['misses']} misses "
+            f"({stats['hit_rate']:.1%} hit rate), {stats['evictions']} evictions, "
+            f"{stats['bytes'] / (1024 * 1024):.1f} MB"
+        )
+        cache.close()
@@ -1,44 +1,104 @@
-""" This script removes the text from the enriched transcript and saves it as a new json file."""
+""" This script removes the text from the enriched transcript and saves it as a new json file
+and as a compact memory mappable embedding index."""
 
 import json
 import os
 import argparse
 import logging
+from ann_index import IvfIndex
+from bm25_index import Bm25Builder
+from embedding_index import DTYPES, VECTOR_KEY, load_index, write_index
+from pq_index import PqIndex
+from segment_stream import read_segments
 
 logging.basicConfig(level=logging.WARNING)
 logger = logging.getLogger(__name__)
 
-parser = argparse.ArgumentParser()
-parser.add_argument("-f", "--folder")
-args = parser.parse_args()
 
-TRANSCRIPT_FOLDER = args.folder if args.folder else None
-if not TRANSCRIPT_FOLDER:
-    logger.error("Transcript folder not provided")
-    exit(1)
+# create a lambda function to remove the text from each dictionary in the list
 
 
-# load video list from json file
-input_file = os.path.join(TRANSCRIPT_FOLDER, "output", "master_enriched.json")
-with open(input_file, "r", encoding="utf-8") as f:
-    segments = json.load(f)
+def remove_text(seg):
+    """This function removes the text from the segment dictionary."""
+    return {k: v for k, v in seg.items() if k != "text" and k != "description"}
 
-total_segments = len(segments)
 
-# create a lambda function to remove the text from each dictionary in the list
+def save_lite(
+    segments, index_prefix, dtype="float32", ann=False, nlist=None, pq=None, bm25=False
+):
+    """
+    save the lite json file, the compact index and the optional IVF, PQ and BM25 indexes.
+    segments can be a generator, the files are written in a single pass.
+    """
+    # the BM25 index needs the text the lite file drops, its doc ids are the index rows
+    bm25_builder = Bm25Builder() if bm25 else None
+
+    with open(index_prefix + ".json", "w", encoding="utf-8") as f:
+
+        def write_lite(segments):
+            """append each lite segment to the json array and pass the segment on"""
+            f.write("[")
+            for i, seg in enumerate(segments):
+                f.write(", " if i else "")
+                json.dump(remove_text(seg), f)
+                if bm25_builder and seg.get(VECTOR_KEY):
+                    bm25_builder.add(seg)
+                yield seg
+            f.write("]")
+
+        # save the compact index, <prefix>.npy and <prefix>.meta.json
+        write_index(write_lite(segments), index_prefix, dtype=dtype)
+
+    # save the BM25 text index, <prefix>.bm25.npz
+    if bm25_builder:
+        bm25_builder.build().save(index_prefix + ".bm25.npz")
+
+    if not ann and not pq:
+        return
+
+    vectors, _ = load_index(index_prefix)
+    if not len(vectors):
+        logger.warning("No embeddings found, skipping the IVF and PQ indexes")
+        return
+
+    # save the IVF approximate nearest neighbour index, <prefix>.ivf.npz
+    if ann:
+        IvfIndex.build(vectors, nlist=nlist).save(index_prefix + ".ivf.npz")
+
+    # save the product quantized index, <prefix>.pq.npz
+    if pq:
+        PqIndex.build(vectors, m=pq).save(index_prefix + ".pq.npz")
 
 
-def remove_text(video_segments):
-    """This function removes the text from each dictionary in the list."""
-    return [
-        {k: v for k, v in seg.items() if k != "text" and k != "description"}
-        for seg in video_segments
-    ]
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-f", "--folder")
+    parser.add_argument("--dtype", choices=DTYPES, default="float32")
+    parser.add_argument("--ann", action="store_true", help="also build an IVF index")
+    parser.add_argument("--nlist", type=int, help="number of IVF lists")
+    parser.add_argument(
+        "--pq", type=int, metavar="M", help="also build a PQ index with M bytes per segment"
+    )
+    parser.add_argument(
+        "--bm25", action="store_true", help="also build a BM25 index for text and hybrid search"
+    )
+    args = parser.parse_args()
 
+    TRANSCRIPT_FOLDER = args.folder if args.folder else None
+    if not TRANSCRIPT_FOLDER:
+        logger.error("Transcript folder not provided")
+        exit(1)
 
-lite = remove_text(segments)
+    # stream the enriched segments
+    input_file = os.path.join(TRANSCRIPT_FOLDER, "output", "master_enriched.jsonl")
 
-# save the embeddings to a json file
-output_file = os.path.join(TRANSCRIPT_FOLDER, "output", "master_enriched_lite.json")
-with open(output_file, "w", encoding="utf-8") as f:
-    json.dump(lite, f)
+    # master_enriched_lite.json, .npy, .meta.json, .ivf.npz, .pq.npz and .bm25.npz
+    save_lite(
+        read_segments(input_file),
+        os.path.join(TRANSCRIPT_FOLDER, "output", "master_enriched_lite"),
+        dtype=args.dtype,
+        ann=args.ann,
+        nlist=args.nlist,
+        pq=args.pq,
+        bm25=args.bm25,
+    )
@@ -2,6 +2,7 @@
 
 import json
 import os
+import re
 import glob
 import threading
 import logging
@@ -11,9 +12,14 @@ import argparse
 import openai
 from openai.embeddings_utils import get_embedding
 from rich.progress import Progress
+from adaptive_limiter import limiter
+from caption_store import load_captions
+from response_cache import ReplayMiss, responses
+from speaker_cache import SpeakerCache
+from token_counter import count_tokens, count_tokens_batch, fits
 from tenacity import (
+    RetryError,
     retry,
-    wait_random_exponential,
     stop_after_attempt,
     retry_if_not_exception_type,
 )
@@ -30,6 +36,19 @@ SEGMENT_MIN_LENGTH_MINUTES = 3
 OPENAI_REQUEST_TIMEOUT = 60
 
 OPENAI_MAX_TOKENS = 512
+# gpt-35-turbo context less the completion and the function definition
+MAX_PROMPT_TOKENS = 4096 - OPENAI_MAX_TOKENS - 256
+# batch mode, the snippets of several videos share one request
+BATCH_MAX_VIDEOS = 16
+# completion tokens of one {"videoId": ..., "speakers": ...} answer, the ids, keys and
+# indentation of the JSON take more tokens than the names themselves
+BATCH_TOKENS_PER_VIDEO = 64
+# the {"videos": [...]} wrapper of a batch answer
+BATCH_WRAPPER_TOKENS = 32
+# prompt tokens of a batch, the context less the answer of a full batch and the function definition
+BATCH_PROMPT_TOKENS = 4096 - BATCH_WRAPPER_TOKENS - BATCH_TOKENS_PER_VIDEO * BATCH_MAX_VIDEOS - 256
+# the "Video <videoId>:" header and separator of each snippet
+BATCH_FRAMING_TOKENS = 16
 AZURE_OPENAI_MODEL_DEPLOYMENT_NAME = os.getenv(
     "AZURE_OPENAI_MODEL_DEPLOYMENT_NAME", "gpt-35-turbo"
 )
@@ -40,18 +59,6 @@ openai.api_key = API_KEY
 openai.api_base = RESOURCE_ENDPOINT
 openai.api_version = "2023-07-01-preview"
 
-parser = argparse.ArgumentParser()
-parser.add_argument("-f", "--folder")
-parser.add_argument("--verbose", action="store_true")
-args = parser.parse_args()
-if args.verbose:
-    logger.setLevel(logging.DEBUG)
-
-TRANSCRIPT_FOLDER = args.folder if args.folder else None
-if not TRANSCRIPT_FOLDER:
-    logger.error("Transcript folder not provided")
-    exit(1)
-
 get_speaker_name = {
     "name": "get_speaker_name",
     "description": "Get the speaker names for the session.",
@@ -68,15 +75,48 @@ get_speaker_name = {
 }
 
 
+get_speaker_names = {
+    "name": "get_speaker_names",
+    "description": "Get the speaker names for each session.",
+    "parameters": {
+        "type": "object",
+        "properties": {
+            "videos": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "videoId": {
+                            "type": "string",
+                            "description": "The videoId of the session.",
+                        },
+                        "speakers": {
+                            "type": "string",
+                            "description": "The speaker names.",
+                        },
+                    },
+                    "required": ["videoId", "speakers"],
+                },
+            }
+        },
+        "required": ["videos"],
+    },
+}
+
+
 openai_functions = [get_speaker_name]
 
+# start of the answers array in the arguments of a get_speaker_names call
+VIDEOS_ARRAY = re.compile(r'"videos"\s*:\s*\[')
+
 
 # these maps are used to make the function name string to the function call
-definition_map = {"get_speaker_name": get_speaker_name}
+definition_map = {"get_speaker_name": get_speaker_name, "get_speaker_names": get_speaker_names}
 
 q = queue.Queue()
 
 errors = 0
+speaker_cache = None
 
 
 class Counter:
@@ -87,20 +127,26 @@ class Counter:
         self.value = 0
         self.lock = threading.Lock()
 
-    def increment(self):
+    def increment(self, amount=1):
         """increment the counter"""
         with self.lock:
-            self.value += 1
+            self.value += amount
             return self.value
 
 
 counter = Counter()
+# chat completion requests sent, retries included
+request_counter = Counter()
+# videos of a batch extracted again on their own
+retried = Counter()
+# batch answers cut off by max_tokens
+truncated_batches = Counter()
 
 
 @retry(
-    wait=wait_random_exponential(min=6, max=10),
+    wait=limiter.wait,
     stop=stop_after_attempt(4),
-    retry=retry_if_not_exception_type(openai.InvalidRequestError),
+    retry=retry_if_not_exception_type((openai.InvalidRequestError, ReplayMiss)),
 )
 def get_speaker_info(text):
     """Gets the OpenAI functions from the text."""
@@ -108,7 +154,11 @@ def get_speaker_info(text):
     function_name = None
     arguments = None
 
-    response_1 = openai.ChatCompletion.create(
+    request_counter.increment()
+    response_1 = responses.call(
+        limiter.call,
+        openai.ChatCompletion.create,
+        tokens=count_tokens(text) + OPENAI_MAX_TOKENS,
         model="gpt-3.5-turbo-0613",
         messages=[
             {
@@ -136,6 +186,109 @@ def get_speaker_info(text):
     return function_name, arguments
 
 
+@retry(
+    wait=limiter.wait,
+    stop=stop_after_attempt(4),
+    retry=retry_if_not_exception_type((openai.InvalidRequestError, ReplayMiss)),
+)
+def get_speaker_info_batch(videos):
+    """
+    Gets the speaker names of several videos in one request, videos is a list of (videoId, text),
+    returns the speakers of each answered videoId and whether the answer was cut off
+    """
+
+    text = "\n\n".join(f"Video {video_id}: {video_text}" for video_id, video_text in videos)
+    max_tokens = BATCH_WRAPPER_TOKENS + BATCH_TOKENS_PER_VIDEO * len(videos)
+
+    request_counter.increment()
+    response = responses.call(
+        limiter.call,
+        openai.ChatCompletion.create,
+        tokens=count_tokens(text) + max_tokens,
+        model="gpt-3.5-turbo-0613",
+        messages=[
+            {
+                "role": "system",
+                "content": "You are an AI assistant that can extract speaker names from text as a list of comma separated names. The text describes several videos, each one starts with 'Video <videoId>:'. Return the speaker names of every video with its videoId. Try and extract the speaker names from the title. Speaker names are usually less than 3 words long.",
+            },
+            {"role": "user", "content": text},
+        ],
+        functions=[get_speaker_names],
+        max_tokens=max_tokens,
+        engine=AZURE_OPENAI_MODEL_DEPLOYMENT_NAME,
+        request_timeout=OPENAI_REQUEST_TIMEOUT,
+        function_call={"name": "get_speaker_names"},
+        temperature=0.0,
+    )
+
+    choice = response.get("choices")[0]
+    truncated = choice.get("finish_reason") == "length"
+    if truncated:
+        truncated_batches.increment()
+        logger.debug("Batch answer of %s videos cut off at %s tokens", len(videos), max_tokens)
+
+    speakers = parse_speaker_batch(
+        choice.get("message"), [video_id for video_id, _ in videos], truncated
+    )
+    return speakers, truncated
+
+
+def complete_entries(arguments):
+    """Returns the entries of a cut off get_speaker_names answer that were written in full"""
+    match = VIDEOS_ARRAY.search(arguments)
+    if not match:
+        return []
+
+    decoder = json.JSONDecoder()
+    entries = []
+    position = match.end()
+    while True:
+        while position < len(arguments) and arguments[position] in " \t\r\n,":
+            position += 1
+        try:
+            entry, position = decoder.raw_decode(arguments, position)
+        except ValueError:
+            # the closing bracket or the entry the answer was cut off in
+            return entries
+        entries.append(entry)
+
+
+def parse_speaker_batch(message, video_ids, truncated=False):
+    """
+    Validates a get_speaker_names function call against the requested videos,
+    returns the speakers of each requested videoId that was answered once.
+    The complete entries of an answer cut off by max_tokens are kept.
+    """
+    function_call = message.get("function_call") or {}
+    arguments = function_call.get("arguments") or "{}"
+    try:
+        if truncated:
+            entries = complete_entries(arguments)
+        else:
+            entries = json.loads(arguments).get("videos")
+    except (ValueError, AttributeError):
+        logger.debug("Malformed batch response: %s", arguments)
+        return {}
+
+    requested = set(video_ids)
+    speakers = {}
+    duplicates = set()
+    for entry in entries if isinstance(entries, list) else []:
+        if not isinstance(entry, dict):
+            continue
+        video_id, names = entry.get("videoId"), entry.get("speakers")
+        if video_id not in requested or not isinstance(names, str):
+            continue
+        if video_id in speakers:
+            duplicates.add(video_id)
+        speakers[video_id] = names.strip()
+
+    # conflicting answers for a video are retried on their own
+    for video_id in duplicates:
+        del speakers[video_id]
+    return speakers
+
+
 def clean_text(text):
     """clean the text"""
     text = text.replace("\n", " ")  # remove new lines
@@ -150,31 +303,127 @@ def clean_text(text):
 def get_first_segment(file_name):
     """Gets the first segment from the filename"""
 
-    text = ""
-    current_seconds = None
-    segment_begin_seconds = None
-    segment_finish_seconds = None
-
     vtt = file_name.replace(".json", ".json.vtt")
 
-    with open(vtt, "r", encoding="utf-8") as json_file:
-        json_vtt = json.load(json_file)
-
-        for segment in json_vtt:
-            current_seconds = segment.get("start")
+    # the caption file is only read up to the first line past SEGMENT_MIN_LENGTH_MINUTES
+    return "".join(
+        clean_text(segment.get("text")) + " "
+        for segment in load_captions(vtt, first_seconds=SEGMENT_MIN_LENGTH_MINUTES * 60)
+    )
 
-            if segment_begin_seconds is None:
-                segment_begin_seconds = current_seconds
-                # calculate the finish time from the segment_begin_time
-                segment_finish_seconds = (
-                    segment_begin_seconds + SEGMENT_MIN_LENGTH_MINUTES * 60
-                )
 
-            if current_seconds < segment_finish_seconds:
-                # add the text to the transcript
-                text += clean_text(segment.get("text")) + " "
+def speaker_prompt(filename):
+    """Reads the metadata of a video and builds the text its speakers are extracted from"""
+
+    with open(filename, "r", encoding="utf-8") as json_file:
+        metadata = json.load(json_file)
+
+    base_text = 'The title is: ' +  metadata['title'] + " " + metadata["description"] + " " + get_first_segment(filename)
+    # replace new line with empty string
+    base_text = base_text.replace("\n", " ")
+
+    # long descriptions can overflow the context, fall back to the title and description
+    if not fits(base_text, MAX_PROMPT_TOKENS):
+        base_text = ('The title is: ' + metadata['title'] + " " + metadata["description"]).replace("\n", " ")
+
+    return metadata, base_text
+
+
+def save_speakers(filename, metadata, speakers, source):
+    """Saves the speaker names in the metadata file of a video"""
+
+    if speakers == "":
+        print(f"From {source}: {filename}\t---MISSING SPEAKER---")
+        return ""
+
+    print(f"From {source}: {filename}\t{speakers}")
+
+    if metadata.get("speaker") != speakers:
+        metadata["speaker"] = speakers
+        json.dump(metadata, open(filename, "w", encoding="utf-8"))
+    return speakers
+
+
+def update_speaker(filename, cache=None):
+    """
+    Extracts the speaker names for a video and saves them in its metadata file,
+    the cache skips the request when the title, description and opening are unchanged
+    """
+
+    metadata, base_text = speaker_prompt(filename)
+
+    source = "cache"
+    speakers = cache.get(metadata["videoId"], AZURE_OPENAI_MODEL_DEPLOYMENT_NAME, base_text) if cache else None
+    if speakers is None:
+        source = "function call"
+        function_name, arguments = get_speaker_info(base_text)
+        speakers = arguments.get("speakers", "")
+        if cache:
+            cache.put(metadata["videoId"], AZURE_OPENAI_MODEL_DEPLOYMENT_NAME, base_text, speakers)
+
+    return save_speakers(filename, metadata, speakers, source)
+
+
+def speaker_batches(filenames, cache=None, max_tokens=BATCH_PROMPT_TOKENS, max_videos=BATCH_MAX_VIDEOS):
+    """
+    Yields batches of (filename, metadata, text) whose texts fit max_tokens together,
+    the videos found in the cache are saved instead
+    """
+
+    videos = []
+    for filename in filenames:
+        metadata, base_text = speaker_prompt(filename)
+        speakers = cache.get(metadata["videoId"], AZURE_OPENAI_MODEL_DEPLOYMENT_NAME, base_text) if cache else None
+        if speakers is None:
+            videos.append((filename, metadata, base_text))
+        else:
+            save_speakers(filename, metadata, speakers, "cache")
+
+    batch = []
+    batch_tokens = 0
+    for video, tokens in zip(videos, count_tokens_batch([text for _, _, text in videos])):
+        tokens += BATCH_FRAMING_TOKENS
+        if batch and (batch_tokens + tokens > max_tokens or len(batch) == max_videos):
+            yield batch
+            batch = []
+            batch_tokens = 0
+        batch.append(video)
+        batch_tokens += tokens
+    if batch:
+        yield batch
+
+
+def update_speakers_batch(batch, cache=None):
+    """
+    Extracts the speaker names of a batch of videos with one request and saves them,
+    the videos left out of a cut off answer are asked again together and
+    the videos still missing from the responses are extracted one at a time
+    """
+
+    results = {}
+    pending = [(metadata["videoId"], text) for _, metadata, text in batch]
+    try:
+        while pending:
+            speakers, truncated = get_speaker_info_batch(pending)
+            results.update(speakers)
+            pending = [video for video in pending if video[0] not in results]
+            if not truncated or not speakers:
+                break
+    except (RetryError, openai.InvalidRequestError) as batch_error:
+        logger.debug("Batch request failed: %s", batch_error)
+
+    for filename, metadata, base_text in batch:
+        source = "batch function call"
+        speakers = results.get(metadata["videoId"])
+        if speakers is None:
+            source = "function call"
+            function_name, arguments = get_speaker_info(base_text)
+            speakers = arguments.get("speakers", "")
+        if cache:
+            cache.put(metadata["videoId"], AZURE_OPENAI_MODEL_DEPLOYMENT_NAME, base_text, speakers)
+        save_speakers(filename, metadata, speakers, source)
 
-    return text
+    return len(batch) - len(results)
 
 
 def process_queue(progress, task):
@@ -186,55 +435,103 @@ def process_queue(progress, task):
             logger.error("Too many errors. Exiting...")
             exit(1)
 
-        with open(filename, "r", encoding="utf-8") as json_file:
-            metadata = json.load(json_file)
-
-            base_text = 'The title is: ' +  metadata['title'] + " " + metadata["description"] + " " + get_first_segment(filename)
-            # replace new line with empty string
-            base_text = base_text.replace("\n", " ")
-
-            function_name, arguments = get_speaker_info(base_text)
-            speakers = arguments.get("speakers", "")
-            if speakers == "":
-                print(f"From function call: {filename}\t---MISSING SPEAKER---")
-                continue
-            else:
-                print(f"From function call: {filename}\t{speakers}")
-
-            metadata["speaker"] = speakers
-            json.dump(metadata, open(filename, "w", encoding="utf-8"))
+        if not update_speaker(filename, speaker_cache):
+            continue
 
         q.task_done()
         time.sleep(0.2)
 
 
-logger.debug("Transcription folder %s", TRANSCRIPT_FOLDER)
-logger.debug("Starting Speaker Update")
-
-# load all the transcript json files into the queue
-folder = os.path.join(TRANSCRIPT_FOLDER, "*.json")
-
-for filename in glob.glob(folder):
-    # load the json file
-    q.put(filename)
-
-
-logger.debug("Starting speaker name update. Files to be processed: %s", q.qsize())
-start_time = time.time()
-with Progress() as progress:
-    task1 = progress.add_task("[blue]Enriching Speaker Data...", total=q.qsize())
-    # create multiple threads to process the queue
-    threads = []
-    for i in range(PROCESSING_THREADS):
-        t = threading.Thread(target=process_queue, args=(progress, task1))
-        t.start()
-        threads.append(t)
+def process_batch_queue(progress, task):
+    """process a queue of speaker batches"""
+    while True:
+        try:
+            batch = q.get_nowait()
+        except queue.Empty:
+            return
+        retried.increment(update_speakers_batch(batch, speaker_cache))
+        progress.update(task, advance=len(batch))
+        q.task_done()
 
-    # wait for all threads to finish
-    for t in threads:
-        t.join()
 
-finish_time = time.time()
-logger.debug(
-    "Finished speaker name update. Total time taken: %s", finish_time - start_time
-)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-f", "--folder")
+    parser.add_argument("--cache", help="speaker cache, output/speaker_cache.sqlite by default")
+    parser.add_argument("--no-cache", action="store_true", help="extract every speaker again")
+    parser.add_argument(
+        "--batch", action="store_true", help="extract the speakers of several videos per request"
+    )
+    parser.add_argument(
+        "--batch-tokens",
+        type=int,
+        default=BATCH_PROMPT_TOKENS,
+        help="prompt tokens per batch, raise it for a larger context deployment",
+    )
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    if args.verbose:
+        logger.setLevel(logging.DEBUG)
+    # openai creates one session per thread with the limiter's factory
+    limiter.install()
+
+    TRANSCRIPT_FOLDER = args.folder if args.folder else None
+    if not TRANSCRIPT_FOLDER:
+        logger.error("Transcript folder not provided")
+        exit(1)
+
+    logger.debug("Transcription folder %s", TRANSCRIPT_FOLDER)
+    logger.debug("Starting Speaker Update")
+
+    if not args.no_cache:
+        speaker_cache = SpeakerCache(
+            args.cache or os.path.join(TRANSCRIPT_FOLDER, "output", "speaker_cache.sqlite")
+        )
+
+    # load all the transcript json files into the queue
+    folder = os.path.join(TRANSCRIPT_FOLDER, "*.json")
+
+    filenames = glob.glob(folder)
+    start_time = time.time()
+    if args.batch:
+        # the cached videos are saved while the batches are packed
+        for batch in speaker_batches(filenames, speaker_cache, args.batch_tokens):
+            q.put(batch)
+        total = sum(len(batch) for batch in q.queue)
+        target = process_batch_queue
+    else:
+        for filename in filenames:
+            # load the json file
+            q.put(filename)
+        total = q.qsize()
+        target = process_queue
+
+    logger.debug("Starting speaker name update. Files to be processed: %s", total)
+    with Progress() as progress:
+        task1 = progress.add_task("[blue]Enriching Speaker Data...", total=total)
+        # create multiple threads to process the queue
+        threads = []
+        for i in range(PROCESSING_THREADS):
+            t = threading.Thread(target=target, args=(progress, task1))
+            t.start()
+            threads.append(t)
+
+        # wait for all threads to finish
+        for t in threads:
+            t.join()
+
+    finish_time = time.time()
+    logger.debug(
+        "Finished speaker name update. Total time taken: %s", finish_time - start_time
+    )
+    print(
+        f"Speaker requests: {request_counter.value}, batch answers cut off: {truncated_batches.value}, "
+        f"batch videos retried alone: {retried.value}"
+    )
+    if speaker_cache:
+        stats = speaker_cache.stats()
+        print(f"Speakers reused: {stats['hits']}, extracted: {stats['misses']}")
+        speaker_cache.close()
+    if not responses.report():
+        logger.error("Replayed requests missing from the response cache")
+        exit(1)
@@ -1,19 +1,34 @@
-""" Summarize a youtube transcript using chatgpt"""
+""" Summarize a youtube transcript using chatgpt
 
+The segments of each video are summarized concurrently. With --hierarchical
+the segment summaries of a video are combined into a video summary as soon as
+its last segment completes, and the video summaries are combined REDUCE_FAN_IN
+at a time into a playlist summary while the other videos are still running.
+A text too long for one request, or whose summary is cut off, is split in
+halves that are summarized and then combined.
+"""
+
+import hashlib
 import json
 import os
-import queue
 import threading
 import logging
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 import openai
 from tenacity import (
     retry,
-    wait_random_exponential,
     stop_after_attempt,
     retry_if_not_exception_type,
 )
 from rich.progress import Progress
+from adaptive_limiter import limiter
+from atomic_file import write_text
+from checkpoint import Journal, segment_id
+from reduce_tree import ReduceTree
+from response_cache import ReplayMiss, responses
+from segment_stream import count_segments, group_by_video, map_videos, read_segments
+from token_counter import count_tokens
 
 API_KEY = os.environ["AZURE_OPENAI_API_KEY"]
 RESOURCE_ENDPOINT = os.environ["AZURE_OPENAI_ENDPOINT"]
@@ -21,8 +36,17 @@ AZURE_OPENAI_MODEL_DEPLOYMENT_NAME = os.getenv(
     "AZURE_OPENAI_MODEL_DEPLOYMENT_NAME", "gpt-35-turbo"
 )
 MAX_TOKENS = 512
-PROCESSOR_THREADS = 10
+# upper bound, the adaptive limiter decides how many requests are in flight
+PROCESSOR_THREADS = 32
 OPENAI_REQUEST_TIMEOUT = 30
+SYSTEM_PROMPT = "You're an AI Assistant for video, write an authoritative 60 word summary.Avoid starting sentences with 'This video'."
+VIDEO_PROMPT = "You're an AI Assistant for video, combine these summaries of consecutive parts of a video into an authoritative 60 word summary.Avoid starting sentences with 'This video'."
+PLAYLIST_PROMPT = "You're an AI Assistant for video, combine these summaries of the videos of a playlist into an authoritative 120 word overview.Avoid starting sentences with 'This playlist'."
+# longer inputs are split before they are sent, the model context is 4096 tokens
+MAX_INPUT_TOKENS = 4096 - MAX_TOKENS - 256
+MAX_SPLIT_DEPTH = 4
+MIN_SPLIT_WORDS = 64
+REDUCE_FAN_IN = 8
 
 openai.api_type = "azure"
 openai.api_key = API_KEY
@@ -32,24 +56,11 @@ openai.api_version = "2023-07-01-preview"
 logging.basicConfig(level=logging.WARNING)
 logger = logging.getLogger(__name__)
 
-parser = argparse.ArgumentParser()
-parser.add_argument("--verbose", action="store_true")
-parser.add_argument("-f", "--folder")
-args = parser.parse_args()
-
-TRANSCRIPT_FOLDER = args.folder if args.folder else None
-if not TRANSCRIPT_FOLDER:
-    logger.error("Transcript folder not provided")
-    exit(1)
-
-if args.verbose:
-    logger.setLevel(logging.DEBUG)
-
-segments = []
-output_segments = []
 total_segments = 0
 
-errors = 0
+
+class SummaryTruncated(Exception):
+    """the summary was cut off before the model finished it"""
 
 
 class Counter:
@@ -68,25 +79,62 @@ class Counter:
 
 
 counter = Counter()
+reused = Counter()
+reduced = Counter()
+split = Counter()
+previous_summaries = {}
+
+
+def summary_hash(text, prompt=SYSTEM_PROMPT):
+    """stable hash of the summary inputs, the text, system prompt and model deployment"""
+    key = "\0".join([AZURE_OPENAI_MODEL_DEPLOYMENT_NAME, prompt, text])
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def load_previous_summaries(filename):
+    """map the text hash to the summary for each segment of a previous run"""
+    if not os.path.exists(filename):
+        logger.warning("Previous output not found: %s", filename)
+        return {}
+
+    return {
+        seg["text_hash"]: seg["summary"]
+        for seg in read_segments(filename)
+        if "text_hash" in seg and "summary" in seg
+    }
+
+
+def load_previous_reductions(video_file, playlist_file):
+    """map the input hash to the summary for each video and playlist reduction of a previous run"""
+    reductions = {}
+    if os.path.exists(video_file):
+        for video in read_segments(video_file):
+            if video.get("summary_hash"):
+                reductions[video["summary_hash"]] = video["summary"]
+    if os.path.exists(playlist_file):
+        with open(playlist_file, "r", encoding="utf-8") as f:
+            reductions.update(json.load(f).get("reductions", {}))
+    return reductions
 
 
 @retry(
-    wait=wait_random_exponential(min=10, max=45),
+    wait=limiter.wait,
     stop=stop_after_attempt(20),
-    retry=retry_if_not_exception_type(openai.InvalidRequestError),
+    retry=retry_if_not_exception_type((openai.InvalidRequestError, SummaryTruncated, ReplayMiss)),
 )
-def chatgpt_summary(text):
+def chatgpt_summary(text, prompt=SYSTEM_PROMPT):
     """generate a summary using chatgpt"""
 
     messages = [
-        {
-            "role": "system",
-            "content": "You're an AI Assistant for video, write an authoritative 60 word summary.Avoid starting sentences with 'This video'.",
-        },
+        {"role": "system", "content": prompt},
         {"role": "user", "content": text},
     ]
 
-    response = openai.ChatCompletion.create(
+    # the quota is charged for the prompt and max_tokens
+    response = responses.call(
+        limiter.call,
+        openai.ChatCompletion.create,
+        tokens=count_tokens(prompt) + count_tokens(text) + MAX_TOKENS,
         engine=AZURE_OPENAI_MODEL_DEPLOYMENT_NAME,
         messages=messages,
         temperature=0.7,
@@ -105,104 +153,317 @@ def chatgpt_summary(text):
 
     # print(finish_reason)
     if finish_reason != "stop":
-        logger.warning("Stop reason: %s", finish_reason)
-        logger.warning("Text: %s", text)
-        logger.warning("Increase Max Tokens and try again")
-        exit(1)
+        raise SummaryTruncated(finish_reason)
 
     return text
 
 
-def process_queue(progress, task):
-    """process the queue"""
-    while not q.empty():
-        if errors > 100:
-            logger.exit("Too many errors. Exiting...")
-            exit(1)
-
-        segment = q.get()
-
-        text = segment.get("text")
-
-        # Think about this some more. Idea is to reduce processing time
-        # text_hash = hash(text)
-
-        # # check if there is a summary already in the segment and the hash is the same
-        # # If found then don't generate a new summary
-        # if "summary" in segment and "text_hash" in segment and text_hash == segment["text_hash"]:
-        #     output_segments.append(segment.copy())
-        #     q.task_done()
-        #     continue
-
-        # get a summary of the text using chatgpt
+def split_text(text):
+    """split a text in two at the sentence or word boundary closest to its middle"""
+    middle = len(text) // 2
+    for separator in (". ", " "):
+        before = text.rfind(separator, 0, middle)
+        after = text.find(separator, middle)
+        cuts = [cut + len(separator) for cut in (before, after) if 0 <= cut < len(text) - 1]
+        if cuts:
+            cut = min(cuts, key=lambda cut: abs(cut - middle))
+            return text[:cut].strip(), text[cut:].strip()
+    return text[:middle], text[middle:]
+
+
+def summarize_text(text, prompt=SYSTEM_PROMPT, depth=0):
+    """
+    summarize a text, a text over MAX_INPUT_TOKENS or whose summary is cut off or
+    rejected as too long is split in halves that are summarized and then combined
+    """
+    if depth < MAX_SPLIT_DEPTH and count_tokens(prompt) + count_tokens(text) > MAX_INPUT_TOKENS:
+        reason = "too long"
+    else:
         try:
-            summary = chatgpt_summary(text)
-        except openai.InvalidRequestError as invalid_request_error:
-            logger.warning("Error: %s", invalid_request_error)
-            summary = text
-        except Exception as e:
-            logger.warning("Error: %s", e)
-            summary = text
-
-        count = counter.increment()
+            return chatgpt_summary(text, prompt)
+        except (SummaryTruncated, openai.InvalidRequestError) as error:
+            too_long = isinstance(error, SummaryTruncated) or (
+                getattr(error, "code", None) == "context_length_exceeded"
+            )
+            if not too_long or depth >= MAX_SPLIT_DEPTH or len(text.split()) < MIN_SPLIT_WORDS:
+                raise
+            reason = str(error) or type(error).__name__
+
+    split.increment()
+    logger.info("Splitting a text of %d words: %s", len(text.split()), reason)
+    halves = [summarize_text(half, prompt, depth + 1) for half in split_text(text)]
+    # the video and playlist prompts already combine summaries
+    combine_prompt = VIDEO_PROMPT if prompt == SYSTEM_PROMPT else prompt
+    return summarize_text("\n".join(halves), combine_prompt, depth + 1)
+
+
+def summarize_segment(segment, summaries=None):
+    """add the summary and text hash to the segment, returns True if a previous summary was reused"""
+    summaries = previous_summaries if summaries is None else summaries
+
+    text = segment.get("text")
+    text_hash = summary_hash(text)
+
+    # reuse the summary from the previous run if the text, prompt and model are unchanged
+    if text_hash in summaries:
+        segment["summary"] = summaries[text_hash]
+        segment["text_hash"] = text_hash
+        return True
+
+    # get a summary of the text using chatgpt
+    try:
+        summary = summarize_text(text)
+        # only record the hash for real summaries so failures are retried next run
+        segment["text_hash"] = text_hash
+    except openai.InvalidRequestError as invalid_request_error:
+        logger.warning("Error: %s", invalid_request_error)
+        summary = text
+    except Exception as e:
+        logger.warning("Error: %s", e)
+        summary = text
+
+    # add the summary to the segment dictionary
+    segment["summary"] = summary
+    return False
+
+
+def reduce_summaries(summaries, prompt, reductions=None):
+    """
+    combine summaries into one with prompt, returns the summary and its input hash,
+    the previous result is reused for unchanged inputs. on failure the summaries are
+    joined and the hash is None so the reduction is retried next run.
+    """
+    reductions = previous_summaries if reductions is None else reductions
+    if len(summaries) == 1:
+        return summaries[0], None
+
+    text = "\n".join(summaries)
+    text_hash = summary_hash(text, prompt)
+    if text_hash in reductions:
+        return reductions[text_hash], text_hash
+
+    try:
+        summary = summarize_text(text, prompt)
+    except Exception as e:
+        logger.warning("Error: %s", e)
+        return text, None
+
+    reduced.increment()
+    return summary, text_hash
+
+
+def summarize_video(video_segments, journal, executor, progress, task, journaled=None):
+    """
+    summarize the segments of one video concurrently, each one is journaled as it completes.
+    segments already journaled are skipped, or take their summary from journaled when given.
+    """
+
+    def summarize(segment):
+        if journal.is_done(segment):
+            if journaled is not None:
+                segment.update(journaled[segment_id(segment)])
+            return
+
+        if summarize_segment(segment):
+            reused.increment()
+        else:
+            count = counter.increment()
+            logger.debug("Processed %d segments of %d", count, total_segments)
+
+        journal.append([segment])
         progress.update(task, advance=1)
-        logger.debug("Processed %d segments of %d", count, total_segments)
-
-        # add the summary and text hash to the segment dictionary
-        segment["summary"] = summary
 
-        output_segments.append(segment.copy())
-        q.task_done()
+    for _ in executor.map(summarize, video_segments):
+        pass
+    return video_segments
 
 
-logger.debug("Starting OpenAI summarization")
-
-# load the segments from a json file
-input_file = os.path.join(TRANSCRIPT_FOLDER, "output", "master_transcriptions.json")
-with open(input_file, "r", encoding="utf-8") as f:
-    segments = json.load(f)
-
-total_segments = len(segments)
-
-logger.debug("Total segments to be processed: %s", len(segments))
-
-# add segment list to a queue
-q = queue.Queue()
-for segment in segments:
-    q.put(segment)
-
-with Progress() as progress:
-    task1 = progress.add_task("[purple]Enriching Summaries...", total=total_segments)
-
-    # create multiple threads to process the queue
-    threads = []
-    for i in range(PROCESSOR_THREADS):
-        t = threading.Thread(target=process_queue, args=(progress, task1))
-        t.start()
-        threads.append(t)
-
-    # wait for all threads to finish
-    for t in threads:
-        t.join()
-
-
-# convert time '00:01:20' to seconds
-def convert_time_to_seconds(value):
-    """convert time to seconds"""
-    time_value = value.split(":")
-    if len(time_value) == 3:
-        h, m, s = time_value
-        return int(h) * 3600 + int(m) * 60 + int(s)
-    else:
-        return 0
-
+def video_record(video_segments):
+    """combine the segment summaries of a video, in time order, into a video summary record"""
+    video_segments = sorted(video_segments, key=lambda segment: segment.get("seconds", 0))
+    first = video_segments[0]
+    summary, text_hash = reduce_summaries(
+        [segment["summary"] for segment in video_segments], VIDEO_PROMPT
+    )
+    return {
+        "videoId": first["videoId"],
+        "title": first.get("title"),
+        "speaker": first.get("speaker"),
+        "segments": len(video_segments),
+        "summary": summary,
+        "summary_hash": text_hash,
+    }
+
+
+def read_journaled(filename):
+    """map the segment id to the summary fields of each segment of a recovered journal"""
+    journaled = {}
+    with open(filename, "r", encoding="utf-8") as f:
+        for line in f:
+            segment = json.loads(line)
+            journaled[segment_id(segment)] = {
+                key: segment[key] for key in ("summary", "text_hash") if key in segment
+            }
+    return journaled
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--verbose", action="store_true")
+    parser.add_argument("-f", "--folder")
+    parser.add_argument(
+        "-i",
+        "--incremental",
+        action="store_true",
+        help="reuse summaries from the previous run for unchanged segments",
+    )
+    parser.add_argument(
+        "--previous",
+        help="previous enriched output, defaults to the output folder master_enriched.jsonl",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="skip the segments already in the checkpoint journal of an interrupted run",
+    )
+    parser.add_argument(
+        "--hierarchical",
+        action="store_true",
+        help="also combine the segment summaries into video and playlist summaries",
+    )
+    parser.add_argument(
+        "--fan-in",
+        type=int,
+        default=REDUCE_FAN_IN,
+        help="video summaries combined by each step of the playlist summary",
+    )
+    args = parser.parse_args()
 
-# sort the output segments by videoId and start
-output_segments.sort(key=lambda x: (x["videoId"], convert_time_to_seconds(x["start"])))
+    TRANSCRIPT_FOLDER = args.folder if args.folder else None
+    if not TRANSCRIPT_FOLDER:
+        logger.error("Transcript folder not provided")
+        exit(1)
 
-logger.debug("Total segments processed: %s", len(output_segments))
+    if args.verbose:
+        logger.setLevel(logging.DEBUG)
+    # openai creates one session per thread with the limiter's factory
+    limiter.install()
+
+    logger.debug("Starting OpenAI summarization")
+
+    # stream the segments one video at a time
+    input_file = os.path.join(TRANSCRIPT_FOLDER, "output", "master_transcriptions.jsonl")
+    output_file = os.path.join(TRANSCRIPT_FOLDER, "output", "master_summaries.jsonl")
+    video_file = os.path.join(TRANSCRIPT_FOLDER, "output", "master_video_summaries.jsonl")
+    playlist_file = os.path.join(TRANSCRIPT_FOLDER, "output", "master_playlist_summary.json")
+    total_segments = count_segments(input_file)
+
+    if args.incremental:
+        previous_file = args.previous or os.path.join(
+            TRANSCRIPT_FOLDER, "output", "master_enriched.jsonl"
+        )
+        previous_summaries = load_previous_summaries(previous_file)
+        if args.hierarchical:
+            # the video and playlist hashes include their prompt, they share the map
+            previous_summaries.update(load_previous_reductions(video_file, playlist_file))
+        logger.debug("Previous summaries loaded: %s", len(previous_summaries))
+
+    logger.debug("Total segments to be processed: %s", total_segments)
+
+    # completed segments are journaled so an interrupted run can resume
+    expected_ids = set()
+    video_records = {}
+    playlist_reductions = {}
+    playlist_summary = None
+    with Journal(output_file + ".journal", resume=args.resume) as journal:
+        if journal.done:
+            print(f"Resuming, {len(journal.done)} segments already summarized")
+        # the video summaries also need the segments summarized before the interruption
+        journaled = read_journaled(journal.filename) if args.hierarchical and journal.done else None
+
+        # the video tasks wait for their segments, they get their own pool so the
+        # segment and reduce tasks never wait behind them
+        with Progress() as progress, ThreadPoolExecutor(
+            PROCESSOR_THREADS
+        ) as executor, ThreadPoolExecutor(PROCESSOR_THREADS) as video_executor:
+            task1 = progress.add_task(
+                "[purple]Enriching Summaries...",
+                total=total_segments,
+                completed=len(journal.done),
+            )
+
+            def reduce_playlist(summaries):
+                """combine video summaries, the results are kept for the next run"""
+                summary, text_hash = reduce_summaries(summaries, PLAYLIST_PROMPT)
+                if text_hash:
+                    playlist_reductions[text_hash] = summary
+                return summary
+
+            # the playlist summary is combined fan_in videos at a time as they complete
+            tree = ReduceTree(reduce_playlist, executor, args.fan_in)
+
+            def process_video(indexed_video):
+                """summarize a video, then reduce it into its video summary"""
+                index, video_segments = indexed_video
+                summarize_video(video_segments, journal, executor, progress, task1, journaled)
+                if args.hierarchical:
+                    video_records[index] = video_record(video_segments)
+                    tree.add(index, video_records[index]["summary"])
+
+            def input_videos():
+                """the videos of the input, only those with pending segments unless reducing"""
+                for video_segments in group_by_video(read_segments(input_file)):
+                    expected_ids.update(segment_id(segment) for segment in video_segments)
+                    if args.hierarchical or not all(map(journal.is_done, video_segments)):
+                        yield video_segments
+
+            # summarize a bounded number of videos at a time
+            for _ in map_videos(
+                process_video,
+                enumerate(input_videos()),
+                video_executor,
+                max_pending=PROCESSOR_THREADS * 2,
+            ):
+                pass
+
+            if args.hierarchical:
+                tree.finish(len(video_records))
+                playlist_summary = tree.wait()
+
+    if args.hierarchical:
+        write_text(
+            video_file,
+            "".join(
+                json.dumps(video_records[index], ensure_ascii=False) + "\n"
+                for index in sorted(video_records)
+            ),
+        )
+        write_text(
+            playlist_file,
+            json.dumps(
+                {
+                    "videos": len(video_records),
+                    "summary": playlist_summary,
+                    "reductions": playlist_reductions,
+                },
+                ensure_ascii=False,
+                indent=4,
+            ),
+        )
+
+    # sort the journal into the output and check no segment is missing
+    if journal.merge(output_file, expected_ids):
+        exit(1)
 
-# save the output segments to a json file
-output_file = os.path.join(TRANSCRIPT_FOLDER, "output", "master_enriched.json")
-with open(output_file, "w", encoding="utf-8") as f:
-    json.dump(output_segments, f, ensure_ascii=False, indent=4)
+    logger.debug("Total segments processed: %s", counter.value + reused.value)
+
+    if args.incremental:
+        print(f"Summaries reused: {reused.value}, regenerated: {counter.value}")
+    if args.hierarchical:
+        print(
+            f"Video summaries: {len(video_records)}, combine requests: {reduced.value}, "
+            f"split texts: {split.value}"
+        )
+    if not responses.report():
+        logger.error("Replayed requests missing from the response cache")
+        exit(1)
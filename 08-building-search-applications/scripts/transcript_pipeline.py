@@ -0,0 +1,413 @@
+""" This script streams every video through all the enrichment stages with asyncio and bounded queues.
+
+download -> speaker -> bucket -> summaries -> embeddings -> lite
+
+Each stage reuses the logic of its transcript_* script and runs its blocking
+calls on a thread pool, so summaries and embeddings of one video overlap with
+the speaker extraction and bucketing of the next.
+"""
+
+import argparse
+import asyncio
+import glob
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import openai
+import transcript_download
+import transcript_enrich_bucket
+import transcript_enrich_embeddings
+import transcript_enrich_speaker
+import transcript_enrich_summaries
+from adaptive_limiter import limiter
+from caption_store import transcript_file
+from download_manifest import Manifest
+from embedding_batch import build_batches
+from embedding_cache import EmbeddingCache
+from rate_limiter import TokenBucket
+from response_cache import responses
+from segment_stream import SegmentWriter, read_segments, sort_runs
+from speaker_cache import SpeakerCache
+from transcript_enrich_lite import save_lite
+
+logging.basicConfig(level=logging.WARNING)
+logger = logging.getLogger(__name__)
+
+QUEUE_SIZE = 256
+REPORT_INTERVAL = 10
+CACHE_MAX_MB = 2048
+# serves the chat completions and the embeddings, so every stage shares one configuration
+OPENAI_API_VERSION = "2023-07-01-preview"
+
+# sentinel passed down a queue when the upstream stage has finished
+DONE = object()
+
+
+class Dropped:
+    """sent to the sink in place of a segment that failed in a stage"""
+
+    def __init__(self, video_id):
+        """initialize the marker"""
+        self.video_id = video_id
+
+
+def configure_openai():
+    """point the openai module at the Azure OpenAI resource of the environment"""
+    openai.api_type = "azure"
+    openai.api_key = os.environ["AZURE_OPENAI_API_KEY"]
+    openai.api_base = os.environ["AZURE_OPENAI_ENDPOINT"]
+    openai.api_version = OPENAI_API_VERSION
+
+
+class Stage:
+    """per stage statistics"""
+
+    def __init__(self, name, workers, inbox):
+        """initialize the stage"""
+        self.name = name
+        self.workers = workers
+        self.inbox = inbox
+        self.processed = 0
+        self.failed = 0
+        self.busy = 0.0
+        self.max_depth = 0
+        self.started = None
+        self.finished = None
+
+    def elapsed(self):
+        """seconds since the stage processed its first item"""
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.perf_counter()) - self.started
+
+    def throughput(self):
+        """items processed per second"""
+        elapsed = self.elapsed()
+        return self.processed / elapsed if elapsed else 0.0
+
+    def depth(self):
+        """current input queue depth"""
+        depth = self.inbox.qsize()
+        self.max_depth = max(self.max_depth, depth)
+        return depth
+
+
+async def run_stage(stage, fn, outbox, executor, batch_size=None, on_error=None):
+    """
+    run `stage.workers` workers that call fn on the thread pool for each item
+    of the inbox and put every returned item on the outbox.
+    with batch_size, fn receives a list of up to batch_size queued items.
+    the items of a failed call are logged, counted and passed to on_error.
+    """
+    loop = asyncio.get_running_loop()
+    inbox = stage.inbox
+
+    async def worker():
+        while True:
+            stage.depth()
+            item = await inbox.get()
+            if item is DONE:
+                # leave the sentinel for the sibling workers
+                await inbox.put(DONE)
+                return
+
+            items = [item]
+            while batch_size and len(items) < batch_size and not inbox.empty():
+                item = inbox.get_nowait()
+                if item is DONE:
+                    await inbox.put(DONE)
+                    break
+                items.append(item)
+
+            if stage.started is None:
+                stage.started = time.perf_counter()
+
+            start_time = time.perf_counter()
+            try:
+                results = await loop.run_in_executor(
+                    executor, fn, items if batch_size else items[0]
+                )
+            except Exception as error:  # pylint: disable=broad-except
+                # like the standalone scripts, a failed item is skipped and the run goes on
+                logger.error("%s failed for %d items: %r", stage.name, len(items), error)
+                stage.failed += len(items)
+                results = []
+                if on_error:
+                    await on_error(items)
+            stage.busy += time.perf_counter() - start_time
+            stage.processed += len(items)
+
+            for result in results:
+                await outbox.put(result)
+
+    await asyncio.gather(*(worker() for _ in range(stage.workers)))
+    stage.finished = time.perf_counter()
+    await outbox.put(DONE)
+
+
+async def report(stages, interval):
+    """print the stage throughput and queue depth every interval seconds"""
+    while True:
+        await asyncio.sleep(interval)
+        print(
+            " | ".join(
+                f"{stage.name} {stage.processed} ({stage.throughput():.1f}/s, q={stage.depth()})"
+                for stage in stages
+            )
+        )
+
+
+def print_summary(stages, elapsed):
+    """print the final per stage statistics"""
+    print(f"\nPipeline finished in {elapsed:.1f}s")
+    print(
+        f"{'stage':<12} {'workers':>8} {'items':>8} {'items/sec':>10} "
+        f"{'busy %':>8} {'max queue':>10} {'failed':>8}"
+    )
+    for stage in stages:
+        elapsed_workers = stage.elapsed() * stage.workers
+        busy = 100 * stage.busy / elapsed_workers if elapsed_workers else 0.0
+        print(
+            f"{stage.name:<12} {stage.workers:>8} {stage.processed:>8} "
+            f"{stage.throughput():>10.1f} {busy:>8.1f} {stage.max_depth:>10} {stage.failed:>8}"
+        )
+
+
+async def run_pipeline(args):
+    """stream the videos through every stage and write the outputs"""
+    configure_openai()
+    folder = args.folder
+    previous_summaries = {}
+    if args.incremental:
+        previous_summaries = transcript_enrich_summaries.load_previous_summaries(
+            args.previous or full_output_file(args)
+        )
+
+    cache = None
+    if not args.no_cache:
+        cache = EmbeddingCache(
+            args.cache or os.path.join(folder, "output", "embedding_cache.sqlite"),
+            max_bytes=args.cache_size_mb * 1024 * 1024,
+        )
+    rate_limiter = TokenBucket(args.rps) if args.rps else None
+
+    session = transcript_download.create_session(args.download_workers)
+    manifest = None
+    if args.playlist:
+        manifest = Manifest(os.path.join(folder, transcript_download.MANIFEST_FILE))
+
+    def download(playlist_item):
+        video_id = playlist_item["snippet"]["resourceId"]["videoId"]
+        transcript_download.download_video(playlist_item, 0, folder, session, manifest)
+
+        metadata_file = os.path.join(folder, video_id + ".json")
+        if os.path.exists(metadata_file) and transcript_file(metadata_file + ".vtt"):
+            return [metadata_file]
+        return []
+
+    speaker_cache = None
+    if not args.no_cache:
+        speaker_cache = SpeakerCache(os.path.join(folder, "output", "speaker_cache.sqlite"))
+
+    def speaker(metadata_file):
+        transcript_enrich_speaker.update_speaker(metadata_file, speaker_cache)
+        return [metadata_file]
+
+    # number of segments of each bucketed video, so the sink knows when a video is complete
+    video_sizes = {}
+
+    def bucket(metadata_file):
+        video_segments = transcript_enrich_bucket.bucket_video(metadata_file, folder, args.minutes)
+        if video_segments:
+            video_sizes[video_segments[0]["videoId"]] = len(video_segments)
+        return video_segments
+
+    def summary(segment):
+        transcript_enrich_summaries.summarize_segment(segment, previous_summaries)
+        return [segment]
+
+    def embedding(segments):
+        done, pending = transcript_enrich_embeddings.split_cached(segments, cache)
+        skipped = []
+        for batch in build_batches(pending, args.batch_size, args.batch_tokens, skipped):
+            if rate_limiter:
+                rate_limiter.acquire()
+            done.extend(transcript_enrich_embeddings.embed_batch(batch, cache))
+        # the oversized segments go on without an embedding so their video still completes
+        done.extend(transcript_enrich_embeddings.skip_segments(skipped))
+        return done
+
+    queues = [asyncio.Queue(maxsize=args.queue_size) for _ in range(6)]
+    stages = []
+    steps = []
+    if args.playlist:
+        stages.append(Stage("download", args.download_workers, queues[0]))
+        steps.append((download, None))
+    stages += [
+        Stage("speaker", args.speaker_workers, queues[1]),
+        Stage("bucket", args.bucket_workers, queues[2]),
+        Stage("summaries", args.summary_workers, queues[3]),
+        Stage("embeddings", args.embedding_workers, queues[4]),
+    ]
+    steps += [
+        (speaker, None),
+        (bucket, None),
+        (summary, None),
+        (embedding, args.batch_size),
+    ]
+    sink = queues[5]
+
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=sum(stage.workers for stage in stages))
+
+    async def source():
+        """feed the first stage with playlist items or the downloaded metadata files"""
+        inbox = stages[0].inbox
+        if args.playlist:
+            youtube = transcript_download.build_youtube_client()
+            items = transcript_download.list_playlist_items(youtube, args.playlist, manifest)
+            video_ids = set()
+            # fetch the playlist pages on the thread pool while the downloads run
+            while (item := await loop.run_in_executor(executor, next, items, DONE)) is not DONE:
+                video_ids.add(item["snippet"]["resourceId"]["videoId"])
+                await inbox.put(item)
+            transcript_download.prune_videos(manifest, args.playlist, video_ids, folder)
+        else:
+            for metadata_file in sorted(glob.glob(os.path.join(folder, "*.json"))):
+                await inbox.put(metadata_file)
+        await inbox.put(DONE)
+
+    async def drop(items):
+        """stop waiting for the bucketed segments that failed in a stage"""
+        for item in items:
+            if isinstance(item, dict) and item.get("videoId") in video_sizes:
+                await sink.put(Dropped(item["videoId"]))
+
+    async def collect(writer):
+        """
+        write each video as a sorted run once all its segments are enriched,
+        the segments that failed are left out
+        """
+        videos = {}
+        while (segment := await sink.get()) is not DONE:
+            if isinstance(segment, Dropped):
+                video_id = segment.video_id
+                video_sizes[video_id] -= 1
+            else:
+                video_id = segment["videoId"]
+                videos.setdefault(video_id, []).append(segment)
+            if len(videos.get(video_id, [])) == video_sizes[video_id]:
+                video_segments = videos.pop(video_id, [])
+                if video_segments:
+                    writer.write_run(video_segments)
+
+    start_time = time.perf_counter()
+    reporter = asyncio.create_task(report(stages, args.report_interval))
+
+    output_file = full_output_file(args)
+    writer = SegmentWriter(output_file + ".tmp")
+    tasks = [asyncio.ensure_future(source()), asyncio.ensure_future(collect(writer))]
+    for i, (stage, (fn, batch_size)) in enumerate(zip(stages, steps)):
+        outbox = stages[i + 1].inbox if i + 1 < len(stages) else sink
+        stage_task = run_stage(stage, fn, outbox, executor, batch_size, on_error=drop)
+        tasks.append(asyncio.ensure_future(stage_task))
+
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        # a failed source or sink, no partial output is left behind
+        writer.close()
+        os.remove(writer.filename)
+        raise
+    finally:
+        for task in tasks:
+            task.cancel()
+        reporter.cancel()
+        writer.close()
+        executor.shutdown(cancel_futures=True)
+
+    # the videos finish out of order, merge the per video runs
+    sort_runs(writer.filename)
+    os.replace(writer.filename, output_file)
+
+    save_lite(
+        read_segments(output_file),
+        os.path.join(folder, "output", f"embedding_index_{args.minutes}m"),
+        ann=args.ann,
+        bm25=args.bm25,
+    )
+
+    print_summary(stages, time.perf_counter() - start_time)
+    if manifest:
+        manifest.close()
+    if speaker_cache:
+        stats = speaker_cache.stats()
+        print(f"Speaker cache: {stats['hits']} hits, {stats['misses']} misses")
+        speaker_cache.close()
+    if cache:
+        stats = cache.stats()
+        print(f"Embedding cache: {stats['hits']} hits, {stats['misses']} misses")
+        cache.close()
+    if not responses.report():
+        logger.error("Replayed requests missing from the response cache")
+        exit(1)
+
+
+def full_output_file(args):
+    """the full enriched output, named like prepare_transcripts_ai_show.sh does"""
+    return os.path.join(args.folder, "output", f"embedding_index_full_{args.minutes}m.jsonl")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-f", "--folder")
+    parser.add_argument("-p", "--playlist", help="download the playlist first")
+    parser.add_argument("-m", "--minutes", type=int, default=3)
+    parser.add_argument("-i", "--incremental", action="store_true")
+    parser.add_argument("--previous", help="previous full enriched output")
+    # stage concurrency limits, the defaults match the standalone scripts
+    parser.add_argument(
+        "--download-workers", type=int, default=transcript_download.PROCESSING_THREADS
+    )
+    parser.add_argument(
+        "--speaker-workers", type=int, default=transcript_enrich_speaker.PROCESSING_THREADS
+    )
+    parser.add_argument("--bucket-workers", type=int, default=2)
+    parser.add_argument(
+        "--summary-workers", type=int, default=transcript_enrich_summaries.PROCESSOR_THREADS
+    )
+    parser.add_argument(
+        "--embedding-workers", type=int, default=transcript_enrich_embeddings.PROCESSING_THREADS
+    )
+    parser.add_argument(
+        "-b", "--batch-size", type=int, default=transcript_enrich_embeddings.BATCH_SIZE
+    )
+    parser.add_argument(
+        "--batch-tokens", type=int, default=transcript_enrich_embeddings.BATCH_MAX_TOKENS
+    )
+    parser.add_argument("--rps", type=float, help=transcript_enrich_embeddings.RPS_HELP)
+    parser.add_argument("--cache", help="embedding cache file, defaults to the output folder")
+    parser.add_argument("--cache-size-mb", type=int, default=CACHE_MAX_MB)
+    parser.add_argument(
+        "--no-cache", action="store_true", help="do not use the embedding and speaker caches"
+    )
+    parser.add_argument("--ann", action="store_true", help="also build an IVF index")
+    parser.add_argument(
+        "--bm25", action="store_true", help="also build a BM25 index for text and hybrid search"
+    )
+    parser.add_argument("--queue-size", type=int, default=QUEUE_SIZE)
+    parser.add_argument("--report-interval", type=float, default=REPORT_INTERVAL)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    if args.verbose:
+        logger.setLevel(logging.DEBUG)
+    # openai creates one session per thread with the limiter's factory
+    limiter.install()
+
+    if not args.folder:
+        logger.error("Transcript folder not provided")
+        exit(1)
+
+    os.makedirs(os.path.join(args.folder, "output"), exist_ok=True)
+    asyncio.run(run_pipeline(args))
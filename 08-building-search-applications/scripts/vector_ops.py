@@ -0,0 +1,53 @@
+""" Vector helpers shared by the search indexes."""
+
+import numpy as np
+
+
+def normalize_rows(vectors):
+    """return float32 vectors scaled to unit length, zero vectors are left as zeros"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    # einsum sums the squares row by row, without a temporary the size of the matrix
+    norms = np.sqrt(np.einsum("...i,...i->...", vectors, vectors))[..., np.newaxis]
+
+    # ada_v2 vectors are already unit length, keep memory mapped indexes zero-copy
+    if np.allclose(norms, 1.0, atol=1e-3):
+        return vectors
+
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def top_k(scores, rows):
+    """return the indices of the `rows` highest scores, best first, along the last axis"""
+    rows = min(rows, scores.shape[-1])
+    if rows <= 0:
+        return np.empty(scores.shape[:-1] + (0,), dtype=np.int64)
+
+    if rows < scores.shape[-1]:
+        candidates = np.argpartition(-scores, rows - 1, axis=-1)[..., :rows]
+    else:
+        candidates = np.broadcast_to(np.arange(scores.shape[-1]), scores.shape)
+
+    order = np.argsort(-np.take_along_axis(scores, candidates, axis=-1), axis=-1)
+    return np.take_along_axis(candidates, order, axis=-1)
+
+
+def maximal_marginal_relevance(vectors, relevance, rows: int, mmr_lambda: float):
+    """
+    return the positions of `rows` normalized vectors picked by maximal marginal relevance,
+    in pick order. Each pick maximizes mmr_lambda * relevance minus (1 - mmr_lambda) times
+    the highest similarity to the vectors already picked, mmr_lambda 1.0 keeps the relevance order.
+    """
+    rows = min(rows, len(relevance))
+    if rows <= 0:
+        return np.empty(0, dtype=np.int64)
+
+    picked = [int(np.argmax(relevance))]
+    # highest similarity of every candidate to the picked ones, updated with one product per pick
+    redundancy = vectors @ vectors[picked[0]]
+    for _ in range(rows - 1):
+        marginal = mmr_lambda * relevance - (1 - mmr_lambda) * redundancy
+        marginal[picked] = -np.inf
+        picked.append(int(np.argmax(marginal)))
+        redundancy = np.maximum(redundancy, vectors @ vectors[picked[-1]])
+    return np.array(picked, dtype=np.int64)
@@ -0,0 +1,316 @@
+""" Vectorized top-k similarity search over the video segment embedding index."""
+
+import json
+import os
+import numpy as np
+from ann_index import IvfIndex
+from bm25_index import Bm25Index
+from embedding_index import VECTOR_KEY, load_index, metadata_columns
+from metadata_index import MetadataIndex
+from pq_index import PqIndex
+from vector_ops import maximal_marginal_relevance, normalize_rows, top_k
+
+SIMILARITIES_RESULTS_THRESHOLD = 0.75
+# number of PQ candidates re-scored with the exact vectors
+PQ_RERANK = 100
+# results of each ranking fused by the hybrid search, and the reciprocal rank fusion constant
+RRF_DEPTH = 50
+RRF_K = 60
+# a filter keeping more than this fraction of the rows scores all of them and masks the rest
+FILTER_SCAN_FRACTION = 0.15
+# best segments grouped by video, the best videos among them re-ranked by MMR
+GROUP_POOL = 1000
+MMR_CANDIDATES = 50
+MMR_LAMBDA = 0.7
+# segments before and after the best one returned with each video
+GROUP_NEIGHBOURS = 1
+
+
+def reciprocal_rank_fusion(rankings, rows: int, k: int = RRF_K):
+    """fuse rankings of indices, best first, by the sum of 1 / (k + rank), returns (indices, scores)"""
+    scores = {}
+    for ranking in rankings:
+        for rank, index in enumerate(ranking, start=1):
+            scores[int(index)] = scores.get(int(index), 0.0) + 1.0 / (k + rank)
+    fused = sorted(scores.items(), key=lambda item: -item[1])[:rows]
+    return (
+        np.array([index for index, _ in fused], dtype=np.int64),
+        np.array([score for _, score in fused], dtype=np.float32),
+    )
+
+
+class VideoIndex:
+    """in memory search index over pre-normalized float32 segment vectors
+
+    Cosine similarity reduces to a single matrix-vector product because the
+    segment vectors are normalized once when the index is built. When an IVF
+    index is attached with `build_ann` or found next to the compact index,
+    queries only score the vectors in the `nprobe` closest lists. When a PQ
+    index is attached the compressed codes are scored instead, with an exact
+    re-rank of the best candidates. `search_text` answers exact term queries
+    without an embedding and `search_hybrid` fuses both, over the BM25 index
+    found next to the compact index or one built on the first text search.
+
+    Every search takes the filters of `filter_rows` as keyword arguments. A
+    filtered search finds the candidate rows from the metadata row sets first
+    and scores only those, exactly, instead of filtering the scores of every row.
+
+    `search_videos` returns distinct videos instead of segments: the overlapping
+    segments of a video collapse into its best one, returned with its
+    neighbours, and an MMR re-rank keeps near duplicate videos apart.
+    """
+
+    def __init__(self, vectors, columns: dict[str, list]):
+        """build the index from a vector matrix and the metadata columns"""
+        self.vectors = np.ascontiguousarray(normalize_rows(vectors))
+        self.columns = columns
+        self.ann = None
+        self.pq = None
+        self.bm25 = None
+        self.metadata = None
+        self.groups = None
+
+    @classmethod
+    def load(cls, prefix: str):
+        """load the compact index written by transcript_enrich_lite.py, with its IVF index if present"""
+        vectors, columns = load_index(prefix)
+        index = cls(vectors, columns)
+
+        ann_file = prefix + ".ivf.npz"
+        if os.path.exists(ann_file):
+            index.ann = IvfIndex.load(ann_file, index.vectors)
+
+        pq_file = prefix + ".pq.npz"
+        if os.path.exists(pq_file):
+            index.pq = PqIndex.load(pq_file, index.vectors, rerank=PQ_RERANK)
+
+        bm25_file = prefix + ".bm25.npz"
+        if os.path.exists(bm25_file):
+            index.bm25 = Bm25Index.load(bm25_file)
+
+        # files left over from another build, or read while the index is being replaced
+        for name, sidecar in [("PQ", index.pq), ("BM25", index.bm25)]:
+            if sidecar is not None and len(sidecar) != len(index):
+                raise ValueError(
+                    f"{name} index of {prefix} has {len(sidecar)} rows, expected {len(index)}"
+                )
+        return index
+
+    @classmethod
+    def from_json(cls, source: str, vector_key: str = VECTOR_KEY):
+        """build the index from a JSON embedding index such as embedding_index_3m.json"""
+        with open(source, "r", encoding="utf-8") as f:
+            segments = [seg for seg in json.load(f) if seg.get(vector_key)]
+
+        vectors = np.array([seg[vector_key] for seg in segments], dtype=np.float32)
+        return cls(vectors, metadata_columns(segments))
+
+    def __len__(self):
+        return self.vectors.shape[0]
+
+    def build_ann(self, nlist: int | None = None, nprobe: int = 8):
+        """train an IVF index over the vectors and use it for searches"""
+        self.ann = IvfIndex.build(self.vectors, nlist=nlist, nprobe=nprobe)
+        return self.ann
+
+    def build_pq(self, m: int = 96, rerank: int = PQ_RERANK):
+        """train a product quantizer over the vectors and use it for searches"""
+        self.pq = PqIndex.build(self.vectors, m=m, rerank=rerank)
+        return self.pq
+
+    def build_bm25(self):
+        """build a BM25 index over the title, speaker and summary columns and use it for text searches"""
+        fields = [field for field in ("title", "speaker", "summary") if field in self.columns]
+        self.bm25 = Bm25Index.build(
+            {field: self.columns[field][i] for field in fields} for i in range(len(self))
+        )
+        return self.bm25
+
+    def warm(self):
+        """fault the mapped vectors into memory and build the metadata row sets before the first search"""
+        if self.metadata is None:
+            self.metadata = MetadataIndex(self.columns)
+        self.video_groups()
+        # one product over every row reads each page of the mapped vectors
+        _ = self.vectors @ np.zeros(self.vectors.shape[1], dtype=self.vectors.dtype)
+        return self
+
+    def filter_rows(self, speaker=None, video_ids=None, title=None, start=None, end=None):
+        """
+        the sorted rows matching every filter, None without filters. speaker and video_ids
+        take a value or a list of accepted values, title the words every title must contain,
+        start and end bound the segment start seconds, start <= seconds < end.
+        """
+        if speaker is None and video_ids is None and title is None and start is None and end is None:
+            return None
+        if self.metadata is None:
+            self.metadata = MetadataIndex(self.columns)
+        return self.metadata.rows(speaker, video_ids, title, start, end)
+
+    def video_groups(self):
+        """the video code of each row, the rows sorted by video and seconds, and each row's place there"""
+        if self.groups is None:
+            video_ids = np.asarray(self.columns["videoId"], dtype=str)
+            _, codes = np.unique(video_ids, return_inverse=True)
+            seconds = np.asarray(self.columns.get("seconds", [0] * len(self)), dtype=np.float64)
+            order = np.lexsort((seconds, codes))
+            positions = np.empty_like(order)
+            positions[order] = np.arange(len(order))
+            self.groups = (codes, order, positions)
+        return self.groups
+
+    def neighbour_rows(self, indices, count: int = GROUP_NEIGHBOURS):
+        """the rows of the `count` segments before and after each row in its video, by start seconds"""
+        codes, order, positions = self.video_groups()
+        indices = np.asarray(indices, dtype=np.int64)
+        offsets = np.concatenate((np.arange(-count, 0), np.arange(1, count + 1)))
+        places = positions[indices][:, np.newaxis] + offsets
+        inside = (places >= 0) & (places < len(order))
+        neighbours = order[np.clip(places, 0, len(order) - 1)]
+        same_video = inside & (codes[neighbours] == codes[indices][:, np.newaxis])
+        return [row_neighbours[keep] for row_neighbours, keep in zip(neighbours, same_video)]
+
+    def candidate_scores(self, queries, candidates):
+        """similarities of the normalized queries to the candidate rows"""
+        if len(candidates) > FILTER_SCAN_FRACTION * len(self):
+            # a broad filter, one contiguous product is cheaper than gathering the rows
+            return (queries @ self.vectors.T)[..., candidates]
+        return queries @ self.vectors[candidates].T
+
+    def search(
+        self,
+        query_vector,
+        rows: int = 5,
+        threshold: float = SIMILARITIES_RESULTS_THRESHOLD,
+        nprobe: int | None = None,
+        **filters,
+    ):
+        """return the (indices, similarities) of the best matches for one query"""
+        query = normalize_rows(query_vector)
+
+        candidates = self.filter_rows(**filters)
+        if candidates is not None:
+            scores = self.candidate_scores(query, candidates)
+            indices = top_k(scores, rows)
+            indices, similarities = candidates[indices], scores[indices]
+        elif self.ann:
+            indices, similarities = self.ann.search(query, rows, nprobe)
+        elif self.pq:
+            indices, similarities = self.pq.search(query, rows)
+        else:
+            scores = self.vectors @ query
+            indices = top_k(scores, rows)
+            similarities = scores[indices]
+
+        mask = similarities >= threshold
+        return indices[mask], similarities[mask]
+
+    def search_batch(
+        self,
+        query_vectors,
+        rows: int = 5,
+        threshold: float = SIMILARITIES_RESULTS_THRESHOLD,
+        nprobe: int | None = None,
+        **filters,
+    ):
+        """answer a batch of queries with one matrix multiply, returns a list of (indices, similarities)"""
+        candidates = self.filter_rows(**filters)
+        if candidates is None and (self.ann or self.pq):
+            return [
+                self.search(query, rows, threshold, nprobe)
+                for query in np.atleast_2d(query_vectors)
+            ]
+
+        queries = normalize_rows(np.atleast_2d(query_vectors))
+        if candidates is not None:
+            scores = self.candidate_scores(queries, candidates)
+        else:
+            scores = queries @ self.vectors.T
+
+        indices = top_k(scores, rows)
+        similarities = np.take_along_axis(scores, indices, axis=-1)
+        if candidates is not None:
+            indices = candidates[indices]
+
+        results = []
+        for row_indices, row_similarities in zip(indices, similarities):
+            mask = row_similarities >= threshold
+            results.append((row_indices[mask], row_similarities[mask]))
+        return results
+
+    def search_videos(
+        self,
+        query_vector,
+        rows: int = 5,
+        threshold: float = SIMILARITIES_RESULTS_THRESHOLD,
+        mmr_lambda: float = MMR_LAMBDA,
+        neighbours: int = GROUP_NEIGHBOURS,
+        pool: int = GROUP_POOL,
+        nprobe: int | None = None,
+        **filters,
+    ):
+        """
+        return the (indices, similarities, neighbour rows) of the best segment of `rows` distinct
+        videos. One search over the index takes the best `pool` segments, the best segment of
+        each video among them is kept, and the MMR_CANDIDATES best videos are re-ranked by
+        maximal marginal relevance, mmr_lambda 1.0 keeps the similarity order.
+        """
+        indices, similarities = self.search(query_vector, pool, threshold, nprobe, **filters)
+
+        # the results are best first, so the first segment of each video is its best
+        codes = self.video_groups()[0]
+        _, first = np.unique(codes[indices], return_index=True)
+        first = np.sort(first)[:MMR_CANDIDATES]
+        indices, similarities = indices[first], similarities[first]
+
+        picked = maximal_marginal_relevance(self.vectors[indices], similarities, rows, mmr_lambda)
+        indices, similarities = indices[picked], similarities[picked]
+        return indices, similarities, self.neighbour_rows(indices, neighbours)
+
+    def search_text(self, query: str, rows: int = 5, **filters):
+        """
+        return the (indices, BM25 scores) of the best matches for a text query, no embedding needed.
+        without a saved BM25 index, one is built on the first text search
+        """
+        if self.bm25 is None:
+            self.build_bm25()
+
+        allowed = None
+        candidates = self.filter_rows(**filters)
+        if candidates is not None:
+            allowed = np.zeros(len(self), dtype=bool)
+            allowed[candidates] = True
+        return self.bm25.search(query, rows, allowed)
+
+    def search_hybrid(
+        self,
+        query: str,
+        query_vector,
+        rows: int = 5,
+        threshold: float = SIMILARITIES_RESULTS_THRESHOLD,
+        depth: int = RRF_DEPTH,
+        nprobe: int | None = None,
+        **filters,
+    ):
+        """return the (indices, fused scores) of the reciprocal rank fusion of the text and vector searches"""
+        vector_indices, _ = self.search(query_vector, depth, threshold, nprobe, **filters)
+        text_indices, _ = self.search_text(query, depth, **filters)
+        return reciprocal_rank_fusion([vector_indices, text_indices], rows)
+
+    def records(self, indices, similarities, neighbours=None):
+        """
+        return the metadata rows for the search results with their similarity, and the
+        start seconds and summary of their neighbour segments when search_videos found them
+        """
+        context = [column for column in ("seconds", "summary") if column in self.columns]
+        results = []
+        for i, (index, similarity) in enumerate(zip(indices, similarities)):
+            record = {column: values[index] for column, values in self.columns.items()}
+            record["similarity"] = float(similarity)
+            if neighbours is not None:
+                record["neighbours"] = [
+                    {column: self.columns[column][row] for column in context}
+                    for row in neighbours[i]
+                ]
+            results.append(record)
+        return results